@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 import os
 import sys
+import time
+import argparse
 import hashlib
 import logging
+import sqlite3
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
 from pathlib import Path
 import numpy as np
 from astropy.io import fits
@@ -15,36 +21,164 @@ from PIL import Image
 CUTOUT_SIZE = 1000
 SRC_DIR = Path("/mnt/waz/nas/transfer_data")
 DEST_DIR = Path("/mnt/waz/nas/cutouts/")
-LOG_FILE = DEST_DIR / "cutout_log.txt"
+LOG_NAME = "cutout_log.txt"
+MANIFEST_NAME = "cutout_manifest.sqlite"
 
 # ========================
 # LOGGING SETUP
 # ========================
-DEST_DIR.mkdir(parents=True, exist_ok=True)
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-)
-console = logging.StreamHandler(sys.stdout)
-console.setLevel(logging.INFO)
-formatter = logging.Formatter("%(message)s")
-console.setFormatter(formatter)
-logging.getLogger().addHandler(console)
+def setup_logging(dest_dir: Path) -> None:
+    """Log to dest_dir/cutout_log.txt and the console. Called by the command line entry point,
+    so importing this module has no side effects."""
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    logging.basicConfig(
+        filename=dest_dir / LOG_NAME,
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(logging.INFO)
+    formatter = logging.Formatter("%(message)s")
+    console.setFormatter(formatter)
+    logging.getLogger().addHandler(console)
+
 
 # ========================
 # CORE FUNCTIONS
 # ========================
 
+FITS_BLOCK = 2880
+READ_BLOCK = 8 * 1024 * 1024
+
+
+def _new_hash(algorithm):
+    """Return a hash object for a hashlib algorithm name or a hashlib-style constructor."""
+    return hashlib.new(algorithm) if isinstance(algorithm, str) else algorithm()
+
+
+def hash_file(file_path: Path, algorithm="sha256", block_size: int = READ_BLOCK) -> str:
+    """Hash a whole file with large unbuffered reads into a reused buffer."""
+    h = _new_hash(algorithm)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
 def sha256sum(file_path: Path) -> str:
     """Compute SHA-256 checksum of a file (for duplicate detection)."""
-    h = hashlib.sha256()
+    return hash_file(file_path, "sha256")
+
+
+def _fits_header_length(f, size: int, max_blocks: int = 360) -> int:
+    """Return the length of the primary FITS header (up to its END card), or one block for other files."""
+    f.seek(0)
+    for block in range(min(max_blocks, size // FITS_BLOCK)):
+        data = f.read(FITS_BLOCK)
+        for card in range(0, FITS_BLOCK, 80):
+            if data[card:card + 8] == b"END     ":
+                return (block + 1) * FITS_BLOCK
+    return min(size, FITS_BLOCK)
+
+
+def sample_hash(file_path: Path, algorithm="sha256", samples: int = 8, sample_size: int = 64 * 1024) -> str:
+    """Hash a file's size, its FITS header and `samples` evenly spaced blocks of its data.
+    Files with equal sample hashes are only probably identical; compare full hashes to be sure."""
+    h = _new_hash(algorithm)
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
+        size = os.fstat(f.fileno()).st_size
+        h.update(size.to_bytes(8, "little"))
+        header = _fits_header_length(f, size)
+        f.seek(0)
+        h.update(f.read(header))
+
+        span = size - header
+        if span <= samples * sample_size:
+            h.update(f.read(span))
+        else:
+            for i in range(samples):
+                f.seek(header + (span - sample_size) * i // max(samples - 1, 1))
+                h.update(f.read(sample_size))
     return h.hexdigest()
 
 
+class DuplicateDetector:
+    """Finds files duplicating an earlier kept file in three tiers, reading as little as possible:
+    files of a unique size are never read, files of a shared size are compared by sample_hash,
+    and full hashes are computed only when sample hashes collide.
+
+    Hashes are computed lazily and reported through on_hash(path, sample_hash, full_hash)
+    so a caller can store them for the next run."""
+
+    def __init__(self, algorithm="sha256", samples: int = 8, sample_size: int = 64 * 1024, on_hash=None):
+        self.algorithm = algorithm
+        self.samples = samples
+        self.sample_size = sample_size
+        self.on_hash = on_hash
+        self.stage_times = defaultdict(lambda: [0, 0.0])
+        self._kept = defaultdict(list)
+        self._kept_paths = set()
+
+    def sample_hash(self, path) -> str:
+        start = time.perf_counter()
+        value = sample_hash(path, self.algorithm, self.samples, self.sample_size)
+        self._time("sample", start)
+        return value
+
+    def full_hash(self, path) -> str:
+        start = time.perf_counter()
+        value = hash_file(path, self.algorithm)
+        self._time("full", start)
+        return value
+
+    def _time(self, stage, start):
+        self.stage_times[stage][0] += 1
+        self.stage_times[stage][1] += time.perf_counter() - start
+
+    def keep(self, path, size: int, sample: str = None, full: str = None) -> None:
+        """Register a file whose cutout is kept, so later files with the same content are duplicates."""
+        if str(path) not in self._kept_paths:
+            self._kept[size].append([str(path), sample, full])
+            self._kept_paths.add(str(path))
+
+    def _tier(self, entry, index, compute):
+        """Return a kept file's hash for a tier, computing and reporting it on first use."""
+        if entry[index] is None:
+            entry[index] = compute(entry[0])
+            if self.on_hash is not None:
+                self.on_hash(entry[0], entry[1], entry[2])
+        return entry[index]
+
+    def check(self, path, size: int, sample: str = None, full: str = None):
+        """Return (kept path this file duplicates or None, sample hash, full hash).
+        Files that are not duplicates are kept. Hashes not needed for the decision are returned as None."""
+        path = str(path)
+        if path in self._kept_paths:
+            entry = next(entry for entry in self._kept[size] if entry[0] == path)
+            entry[1], entry[2] = entry[1] or sample, entry[2] or full
+            return None, entry[1], entry[2]
+        candidates = self._kept[size]
+        if not candidates:
+            self.keep(path, size, sample, full)
+            return None, sample, full
+
+        sample = sample or self.sample_hash(path)
+        candidates = [entry for entry in candidates if self._tier(entry, 1, self.sample_hash) == sample]
+        if candidates:
+            full = full or self.full_hash(path)
+            for entry in candidates:
+                if self._tier(entry, 2, self.full_hash) == full:
+                    return entry[0], sample, full
+
+        self.keep(path, size, sample, full)
+        return None, sample, full
+
+
 def write_fits_center_cutout_png16(data: np.ndarray, out_path: Path, zscale: bool = True) -> None:
     """Save a centered 1000x1000 px cutout of a FITS image as a 16-bit PNG."""
     if data is None or data.ndim != 2:
@@ -104,8 +238,144 @@ def write_fits_center_cutout_png16(data: np.ndarray, out_path: Path, zscale: boo
     Image.fromarray(out_uint16, mode="I;16").save(out_path)
 
 
-def process_all_fits(src_dir: Path, dest_dir: Path) -> None:
-    """Find all .fits files in src_dir and save PNG cutouts to dest_dir."""
+class CutoutManifest:
+    """Persistent record of the FITS files seen by earlier runs, keyed by path, size and mtime.
+
+    Stores each file's DuplicateDetector hashes (only those that were needed), and either the PNG
+    it owns or the path of the file it duplicates, so unchanged files are not read again and
+    duplicates are found across runs. Manifests written before the hashes were tiered are upgraded."""
+
+    def __init__(self, path: Path, algorithm: str = "sha256", commit_every: int = 1000):
+        self.algorithm = algorithm
+        self.commit_every = commit_every
+        self._pending = 0
+        self._db = sqlite3.connect(str(path))
+        self._db.execute("PRAGMA journal_mode=WAL;")
+        old_layout = "hash" in [row[1] for row in self._db.execute("PRAGMA table_info(files)")]
+        if old_layout:
+            self._db.execute("ALTER TABLE files RENAME TO files_v1")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                         path TEXT PRIMARY KEY,
+                         size INTEGER NOT NULL,
+                         mtime_ns INTEGER NOT NULL,
+                         algorithm TEXT NOT NULL,
+                         sample_hash TEXT,
+                         full_hash TEXT,
+                         png_path TEXT,
+                         duplicate_of TEXT)""")
+        if old_layout:
+            # Old manifests hold full SHA-256 hashes
+            self._db.execute("""INSERT INTO files SELECT path, size, mtime_ns, 'sha256', NULL, hash, png_path, duplicate_of
+                             FROM files_v1""")
+            self._db.execute("DROP TABLE files_v1")
+            self._db.commit()
+        # path -> (size, mtime_ns, algorithm, sample_hash, full_hash, png_path, duplicate_of), as stored
+        self._files = {row[0]: row[1:] for row in self._db.execute("SELECT * FROM files")}
+
+    def cached(self, path: str, size: int, mtime_ns: int):
+        """Return the stored (sample hash, full hash) of a file if its size and mtime are unchanged
+        and it was hashed with this manifest's algorithm, else None."""
+        entry = self._files.get(path)
+        if entry is None or entry[:3] != (size, mtime_ns, self.algorithm):
+            return None
+        return entry[3:5]
+
+    def owners(self):
+        """Return (path, size, mtime_ns) of every file whose cutout was kept."""
+        return self._db.execute("SELECT path, size, mtime_ns FROM files WHERE duplicate_of IS NULL ORDER BY rowid").fetchall()
+
+    def record(self, path: str, size: int, mtime_ns: int, sample: str = None, full: str = None,
+               png_path=None, duplicate_of=None):
+        """Store a file's hashes and whether it owns png_path or duplicates another file.
+        Nothing is written if the stored row is already the same."""
+        entry = (size, mtime_ns, self.algorithm, sample, full, png_path and str(png_path), duplicate_of)
+        if self._files.get(path) == entry:
+            return
+        self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (path,) + entry)
+        self._files[path] = entry
+        self._changed()
+
+    def update_hashes(self, path: str, sample: str, full: str):
+        """Store hashes computed later for a file already recorded."""
+        entry = self._files.get(path)
+        if entry is None or entry[2:5] == (self.algorithm, sample, full):
+            return
+        self._db.execute("UPDATE files SET algorithm = ?, sample_hash = ?, full_hash = ? WHERE path = ?",
+                         (self.algorithm, sample, full, path))
+        self._files[path] = entry[:2] + (self.algorithm, sample, full) + entry[5:]
+        self._changed()
+
+    def forget(self, path: str):
+        """Remove a file that no longer exists."""
+        self._db.execute("DELETE FROM files WHERE path = ?", (path,))
+        self._files.pop(path, None)
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
+def _sample_task(fits_path: Path, algorithm, samples: int, sample_size: int):
+    """Sample-hash one file. Returns (fits_path, hash or None, error or None, seconds)."""
+    start = time.perf_counter()
+    try:
+        return fits_path, sample_hash(fits_path, algorithm, samples, sample_size), None, time.perf_counter() - start
+    except Exception as e:
+        return fits_path, None, e, time.perf_counter() - start
+
+
+def _convert_task(fits_path: Path, png_path: Path):
+    """Read one FITS file and write its PNG cutout.
+    Runs in worker processes, so the log message is returned rather than logged.
+    Returns (level, message, {stage: seconds})."""
+    timings = {}
+    try:
+        start = time.perf_counter()
+        data = fits.getdata(fits_path)
+        timings["read"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        write_fits_center_cutout_png16(data, png_path)
+        timings["write"] = time.perf_counter() - start
+        return logging.INFO, f"✅ {fits_path} → {png_path}", timings
+    except Exception as e:
+        return logging.ERROR, f"⚠️  Failed {fits_path}: {e}", timings
+
+
+def _log_timing_summary(stage_times, counts, elapsed, workers):
+    """Log the files handled and the time spent in each stage."""
+    logging.info(f"⏱️  {elapsed:.1f} s with {workers} worker(s): {counts['converted']} converted, "
+                 f"{counts['duplicate']} duplicates, {counts['existing']} already done, {counts['failed']} failed, "
+                 f"{counts['unchanged']} unchanged since the last run")
+    for stage, (n, seconds) in stage_times.items():
+        logging.info(f"⏱️  {stage:>6}: {n} files, {seconds:.1f} s total, {1000 * seconds / max(n, 1):.1f} ms/file")
+
+
+def process_all_fits(src_dir: Path, dest_dir: Path, workers: int = 1, max_in_flight: int = None,
+                     manifest: bool = True, algorithm="sha256") -> None:
+    """Find all .fits files in src_dir and save PNG cutouts to dest_dir.
+
+    Duplicates are found by DuplicateDetector: only files sharing a size are sample-hashed, and
+    only files sharing a sample hash are hashed in full. algorithm is a hashlib name or constructor.
+
+    With workers > 1 sample hashes are computed and files converted in a process pool. Duplicates
+    are still decided in file order by this process. Sample hashes are computed at most max_in_flight
+    files (default 2 * workers) ahead of that, and at most max_in_flight conversions are queued at once,
+    so frames are not read faster than they are written.
+
+    With manifest set, hashes are kept in dest_dir/cutout_manifest.sqlite. Files whose size and
+    mtime are unchanged since an earlier run are not read again, and a file duplicating one
+    converted by an earlier run is skipped.
+    """
     fits_files = list(src_dir.rglob("*.fits"))
     if not fits_files:
         logging.info(f"No FITS files found under {src_dir}")
@@ -113,33 +383,145 @@ def process_all_fits(src_dir: Path, dest_dir: Path) -> None:
 
     logging.info(f"Found {len(fits_files)} FITS files. Processing...")
 
-    seen_hashes = set()
+    start = time.perf_counter()
+    stage_times = defaultdict(lambda: [0, 0.0])
+    counts = Counter()
+
+    def record(level, message, timings):
+        logging.log(level, message)
+        counts["converted" if level == logging.INFO else "failed"] += 1
+        for stage, seconds in timings.items():
+            stage_times[stage][0] += 1
+            stage_times[stage][1] += seconds
 
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    hash_name = algorithm if isinstance(algorithm, str) else getattr(algorithm, "__name__", repr(algorithm))
+    files = CutoutManifest(dest_dir / MANIFEST_NAME, hash_name) if manifest else None
+    detector = DuplicateDetector(algorithm, on_hash=files.update_hashes if files is not None else None)
+
+    # Stat every file, reusing the hashes of files unchanged since the last run
+    entries = []
     for fits_path in fits_files:
         try:
-            file_hash = sha256sum(fits_path)
-            if file_hash in seen_hashes:
-                logging.info(f"⏭️  Skipping duplicate: {fits_path}")
+            stat = fits_path.stat()
+        except OSError as e:
+            logging.error(f"⚠️  Failed {fits_path}: {e}")
+            counts["failed"] += 1
+            continue
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = files.cached(str(fits_path), *key) if files is not None else None
+        counts["unchanged"] += cached is not None
+        entries.append((fits_path, key, cached or (None, None)))
+
+    # Files kept by earlier runs are the first owners, as long as they still exist unchanged.
+    # Their hashes are computed by the detector if another file is compared with them.
+    sizes = Counter(key[0] for _, key, _ in entries)
+    run_owners = set()
+    if files is not None:
+        in_run = {str(fits_path): (key, cached) for fits_path, key, cached in entries}
+        for path, size, mtime_ns in files.owners():
+            if path in in_run:
+                key, cached = in_run[path]
+                if key == (size, mtime_ns):
+                    detector.keep(path, size, *cached)
+                    run_owners.add(path)
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                files.forget(path)
+                continue
+            cached = files.cached(path, stat.st_size, stat.st_mtime_ns) or (None, None)
+            detector.keep(path, stat.st_size, *cached)
+            sizes[stat.st_size] += 1
+
+    # Only files sharing a size with another file need their sample hash
+    to_sample = iter([fits_path for fits_path, key, (sample, _) in entries
+                      if sizes[key[0]] > 1 and sample is None and str(fits_path) not in run_owners])
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    max_in_flight = max_in_flight or 2 * workers
+    try:
+        task = partial(_sample_task, algorithm=algorithm, samples=detector.samples, sample_size=detector.sample_size)
+        sampling = deque()
+        in_flight = set()
+
+        for fits_path, key, (sample, full) in entries:
+            # Sample hashes are computed in the pool at most max_in_flight files ahead of the file being decided
+            while executor is not None and len(sampling) < max_in_flight:
+                next_path = next(to_sample, None)
+                if next_path is None:
+                    break
+                sampling.append((next_path, executor.submit(task, next_path)))
+
+            try:
+                if sampling and sampling[0][0] == fits_path:
+                    _, sample, error, seconds = sampling.popleft()[1].result()
+                    stage_times["sample"][0] += 1
+                    stage_times["sample"][1] += seconds
+                    if error is not None:
+                        raise error
+                owner, sample, full = detector.check(fits_path, key[0], sample, full)
+            except Exception as e:
+                logging.error(f"⚠️  Failed {fits_path}: {e}")
+                counts["failed"] += 1
                 continue
-            seen_hashes.add(file_hash)
 
             rel_path = fits_path.relative_to(src_dir)
             png_path = dest_dir / rel_path.with_suffix(".png")
 
+            if files is not None:
+                files.record(str(fits_path), *key, sample, full,
+                             png_path=None if owner else png_path, duplicate_of=owner)
+
+            if owner is not None:
+                logging.info(f"⏭️  Skipping duplicate: {fits_path}")
+                counts["duplicate"] += 1
+                continue
+
             if png_path.exists():
                 logging.info(f"⏭️  PNG already exists, skipping: {png_path}")
+                counts["existing"] += 1
                 continue
 
-            data = fits.getdata(fits_path)
-            write_fits_center_cutout_png16(data, png_path)
-            logging.info(f"✅ {fits_path} → {png_path}")
+            if executor is None:
+                record(*_convert_task(fits_path, png_path))
+                continue
 
-        except Exception as e:
-            logging.error(f"⚠️  Failed {fits_path}: {e}")
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(*future.result())
+            in_flight.add(executor.submit(_convert_task, fits_path, png_path))
+
+        for future in wait(in_flight).done:
+            record(*future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if files is not None:
+            files.close()
+
+    for stage, (n, seconds) in detector.stage_times.items():
+        stage_times[stage][0] += n
+        stage_times[stage][1] += seconds
+    _log_timing_summary(stage_times, counts, time.perf_counter() - start, workers)
 
 
 if __name__ == "__main__":
-    src = Path(sys.argv[1]) if len(sys.argv) > 1 else SRC_DIR
-    dest = Path(sys.argv[2]) if len(sys.argv) > 2 else DEST_DIR
-    process_all_fits(src, dest)
+    parser = argparse.ArgumentParser(description="Save centered PNG cutouts of every FITS file under a directory.")
+    parser.add_argument("src", nargs="?", type=Path, default=SRC_DIR, help=f"directory to search (default {SRC_DIR})")
+    parser.add_argument("dest", nargs="?", type=Path, default=DEST_DIR, help=f"directory for the PNGs (default {DEST_DIR})")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="worker processes (default 1, serial)")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="conversions queued at once (default 2 x workers)")
+    parser.add_argument("--no-manifest", action="store_true",
+                        help=f"hash every file again instead of using dest/{MANIFEST_NAME}")
+    parser.add_argument("--hash", default="sha256", choices=sorted(a for a in hashlib.algorithms_available if not a.startswith("shake")),
+                        help="hashlib algorithm used to compare files (default sha256)")
+    args = parser.parse_args()
+
+    setup_logging(args.dest)
+    process_all_fits(args.src, args.dest, args.workers, args.max_in_flight, manifest=not args.no_manifest,
+                     algorithm=args.hash)
     logging.info("✅ All processing complete.")
@@ -0,0 +1,253 @@
+'''
+asyncio variant of the DatabaseManager for the scheduler and web status services.
+
+Uses psycopg 3 with a psycopg_pool.AsyncConnectionPool, so many concurrent coroutines share a
+few connections without threads. The statements are the ones DatabaseManager runs (see queries).
+The tables must already have been created, e.g. by a DatabaseManager.
+'''
+from logging import Logger
+import os
+import socket
+
+from psycopg_pool import AsyncConnectionPool
+
+from database import queries
+from database.calibration_cache import CalibrationCache
+from database.database_manager import DatabaseError, DatabaseManager
+
+
+class AsyncDatabaseManager:
+    """Awaitable versions of the DatabaseManager's queue, status, calibration and reference queries"""
+
+    claim_orders = DatabaseManager.claim_orders
+    closest_image_radii = DatabaseManager.closest_image_radii
+
+    def __init__(self, db_details, logger: Logger, schema="pipeline", min_size=1, max_size=4, timeout=30.0,
+                 claim_order="fifo", lease_seconds=900):
+        """Prepares the pool. Connections are opened by open(), or by entering the manager with async with.
+
+        @param db_details       Connection keywords, as for DatabaseManager
+        @param min_size         Connections kept open
+        @param max_size         Most connections opened; further queries wait for a free one
+        @param timeout          Seconds a query waits for a connection before failing
+        """
+        if claim_order not in self.claim_orders:
+            raise ValueError(f"Unknown claim order: {claim_order}")
+        self.claim_order = claim_order
+        self.lease_seconds = lease_seconds
+        self.schema = schema
+        self.logger = logger
+        self.calibration_cache = CalibrationCache()
+        self._known_steps = None
+
+        details = dict(db_details)
+        # psycopg2 accepts database= as an alias of dbname=, libpq does not
+        if "database" in details:
+            details["dbname"] = details.pop("database")
+        details["options"] = f"-c search_path={schema}"
+        self.pool = AsyncConnectionPool("", min_size=min_size, max_size=max_size, timeout=timeout,
+                                        kwargs=details, open=False)
+
+    async def open(self):
+        """Opens the pool's connections"""
+        try:
+            await self.pool.open(wait=True)
+        except Exception as e:
+            self.logger.exception(f"Failed to Connect to Database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to Connect to Database.") from e
+
+    async def close(self):
+        """Closes the pool's connections"""
+        await self.pool.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def pool_stats(self):
+        """Returns the pool's counters (connections, waiting requests, wait times)"""
+        return self.pool.get_stats()
+
+    @staticmethod
+    def _counter_shard(connection):
+        """Returns the counter shard of a pooled connection, so connections never share a counter row"""
+        return f"{socket.gethostname()}:{os.getpid()}:{connection.info.backend_pid}"[:128]
+
+    async def get_next_image(self):
+        """Get the next un-processed image from the 'image_status' table, while setting its status to 'processing'.
+        Returns the file path, image_id, and log_path for the image."""
+        await self.add_pipeline_step('assigned', 'assigned')
+        try:
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(queries.CLAIM_NEXT_IMAGE.format(order=self.claim_orders[self.claim_order]),
+                                     (self.lease_seconds,))
+                next_image = await cursor.fetchone()
+        except Exception as e:
+            self.logger.exception(f"Failed to claim the next image.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to claim the next image.") from e
+
+        if next_image:
+            return next_image[0], next_image[1], next_image[2]
+        return None, -1, None
+
+    async def get_queue_depth(self):
+        """Returns the number of images waiting in the queue for each priority, as {priority: count}"""
+        try:
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(queries.QUEUE_DEPTH)
+                return dict(await cursor.fetchall())
+        except Exception as e:
+            self.logger.exception(f"Failed to query the queue depth.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to query the queue depth.") from e
+
+    async def update_image_status(self, image, pipeline_step, step_shortname, update_time, runtime, step_message="NO MESSAGE"):
+        """Updates an image's status in the database including which step it's on and
+        its total processing time. Updates the image status and the pipeline status tables.
+        Updates for images no longer in the live queue (finished and archived) are dropped."""
+        try:
+            step_message = step_message[:127]
+            await self.add_pipeline_step(pipeline_step, step_shortname)
+
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(queries.LIVE_IMAGE_STEP, (image.db_id,))
+                row = await cursor.fetchone()
+                if row is None:
+                    # Archived images have no row to update, and must not move the counters
+                    self.logger.warning(f"Dropped a status update for image {image.db_id}, which is no longer in the live queue.")
+                    return
+                starting = row[0] != pipeline_step
+
+                await cursor.execute(queries.UPDATE_IMAGE_STEP,
+                                     (pipeline_step, update_time, runtime, step_message,
+                                      starting, self.lease_seconds, image.db_id))
+
+                deltas = (1, 0, 0) if starting else (-1, 1, runtime)
+                await cursor.execute(queries.UPDATE_STEP_COUNTERS.format(rows="VALUES " + queries.STEP_COUNTER_ROW),
+                                     (pipeline_step, self._counter_shard(connection)) + deltas)
+                if not starting:
+                    await cursor.execute(queries.RECORD_STEP_RUNTIME, (image.db_id, pipeline_step, runtime))
+        except Exception as e:
+            self.logger.exception(f"Failed to update the database image status.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to update the database image status.") from e
+
+    async def get_step_from_status_table(self, image_id):
+        """Query the pipeline_step from the image status table for an image"""
+        try:
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(queries.IMAGE_STEP, (image_id,))
+                row = await cursor.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            self.logger.warning(f"Failed to query the database image status table.", exc_info=True)
+            return None
+
+    async def get_image_status(self, image_id):
+        """Returns an image's status row as a dict, whether it is in the live queue or the archive,
+        or None if the image has no status"""
+        try:
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(queries.IMAGE_STATUS, (image_id,))
+                row = await cursor.fetchone()
+                if row is None:
+                    return None
+                return dict(zip([column.name for column in cursor.description], row))
+        except Exception as e:
+            self.logger.warning(f"Failed to query the database image status table.", exc_info=True)
+            return None
+
+    async def get_pipeline_status(self):
+        """Returns (pipeline_step, shortname, total_runtime, n_processed, n_current) for every step,
+        including counts not yet rolled up into the status table"""
+        try:
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(queries.PIPELINE_STATUS)
+                return await cursor.fetchall()
+        except Exception as e:
+            self.logger.exception(f"Failed to query the pipeline status.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to query the pipeline status.") from e
+
+    async def add_pipeline_step(self, pipeline_step, shortname):
+        """Adds a new pipeline step to the database unless the step registry already has it"""
+        try:
+            if self._known_steps is None:
+                async with self.pool.connection() as connection, connection.cursor() as cursor:
+                    await cursor.execute(queries.PIPELINE_STEPS)
+                    self._known_steps = {row[0] for row in await cursor.fetchall()}
+            if pipeline_step in self._known_steps:
+                return
+
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(queries.ADD_PIPELINE_STEP, (pipeline_step, shortname))
+            self._known_steps.add(pipeline_step)
+        except Exception as e:
+            self.logger.error(f"Failed to add a pipeline step to the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to add a pipeline step to the database.") from e
+
+    def invalidate_step_registry(self):
+        """Forget the cached pipeline steps. The registry is reloaded on the next step check."""
+        self._known_steps = None
+
+    async def retrieve_closest_image(self, image_id, ra, dec, filter="NONE"):
+        """Retrieves the closest image in the database by its RA and DEC coordinate,
+        searching cones of increasing radius as DatabaseManager.retrieve_closest_image does"""
+        try:
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                for params in queries.closest_image_cones(ra, dec, filter, self.closest_image_radii):
+                    await cursor.execute(queries.CLOSEST_IMAGE, params)
+                    result = await cursor.fetchone()
+                    if result is not None:
+                        return result
+                return None
+        except Exception as e:
+            self.logger.exception(f"Failed to find a close image pair in the database. {image_id}, {ra}, {dec}\n{type(e).__name__}: {e.args}")
+            return None
+
+    async def get_flat(self, telescopeName, filter, date):
+        """Returns the filepath and timestamp of closest flat by time.
+        Only looks at flats from the same telescope and filter. Cached per (telescope, filter, night)."""
+        try:
+            key = ("flat", telescopeName, filter, queries.observing_night(date))
+            candidates = self.calibration_cache.get(key)
+
+            if candidates is None:
+                night_start, night_end = queries.night_bounds(date)
+                async with self.pool.connection() as connection, connection.cursor() as cursor:
+                    await cursor.execute(queries.FLATS_FOR_NIGHT,
+                                         {"telescope": telescopeName, "filter": filter,
+                                          "start": night_start, "end": night_end})
+                    candidates = await cursor.fetchall()
+                # No flats yet: ask again next time rather than missing one added by another process
+                if candidates:
+                    self.calibration_cache.put(key, candidates)
+
+            return queries.closest_in_time(candidates, date)
+        except Exception as e:
+            self.logger.exception(f"Failed to find flat in database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to find flat in database.") from e
+
+    async def _latest_calibration(self, kind, query, camera_id):
+        """Returns the file path of the most recent bias or dark of a camera, using the calibration cache"""
+        file_path = self.calibration_cache.get((kind, camera_id))
+        if file_path is not None:
+            return file_path
+
+        try:
+            async with self.pool.connection() as connection, connection.cursor() as cursor:
+                await cursor.execute(query, (camera_id,))
+                file_path = (await cursor.fetchone())[0]
+        except Exception as e:
+            self.logger.exception(f"Failed to find {kind} in database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError(f"Failed to find {kind} in database.") from e
+        self.calibration_cache.put((kind, camera_id), file_path)
+        return file_path
+
+    async def get_bias(self, camera_id):
+        """Returns the filepath of the most time recent bias .fits file based on the unique camera id"""
+        return await self._latest_calibration("bias", queries.LATEST_BIAS, camera_id)
+
+    async def get_dark(self, camera_id):
+        """Returns the filepath of the most time recent dark .fits file based on the unique camera id"""
+        return await self._latest_calibration("dark", queries.LATEST_DARK, camera_id)
@@ -0,0 +1,113 @@
+'''
+Background helpers for the DatabaseManager.
+
+- PeriodicWorker     - runs a function on a daemon thread every interval, or early when woken
+- StatusUpdateBuffer - queues image status transitions and flushes them in batches
+- weak_method        - calls a bound method without keeping its object alive
+'''
+from logging import Logger
+import threading
+import weakref
+
+
+def weak_method(method):
+    """Wraps a bound method so that holding the wrapper (e.g. in a thread or an atexit hook) does not
+    keep its object alive. Once the object has been collected, calls do nothing and return None."""
+    reference = weakref.WeakMethod(method)
+
+    def call(*args, **kwargs):
+        method = reference()
+        if method is not None:
+            return method(*args, **kwargs)
+
+    return call
+
+
+class PeriodicWorker:
+    """Calls a function from a daemon thread every interval seconds, or as soon as it is woken"""
+
+    def __init__(self, interval, function, logger: Logger, name="periodic-worker"):
+        """@param interval  Seconds between calls
+        @param function     Callable taking no arguments
+        @param logger       Logger for exceptions raised by the function
+        @param name         Name of the thread"""
+        self.interval = interval
+        self.function = function
+        self.logger = logger
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopping.is_set():
+                break
+            try:
+                self.function()
+            except Exception:
+                self.logger.exception(f"Background task {self._thread.name} failed.")
+
+    def wake(self):
+        """Runs the function now instead of waiting for the interval"""
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        """Stops the thread after any call in progress has finished"""
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+
+class StatusUpdateBuffer:
+    """Queues image status transitions in memory. A background thread flushes them when
+    max_batch updates are waiting or max_delay seconds have passed."""
+
+    def __init__(self, flush, logger: Logger, max_batch=500, max_delay=1.0):
+        """@param flush     Callable writing a list of queued updates to the database
+        @param logger       Logger for failed flushes
+        @param max_batch    Number of queued updates that triggers a flush
+        @param max_delay    Maximum seconds an update waits before being flushed"""
+        self.max_batch = max_batch
+        self._flush = flush
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # The thread holds the buffer weakly, so an owner that is no longer used can be collected
+        self._worker = PeriodicWorker(max_delay, weak_method(self.flush), logger, name="status-write-behind")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def put(self, update):
+        """Queues an update, waking the flush thread if the batch is full"""
+        with self._lock:
+            self._pending.append(update)
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._worker.wake()
+
+    def flush(self):
+        """Writes every queued update. Failed batches are put back at the front of the queue.
+        Returns the number of updates written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                self._flush(batch)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = batch
+                raise
+            return len(batch)
+
+    def close(self):
+        """Stops the flush thread and writes anything still queued"""
+        self._worker.stop()
+        self.flush()
@@ -0,0 +1,330 @@
+'''
+Throughput benchmark for the DatabaseManager queue.
+
+Seeds a schema with fake images, then runs the full claim -> start -> step updates -> finish
+lifecycle from a number of worker threads or processes, reporting images per second, the p50/p99
+latency of each DatabaseManager method, and lock waits sampled from pg_locks.
+
+    python -m database.benchmark --images 5000 --workers 1 8 64
+    python -m database.benchmark --dsn "host=localhost dbname=scratch user=me" --mode process
+
+Without --dsn a throwaway cluster is created with initdb/pg_ctl in a temporary directory.
+The benchmark schema is dropped and rebuilt for every run.
+'''
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+from database.database_manager import DatabaseManager
+
+
+class TemporaryPostgres:
+    """A Postgres cluster in a temporary directory, listening only on a unix socket"""
+
+    def __init__(self, bin_dir=None, max_connections=300):
+        """@param bin_dir           Directory holding initdb and pg_ctl (found on PATH or with pg_config if not given)
+        @param max_connections      max_connections of the cluster
+        Raises RuntimeError if no bin_dir is given and initdb/pg_ctl cannot be found."""
+        self.bin_dir = bin_dir or self._find_bin_dir()
+        self.max_connections = max_connections
+        self.directory = None
+        self.port = None
+
+    @staticmethod
+    def _find_bin_dir():
+        pg_ctl = shutil.which("pg_ctl")
+        if pg_ctl:
+            return os.path.dirname(pg_ctl)
+        try:
+            return subprocess.run(["pg_config", "--bindir"], check=True, capture_output=True, text=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            raise RuntimeError("Cannot find initdb/pg_ctl.")
+
+    def _run(self, program, *args):
+        subprocess.run([os.path.join(self.bin_dir, program), *args], check=True, capture_output=True, text=True)
+
+    def start(self):
+        self.directory = tempfile.mkdtemp(prefix="pipeline-benchmark-")
+        data = os.path.join(self.directory, "data")
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+
+        self._run("initdb", "-D", data, "-U", "postgres", "--auth=trust", "-E", "UTF8")
+        self._run("pg_ctl", "-D", data, "-w", "-l", os.path.join(self.directory, "postgres.log"),
+                  "-o", f"-p {self.port} -k {self.directory} -c listen_addresses='' "
+                        f"-c max_connections={self.max_connections} -c fsync=off",
+                  "start")
+
+        # The pipeline schema is owned by this role
+        connection = psycopg2.connect(**self.db_details)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE ROLE turbogroup;")
+        connection.close()
+        return self
+
+    @property
+    def db_details(self):
+        return {"host": self.directory, "port": self.port, "user": "postgres", "dbname": "postgres"}
+
+    def stop(self):
+        if self.directory is None:
+            return
+        try:
+            self._run("pg_ctl", "-D", os.path.join(self.directory, "data"), "-m", "immediate", "stop")
+        finally:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class BenchmarkImage:
+    """The attributes of a pipeline Image that the DatabaseManager reads and sets"""
+
+    def __init__(self, index=0, db_id=None):
+        self.source_path = f"/benchmark/raw/{index:08d}.fits"
+        self.object_id = f"benchmark_{index:08d}"
+        self.ra = (index * 7.31) % 360
+        self.dec = (index * 3.17) % 170 - 85
+        self.hdr = {"FILTER": "r"}
+        self.hdul = self
+        self.db_id = db_id
+
+    def close(self):
+        pass
+
+
+class LockSampler:
+    """Samples pg_locks from its own connection, counting ungranted locks by relation and mode"""
+
+    def __init__(self, db_details, interval=0.05):
+        self.interval = interval
+        self.samples = 0
+        self.waiting_samples = 0
+        self.max_waiting = 0
+        self.total_waiting = 0
+        self.by_lock = Counter()
+        self._connection = psycopg2.connect(**db_details)
+        self._connection.autocommit = True
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lock-sampler", daemon=True)
+
+    def _run(self):
+        with self._connection.cursor() as cursor:
+            while not self._stopping.wait(self.interval):
+                cursor.execute("""SELECT COALESCE(relation::regclass::text, locktype), mode, COUNT(*)
+                               FROM pg_locks WHERE NOT granted GROUP BY 1, 2;""")
+                rows = cursor.fetchall()
+                waiting = sum(row[2] for row in rows)
+                self.samples += 1
+                self.total_waiting += waiting
+                self.max_waiting = max(self.max_waiting, waiting)
+                if waiting:
+                    self.waiting_samples += 1
+                for relation, mode, count in rows:
+                    self.by_lock[f"{relation} {mode}"] += count
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopping.set()
+        self._thread.join()
+        self._connection.close()
+
+    def report(self):
+        samples = max(self.samples, 1)
+        return {"samples": self.samples,
+                "fraction_waiting": self.waiting_samples / samples,
+                "mean_waiting": self.total_waiting / samples,
+                "max_waiting": self.max_waiting,
+                "top_waits": dict(self.by_lock.most_common(5))}
+
+
+def _timed(latencies, name, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    latencies[name].append(time.perf_counter() - start)
+    return result
+
+
+def process_images(manager, steps, start_at, name):
+    """Claims and processes images until the queue is empty.
+    @return     {method: [latency seconds]} for the calls made"""
+    latencies = defaultdict(list)
+    time.sleep(max(0.0, start_at - time.time()))
+    while True:
+        _, image_id, _ = _timed(latencies, "get_next_image", manager.get_next_image)
+        if image_id == -1:
+            return dict(latencies)
+
+        image = BenchmarkImage(db_id=image_id)
+        _timed(latencies, "start_image", manager.start_image, image, name, datetime.now())
+        for step in range(steps):
+            step_name = f"benchmark step {step}"
+            # The first update starts the step, the second finishes it
+            _timed(latencies, "update_image_status", manager.update_image_status,
+                   image, step_name, f"step{step}", datetime.now(), 0)
+            _timed(latencies, "update_image_status", manager.update_image_status,
+                   image, step_name, f"step{step}", datetime.now(), 0.01)
+        _timed(latencies, "finish_image", manager.finish_image, image, "complete", datetime.now())
+
+
+def _process_worker(db_details, schema, steps, start_at, name):
+    """Entry point of worker processes, each with its own DatabaseManager"""
+    manager = DatabaseManager(db_details, logging.getLogger("benchmark"), schema)
+    try:
+        return process_images(manager, steps, start_at, name)
+    finally:
+        manager.close()
+
+
+def summarize(latencies):
+    """Returns {method: {calls, mean_ms, p50_ms, p99_ms, max_ms}}"""
+    summary = {}
+    for method, values in sorted(latencies.items()):
+        values = np.asarray(values) * 1000
+        summary[method] = {"calls": len(values),
+                           "mean_ms": float(values.mean()),
+                           "p50_ms": float(np.percentile(values, 50)),
+                           "p99_ms": float(np.percentile(values, 99)),
+                           "max_ms": float(values.max())}
+    return summary
+
+
+def reset_schema(db_details, schema):
+    connection = psycopg2.connect(**db_details)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE;")
+    connection.close()
+
+
+def run(db_details, schema, images, workers, mode="thread", steps=3, batch_size=500, claim_order="fifo"):
+    """Seeds images into a fresh schema and processes them with workers threads or processes.
+    @return     Dict of throughput, per-method latencies and lock waits"""
+    logger = logging.getLogger("benchmark")
+    reset_schema(db_details, schema)
+    pool_mode = "thread" if mode == "thread" else None
+    manager = DatabaseManager(db_details, logger, schema, pool_mode=pool_mode, claim_order=claim_order)
+
+    ingest_latencies = defaultdict(list)
+    start = time.perf_counter()
+    for first in range(0, images, batch_size):
+        batch = [BenchmarkImage(index) for index in range(first, min(images, first + batch_size))]
+        _timed(ingest_latencies, "add_images", manager.add_images, batch)
+    ingest_time = time.perf_counter() - start
+
+    latencies = defaultdict(list)
+    start_at = time.time() + 1.0 + 0.02 * workers
+    with LockSampler(db_details) as sampler:
+        if mode == "thread":
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(process_images, manager, steps, start_at, f"thread-{n}") for n in range(workers)]
+                results = [future.result() for future in futures]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_process_worker, db_details, schema, steps, start_at, f"process-{n}")
+                           for n in range(workers)]
+                results = [future.result() for future in futures]
+        # Workers start together at start_at, after connecting
+        process_time = time.time() - start_at
+    manager.close()
+
+    for result in results:
+        for method, values in result.items():
+            latencies[method].extend(values)
+    processed = len(latencies.get("finish_image", []))
+
+    return {"mode": mode,
+            "workers": workers,
+            "images": images,
+            "steps": steps,
+            "ingest_images_per_s": images / ingest_time,
+            "processed": processed,
+            "process_images_per_s": processed / process_time,
+            "latency": summarize({**ingest_latencies, **latencies}),
+            "locks": sampler.report()}
+
+
+def print_report(result):
+    print(f"\n{result['mode']} x {result['workers']}: ingested {result['images']} at {result['ingest_images_per_s']:.0f} images/s, "
+          f"processed {result['processed']} at {result['process_images_per_s']:.1f} images/s ({result['steps']} steps each)")
+    print(f"  {'method':<24}{'calls':>8}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for method, stats in result["latency"].items():
+        print(f"  {method:<24}{stats['calls']:>8}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+    locks = result["locks"]
+    print(f"  lock waits: {100 * locks['fraction_waiting']:.1f}% of {locks['samples']} samples, "
+          f"mean {locks['mean_waiting']:.2f}, max {locks['max_waiting']}")
+    for lock, count in locks["top_waits"].items():
+        print(f"    {lock}: {count}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the DatabaseManager image queue.")
+    parser.add_argument("--dsn", help="libpq connection string of an existing database (default: a throwaway cluster)")
+    parser.add_argument("--pg-bin", help="directory holding initdb and pg_ctl")
+    parser.add_argument("--schema", default="pipeline_benchmark", help="schema to (re)create for the benchmark")
+    parser.add_argument("--images", type=int, default=2000, help="images seeded per run")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8, 64], help="worker counts to run")
+    parser.add_argument("--mode", choices=["thread", "process"], default="thread")
+    parser.add_argument("--steps", type=int, default=3, help="pipeline steps per image")
+    parser.add_argument("--batch-size", type=int, default=500, help="images per add_images call")
+    parser.add_argument("--claim-order", choices=sorted(DatabaseManager.claim_orders), default="fifo")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark schema after the last run")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    cluster = None
+    if args.dsn:
+        db_details = {"dsn": args.dsn}
+    else:
+        try:
+            cluster = TemporaryPostgres(args.pg_bin, max_connections=max(args.workers) * 2 + 20).start()
+        except RuntimeError as e:
+            raise SystemExit(f"{e} Pass --pg-bin or --dsn.")
+        db_details = cluster.db_details
+
+    results = []
+    try:
+        for workers in args.workers:
+            result = run(db_details, args.schema, args.images, workers, args.mode, args.steps,
+                         args.batch_size, args.claim_order)
+            print_report(result)
+            results.append(result)
+        if not args.keep:
+            reset_schema(db_details, args.schema)
+    finally:
+        if cluster is not None:
+            cluster.stop()
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
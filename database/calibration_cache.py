@@ -0,0 +1,57 @@
+'''
+In-memory cache for calibration frame lookups (biases, darks and flats).
+
+Entries expire after a time-to-live so frames added by other processes are picked up, the least
+recently used entries are evicted beyond max_entries, and the DatabaseManager invalidates entries
+when it adds a calibration frame itself.
+'''
+from collections import OrderedDict
+import threading
+import time
+
+
+class CalibrationCache:
+    """A thread-safe LRU cache with a time-to-live, keyed by tuples such as ('bias', camera)"""
+
+    def __init__(self, ttl=300.0, max_entries=256):
+        """@param ttl           Seconds an entry stays valid (0 disables the cache)
+        @param max_entries      Number of entries kept before the least recently used is evicted"""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for a key, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Caches a value, evicting the least recently used entries if the cache is full"""
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *prefix):
+        """Removes every entry whose key starts with prefix (everything if no prefix is given)"""
+        with self._lock:
+            for key in [key for key in self._entries if key[:len(prefix)] == prefix]:
+                del self._entries[key]
+
+    def stats(self):
+        """Returns the number of entries, hits and misses"""
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
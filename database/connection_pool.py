@@ -0,0 +1,241 @@
+'''
+Connection pools used by the DatabaseManager when it is shared between pipeline worker threads.
+
+- BoundedConnectionPool      - at most max_size connections, callers block until one is free
+- ThreadLocalConnectionPool  - one persistent connection per worker thread
+'''
+from contextlib import contextmanager
+import threading
+import time
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class _PoolStats:
+    """Checkout counters shared by the pool implementations"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_checkout = 0.0
+        self.max_checkout = 0.0
+
+    def record_checkout(self, wait_time, checkout_time):
+        with self.lock:
+            self.checkouts += 1
+            if wait_time > 0:
+                self.waits += 1
+            self.total_wait += wait_time
+            self.max_wait = max(self.max_wait, wait_time)
+            self.total_checkout += checkout_time
+            self.max_checkout = max(self.max_checkout, checkout_time)
+
+    def as_dict(self):
+        with self.lock:
+            checkouts = max(self.checkouts, 1)
+            return {"checkouts": self.checkouts,
+                    "waits": self.waits,
+                    "timeouts": self.timeouts,
+                    "connects": self.connects,
+                    "total_wait_s": self.total_wait,
+                    "max_wait_s": self.max_wait,
+                    "mean_checkout_ms": 1000 * self.total_checkout / checkouts,
+                    "max_checkout_ms": 1000 * self.max_checkout}
+
+
+def _usable(connection):
+    """Checks that a returned connection can be handed out again"""
+    return not connection.closed
+
+
+class BoundedConnectionPool:
+    """Hands out at most max_size connections. Callers block for up to timeout seconds
+    when every connection is checked out."""
+
+    def __init__(self, connect, max_size, timeout=30.0):
+        """@param connect   Callable returning a new database connection
+        @param max_size     Maximum number of open connections
+        @param timeout      Seconds to wait for a free connection (None waits forever)"""
+        if max_size < 1:
+            raise ValueError("A connection pool needs at least one connection.")
+        self.mode = "bounded"
+        self.max_size = max_size
+        self.timeout = timeout
+        self._connect = connect
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._stats = _PoolStats()
+
+    def getconn(self):
+        """Checks out a connection, opening a new one if the pool is below max_size"""
+        start = time.monotonic()
+        deadline = None if self.timeout is None else start + self.timeout
+        waited = 0.0
+        with self._condition:
+            while not self._idle and self._size >= self.max_size:
+                if self._closed:
+                    raise PoolExhausted("The connection pool has been closed.")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    with self._stats.lock:
+                        self._stats.timeouts += 1
+                    raise PoolExhausted(f"No database connection available after {self.timeout} s.")
+                wait_start = time.monotonic()
+                self._condition.wait(remaining)
+                waited += time.monotonic() - wait_start
+
+            if self._closed:
+                raise PoolExhausted("The connection pool has been closed.")
+            connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                # Reserve the slot before connecting so other threads respect max_size
+                self._size += 1
+
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+            with self._stats.lock:
+                self._stats.connects += 1
+
+        self._stats.record_checkout(waited, time.monotonic() - start)
+        return connection
+
+    def putconn(self, connection, discard=False):
+        """Returns a connection to the pool. Broken or discarded connections are closed."""
+        with self._condition:
+            if discard or self._closed or not _usable(connection):
+                self._size -= 1
+                if not connection.closed:
+                    connection.close()
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for one unit of work. Commits on success and rolls back on error."""
+        connection = self.getconn()
+        discard = False
+        try:
+            with connection:
+                yield connection
+        except Exception:
+            discard = not _usable(connection)
+            raise
+        finally:
+            self.putconn(connection, discard)
+
+    def close_all(self):
+        """Closes every idle connection and refuses further checkouts"""
+        with self._condition:
+            self._closed = True
+            for connection in self._idle:
+                if not connection.closed:
+                    connection.close()
+            self._size -= len(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+    def stats(self):
+        """Returns the pool size and checkout statistics"""
+        with self._condition:
+            size, idle = self._size, len(self._idle)
+        stats = {"mode": self.mode, "max_size": self.max_size, "size": size,
+                 "idle": idle, "in_use": size - idle}
+        stats.update(self._stats.as_dict())
+        return stats
+
+
+class ThreadLocalConnectionPool:
+    """Keeps one persistent connection per worker thread, opened on first use"""
+
+    def __init__(self, connect):
+        """@param connect   Callable returning a new database connection"""
+        self.mode = "thread"
+        self._connect = connect
+        self._local = threading.local()
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = _PoolStats()
+
+    def _prune(self):
+        """Closes the connections of threads that have exited"""
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in [ident for ident in self._connections if ident not in alive]:
+            connection = self._connections.pop(ident)
+            if not connection.closed:
+                connection.close()
+
+    def getconn(self):
+        """Returns the calling thread's connection, opening it if needed"""
+        start = time.monotonic()
+        if self._closed:
+            raise PoolExhausted("The connection pool has been closed.")
+        connection = getattr(self._local, "connection", None)
+        if connection is None or not _usable(connection):
+            connection = self._connect()
+            self._local.connection = connection
+            with self._lock:
+                self._prune()
+                self._connections[threading.get_ident()] = connection
+            with self._stats.lock:
+                self._stats.connects += 1
+        self._stats.record_checkout(0.0, time.monotonic() - start)
+        return connection
+
+    def putconn(self, connection, discard=False):
+        """Keeps the connection for the thread unless it is broken or discarded"""
+        if discard or not _usable(connection):
+            self._local.connection = None
+            with self._lock:
+                self._connections.pop(threading.get_ident(), None)
+            if not connection.closed:
+                connection.close()
+
+    @contextmanager
+    def connection(self):
+        """Checks out the thread's connection for one unit of work. Commits on success and rolls back on error."""
+        connection = self.getconn()
+        discard = False
+        try:
+            with connection:
+                yield connection
+        except Exception:
+            discard = not _usable(connection)
+            raise
+        finally:
+            self.putconn(connection, discard)
+
+    def close_all(self):
+        """Closes every thread's connection"""
+        with self._lock:
+            self._closed = True
+            for connection in self._connections.values():
+                if not connection.closed:
+                    connection.close()
+            self._connections = {}
+
+    def stats(self):
+        """Returns the number of open connections and checkout statistics"""
+        with self._lock:
+            self._prune()
+            size = len(self._connections)
+        stats = {"mode": self.mode, "max_size": None, "size": size,
+                 "idle": None, "in_use": size}
+        stats.update(self._stats.as_dict())
+        return stats
@@ -1,19 +1,24 @@
 '''
 Provides postgresql commands to set up the Pipeline database from scratch.
 
-- pipeline.images           - the basic science data for the images
+- pipeline.images           - the basic science data for the images, one row per file_path
 - pipeline.image_status     - the pipeline stats for individual images
 - pipeline.processing_time  - the runtime taken by an image at each stage in the pipeline
 - pipeline.status           - the total runtime and number of images at each stage in the pipeline
+- pipeline.status_shards    - per-worker counter deltas not yet rolled up into pipeline.status
+- pipeline.status_totals    - view of pipeline.status including the unrolled shards
+- pipeline.image_status_archive - image_status rows of finished images
+- pipeline.image_status_all - view of image_status and image_status_archive together
+
+The tables are built by numbered migrations. Add schema changes as a new migration at the end of
+pipeline_migrations rather than editing an applied one.
 '''
+from database.migrations import Migration, OptionalStatement, apply_migrations
 
-def create_pipeline_tables(database_connection, schema='pipeline'):
-    """
-    Creates all of the tables for the Pipeline and propagates basic data
-    """
 
-    create_pipeline_schema = f"""
-    CREATE SCHEMA IF NOT EXISTS {schema} AUTHORIZATION turbogroup;
+def pipeline_migrations(schema='pipeline'):
+    """
+    Returns the ordered list of migrations that build the Pipeline schema
     """
 
     create_image_table = f"""
@@ -32,9 +37,9 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     );
     """
 
-    set_image_table_owner = f"""
+    set_image_table_owner = OptionalStatement(f"""
     ALTER TABLE {schema}.images OWNER TO turbogroup;
-    """
+    """)
 
     create_status_table = f"""
     CREATE TABLE IF NOT EXISTS {schema}.image_status (
@@ -61,13 +66,14 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     INSERT INTO {schema}.status(pipeline_step, shortname, total_runtime, n_processed, n_current)
     VALUES
     ('received', 'receiv', 0, 0, 0),
-    ('captured', 'captur', 0, 0, 0)
+    ('captured', 'captur', 0, 0, 0),
+    ('assigned', 'assigned', 0, 0, 0)
     ON CONFLICT DO NOTHING;
     """
 
-    set_image_status_owner = f"""
+    set_image_status_owner = OptionalStatement(f"""
     ALTER TABLE {schema}.image_status OWNER TO turbogroup;
-    """
+    """)
 
     add_log_path_column = f"""
     DO $$ 
@@ -95,9 +101,9 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     );
     """
 
-    set_time_table_owner = f"""
+    set_time_table_owner = OptionalStatement(f"""
     ALTER TABLE {schema}.processing_time OWNER TO turbogroup;
-    """
+    """)
 
     create_pipeline_statistics = f"""
     CREATE TABLE IF NOT EXISTS {schema}.status (
@@ -109,9 +115,9 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     );
     """
 
-    set_status_table_owner = f"""
+    set_status_table_owner = OptionalStatement(f"""
     ALTER TABLE {schema}.status OWNER TO turbogroup;
-    """
+    """)
 
     create_flats_table = f"""
     CREATE TABLE IF NOT EXISTS {schema}.flats (
@@ -126,9 +132,9 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     );
     """
 
-    set_flats_table_owner = f"""
+    set_flats_table_owner = OptionalStatement(f"""
     ALTER TABLE {schema}.flats OWNER TO turbogroup;
-    """
+    """)
 
     create_darks_table = f"""
     CREATE TABLE IF NOT EXISTS {schema}.darks (
@@ -140,9 +146,9 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     );
     """
 
-    set_darks_table_owner = f"""
+    set_darks_table_owner = OptionalStatement(f"""
     ALTER TABLE {schema}.darks OWNER TO turbogroup;
-    """
+    """)
 
     create_biases_table = f"""
     CREATE TABLE IF NOT EXISTS {schema}.biases (
@@ -154,9 +160,9 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     );
     """
 
-    set_biases_table_owner = f"""
+    set_biases_table_owner = OptionalStatement(f"""
     ALTER TABLE {schema}.biases OWNER TO turbogroup;
-    """
+    """)
 
     create_candidates_table = f"""
     CREATE TABLE IF NOT EXISTS {schema}.candidates (
@@ -197,27 +203,143 @@ def create_pipeline_tables(database_connection, schema='pipeline'):
     """
 
 
-    table_commands = [create_pipeline_schema,
-                      create_image_table, set_image_table_owner,
-                      create_pipeline_statistics, set_status_table_owner,
-                      create_status_table, set_image_status_owner, add_log_path_column,
-                      create_time_table, set_time_table_owner,
-                      create_flats_table, set_flats_table_owner,
-                      create_darks_table, set_darks_table_owner,
-                      create_biases_table, set_biases_table_owner,
-                      create_candidates_table, create_scamp_table, add_pipeline_categories]
+    initial_tables = Migration(1, "Initial pipeline tables",
+                               [create_image_table, set_image_table_owner,
+                                create_pipeline_statistics, set_status_table_owner,
+                                create_status_table, set_image_status_owner, add_log_path_column,
+                                create_time_table, set_time_table_owner,
+                                create_flats_table, set_flats_table_owner,
+                                create_darks_table, set_darks_table_owner,
+                                create_biases_table, set_biases_table_owner,
+                                create_candidates_table, create_scamp_table, add_pipeline_categories])
+
+    lookup_indexes = Migration(2, "Indexes for image, queue and calibration lookups", [
+        f"CREATE INDEX IF NOT EXISTS images_file_path_idx ON {schema}.images (file_path);",
+        f"CREATE INDEX IF NOT EXISTS images_object_id_idx ON {schema}.images (object_id);",
+        f"CREATE INDEX IF NOT EXISTS image_status_status_idx ON {schema}.image_status (status);",
+        f"CREATE INDEX IF NOT EXISTS image_status_received_idx ON {schema}.image_status (image_id) WHERE status = 'received';",
+        f"CREATE INDEX IF NOT EXISTS flats_lookup_idx ON {schema}.flats (telescope, filter, date_obs);",
+        f"CREATE INDEX IF NOT EXISTS biases_lookup_idx ON {schema}.biases (camera, date_obs);",
+        f"CREATE INDEX IF NOT EXISTS darks_lookup_idx ON {schema}.darks (camera, date_obs);",
+    ])
 
-    cursor = database_connection.cursor()
-    commands = table_commands
-    # run the table creation commands
-    for command in commands:
-        try:
-            cursor.execute(command)
-        except Exception as e:
-            print(e)
-            print(command)
+    # Unit vector of each image's pointing, so nearest-image searches can use an index
+    spatial_key = Migration(3, "Unit vector columns and spatial index on images", [
+        f"""ALTER TABLE {schema}.images
+        ADD COLUMN IF NOT EXISTS cx DOUBLE PRECISION GENERATED ALWAYS AS (COS(RADIANS(dec)) * COS(RADIANS(ra))) STORED,
+        ADD COLUMN IF NOT EXISTS cy DOUBLE PRECISION GENERATED ALWAYS AS (COS(RADIANS(dec)) * SIN(RADIANS(ra))) STORED,
+        ADD COLUMN IF NOT EXISTS cz DOUBLE PRECISION GENERATED ALWAYS AS (SIN(RADIANS(dec))) STORED;""",
+        f"CREATE INDEX IF NOT EXISTS images_spatial_idx ON {schema}.images (filter, cz) INCLUDE (cx, cy);",
+    ])
 
+    # Per-worker counter rows, so step counters are not a single hot row shared by every worker
+    counter_shards = Migration(4, "Sharded pipeline step counters", [
+        f"""
+        CREATE TABLE IF NOT EXISTS {schema}.status_shards (
+        pipeline_step VARCHAR(255) NOT NULL,
+        shard VARCHAR(128) NOT NULL,
+        n_current INT NOT NULL DEFAULT 0,
+        n_processed INT NOT NULL DEFAULT 0,
+        total_runtime REAL NOT NULL DEFAULT 0,
+
+        PRIMARY KEY(pipeline_step, shard),
+        FOREIGN KEY (pipeline_step)
+            REFERENCES {schema}.status (pipeline_step) ON DELETE CASCADE
+        );
+        """,
+        OptionalStatement(f"ALTER TABLE {schema}.status_shards OWNER TO turbogroup;"),
+        f"""
+        CREATE OR REPLACE VIEW {schema}.status_totals AS
+        SELECT s.pipeline_step, s.shortname,
+            s.total_runtime + COALESCE(SUM(sh.total_runtime), 0) AS total_runtime,
+            (s.n_processed + COALESCE(SUM(sh.n_processed), 0))::INT AS n_processed,
+            (s.n_current + COALESCE(SUM(sh.n_current), 0))::INT AS n_current
+        FROM {schema}.status AS s
+        LEFT JOIN {schema}.status_shards AS sh ON sh.pipeline_step = s.pipeline_step
+        GROUP BY s.pipeline_step;
+        """,
+        OptionalStatement(f"ALTER VIEW {schema}.status_totals OWNER TO turbogroup;"),
+    ])
+
+    # Finished images are moved out of image_status so the live queue only holds in-flight rows
+    status_archive = Migration(5, "Archive table for finished image statuses", [
+        f"""
+        CREATE TABLE IF NOT EXISTS {schema}.image_status_archive (
+        image_id int PRIMARY KEY NOT NULL,
+        file_path VARCHAR(255) NOT NULL,
+        status VARCHAR (128) NOT NULL,
+        processing_start TIMESTAMP,
+        processing_last TIMESTAMP,
+        processing_time REAL,
+        machine_name VARCHAR(128),
+        pipeline_step VARCHAR(255),
+        step_message VARCHAR(255),
+        log_path TEXT,
+        archived_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+        FOREIGN KEY (image_id)
+            REFERENCES {schema}.images (image_id) ON DELETE CASCADE
+        );
+        """,
+        OptionalStatement(f"ALTER TABLE {schema}.image_status_archive OWNER TO turbogroup;"),
+        f"CREATE INDEX IF NOT EXISTS image_status_archive_start_idx ON {schema}.image_status_archive (processing_start);",
+        f"""
+        CREATE OR REPLACE VIEW {schema}.image_status_all AS
+        SELECT image_id, file_path, status, processing_start, processing_last, processing_time,
+            machine_name, pipeline_step, step_message, log_path, NULL::TIMESTAMPTZ AS archived_at
+        FROM {schema}.image_status
+        UNION ALL
+        SELECT image_id, file_path, status, processing_start, processing_last, processing_time,
+            machine_name, pipeline_step, step_message, log_path, archived_at
+        FROM {schema}.image_status_archive;
+        """,
+        OptionalStatement(f"ALTER VIEW {schema}.image_status_all OWNER TO turbogroup;"),
+    ])
+
+    # Priority lanes for the work queue. FIFO claims use image_status_received_idx.
+    queue_priority = Migration(6, "Priority column and priority claim index on image_status", [
+        f"ALTER TABLE {schema}.image_status ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 0;",
+        f"ALTER TABLE {schema}.image_status_archive ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 0;",
+        f"CREATE INDEX IF NOT EXISTS image_status_priority_idx ON {schema}.image_status (priority DESC, image_id) WHERE status = 'received';",
+        f"""
+        CREATE OR REPLACE VIEW {schema}.image_status_all AS
+        SELECT image_id, file_path, status, processing_start, processing_last, processing_time,
+            machine_name, pipeline_step, step_message, log_path, NULL::TIMESTAMPTZ AS archived_at, priority
+        FROM {schema}.image_status
+        UNION ALL
+        SELECT image_id, file_path, status, processing_start, processing_last, processing_time,
+            machine_name, pipeline_step, step_message, log_path, archived_at, priority
+        FROM {schema}.image_status_archive;
+        """,
+    ])
+
+    # Leases on claimed images, so the claims of dead workers can be requeued
+    claim_leases = Migration(7, "Claim leases on image_status", [
+        f"""ALTER TABLE {schema}.image_status
+        ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS step_active BOOLEAN NOT NULL DEFAULT FALSE;""",
+        f"CREATE INDEX IF NOT EXISTS image_status_lease_idx ON {schema}.image_status (lease_expires) WHERE status = 'processing';",
+    ])
+
+    # Lets add_new_image and reconcile_paths upsert on file_path. Fails (and rolls back the whole
+    # upgrade) if images already holds duplicate paths; those have to be merged by hand first.
+    unique_file_path = Migration(8, "Unique file_path on images", [
+        f"CREATE UNIQUE INDEX IF NOT EXISTS images_file_path_key ON {schema}.images (file_path);",
+        f"DROP INDEX IF EXISTS {schema}.images_file_path_idx;",
+    ])
+
+    return [initial_tables, lookup_indexes, spatial_key, counter_shards, status_archive, queue_priority,
+            claim_leases, unique_file_path]
+
+
+def create_pipeline_tables(database_connection, schema='pipeline', logger=None):
+    """
+    Creates or upgrades the tables for the Pipeline. Only migrations newer than the
+    database's schema version are applied, so an up-to-date database costs one query.
+    """
+    create_pipeline_schema = f"""
+    CREATE SCHEMA IF NOT EXISTS {schema} AUTHORIZATION turbogroup;
+    """
 
-    # close the cursor and commit
-    cursor.close()
-    database_connection.commit()
+    return apply_migrations(database_connection, pipeline_migrations(schema), schema,
+                            setup=[create_pipeline_schema], logger=logger)
@@ -1,8 +1,22 @@
 from database.create_pipeline_tables import create_pipeline_tables
+from database.connection_pool import BoundedConnectionPool, ThreadLocalConnectionPool
+from database.background import PeriodicWorker, StatusUpdateBuffer, weak_method
+from database.calibration_cache import CalibrationCache
+from database.export import export_table
+from database.scamp_ingest import parse_scamp_xml
+from database.instrumentation import QueryTracer, trace_methods, untrace_methods
+from database import queries
+from contextlib import contextmanager
+import threading
+import socket
+import os
+import time
+import atexit
 from datetime import datetime
-from astropy.io import votable
 from logging import Logger
 import psycopg2
+import select
+from psycopg2.extras import execute_values
 
 
 class DatabaseError(Exception):
@@ -11,16 +25,54 @@ class DatabaseError(Exception):
 class DatabaseManager:
     """Mediates the database connection for the Pipeline"""
 
-    def __init__(self, db_details, logger: Logger, schema="pipeline"):
-        """Connects to the database and creates the pipeline tables"""
+    # ORDER BY clauses for claiming queued images, each served by a partial index on received rows
+    claim_orders = {"fifo": "ORDER BY image_id",
+                    "priority": "ORDER BY priority DESC, image_id"}
+
+    def __init__(self, db_details, logger: Logger, schema="pipeline",
+                 pool_mode=None, pool_size=8, pool_timeout=30.0, claim_order="fifo", lease_seconds=900):
+        """Connects to the database and creates the pipeline tables.
+
+        By default a single connection is used, which must not be shared between threads.
+        pool_mode="bounded" shares at most pool_size connections between threads (waiting up to
+        pool_timeout seconds for one), and pool_mode="thread" opens one connection per thread.
+        claim_order is "fifo" (oldest image first) or "priority" (highest priority first, then oldest).
+        Claimed images are leased for lease_seconds; see heartbeat and reap_expired_claims."""
+        if claim_order not in self.claim_orders:
+            raise ValueError(f"Unknown claim order: {claim_order}")
+        self.claim_order = claim_order
+        self.lease_seconds = lease_seconds
         self.schema = schema
         self.logger = logger
+        self.db_details = db_details
+        self.connection = None
+        self.pool = None
+        self._background = None
+        self._background_lock = threading.Lock()
+        self._status_buffer = None
+        self._exit_hook = None
+        self._rollup_worker = None
+        self._archive_worker = None
+        self._reaper_worker = None
+        self._known_steps = None
+        self._steps_lock = threading.Lock()
+        self.calibration_cache = CalibrationCache()
+        self.work_channel = f"{schema}_new_image"
+        self._listeners = threading.local()
+        self._listener_connections = []
+        self.tracer = None
+        self._traced_methods = []
 
         try:
-            self.connection = psycopg2.connect(options=f"-c search_path={schema}",**db_details)
-            create_pipeline_tables(self.connection, schema)
-            self.connection.close()
-            self.connection = psycopg2.connect(options=f"-c search_path={schema}",**db_details)
+            if pool_mode == "bounded":
+                self.pool = BoundedConnectionPool(self._connect, pool_size, pool_timeout)
+            elif pool_mode == "thread":
+                self.pool = ThreadLocalConnectionPool(self._connect)
+            elif pool_mode is not None:
+                raise ValueError(f"Unknown pool mode: {pool_mode}")
+
+            with self._connection() as connection:
+                create_pipeline_tables(connection, schema, logger)
         except Exception as e:
             output = f"Failed to Connect to Database.\n{type(e).__name__}: {e.args}"
             self.logger.exception(output)
@@ -28,57 +80,151 @@ class DatabaseManager:
 
     def __del__(self):
         """Closes the database connection"""
-        if self.connection:
+        self.close()
+
+    def _connect(self):
+        """Opens a new connection to the pipeline schema"""
+        return psycopg2.connect(options=f"-c search_path={self.schema}", **self.db_details)
+
+    @contextmanager
+    def _connection(self):
+        """Provides a connection for one unit of work.
+        Pooled connections are committed (or rolled back on error) when they are returned."""
+        if self.pool is not None:
+            with self.pool.connection() as connection:
+                self._trace(connection)
+                yield connection
+            return
+
+        if self.connection is None:
+            self.connection = self._connect()
+        self._trace(self.connection)
+        yield self.connection
+
+    @contextmanager
+    def _background_connection(self):
+        """Provides a connection for background threads, committed (or rolled back on error) when done.
+        Without a pool a separate connection is used so background work never shares the caller's transaction."""
+        if self.pool is not None:
+            with self.pool.connection() as connection:
+                self._trace(connection)
+                yield connection
+            return
+
+        with self._background_lock:
+            if self._background is None or self._background.closed:
+                self._background = self._connect()
+            self._trace(self._background)
+            with self._background as connection:
+                yield connection
+
+    def _trace(self, connection):
+        """Installs the tracing cursor on a connection while tracing is enabled, and removes it otherwise"""
+        factory = self.tracer.cursor_factory if self.tracer is not None else None
+        if connection.cursor_factory is not factory:
+            connection.cursor_factory = factory
+
+    # Methods that are not timed when tracing is enabled
+    untraced_methods = ("close", "wait_for_work", "enable_tracing", "disable_tracing", "tracing_report", "dump_tracing")
+
+    def enable_tracing(self, slow_threshold=0.5, explain=False, analyze=False):
+        """Records wall time, round trips and rows of every public method call in per-method histograms,
+        and logs statements slower than slow_threshold seconds (with their EXPLAIN plan if explain is set).
+        analyze=True uses EXPLAIN ANALYZE for slow SELECTs without side effects, running them again.
+        Returns the QueryTracer."""
+        if self.tracer is None:
+            self.tracer = QueryTracer(slow_threshold, explain, analyze)
+            self._traced_methods = trace_methods(self, self.tracer, exclude=self.untraced_methods)
+        return self.tracer
+
+    def disable_tracing(self):
+        """Removes the tracing wrappers. The collected report is kept on the returned QueryTracer."""
+        tracer, self.tracer = self.tracer, None
+        untrace_methods(self, self._traced_methods)
+        self._traced_methods = []
+        return tracer
+
+    def tracing_report(self):
+        """Returns the per-method latency report, or None if tracing is not enabled"""
+        if self.tracer is None:
+            return None
+        return self.tracer.report()
+
+    def dump_tracing(self, slow_queries=10):
+        """Logs the per-method latency report and the most recent slow queries"""
+        if self.tracer is not None:
+            self.tracer.dump(self.logger, slow_queries)
+
+    def close(self):
+        """Flushes buffered status updates and closes the database connections"""
+        for worker in ("_rollup_worker", "_archive_worker", "_reaper_worker"):
+            if getattr(self, worker, None) is not None:
+                getattr(self, worker).stop()
+                setattr(self, worker, None)
+        if getattr(self, "_status_buffer", None) is not None:
+            self.disable_write_behind()
+        if getattr(self, "_background", None):
+            self._background.close()
+            self._background = None
+        for listener in getattr(self, "_listener_connections", []):
+            if not listener.closed:
+                listener.close()
+        if getattr(self, "pool", None) is not None:
+            self.pool.close_all()
+        if getattr(self, "connection", None):
             self.connection.close()
+            self.connection = None
+
+    def pool_stats(self):
+        """Returns the connection pool size, wait times, and checkout latency, or None if not pooled"""
+        if self.pool is None:
+            return None
+        return self.pool.stats()
 
     def exit_cleanup(self):
         """Zeros n_current. Could perform other cleanup"""
         try:
-            with self.connection.cursor() as cursor:
+            self.flush_status_updates()
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""UPDATE status SET n_current = 0;""")
-                self.connection.commit()
+                cursor.execute("""UPDATE status_shards SET n_current = 0;""")
+                connection.commit()
 
         except Exception as e:
             pass
 
     def get_image_id(self, image):
         """Returns the sequential id for an image in the database, or -1 if the image is not found in the database"""
-        file_path = image.source_path
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"""SELECT image_id FROM images WHERE file_path = '{file_path}';""")
-            value = cursor.fetchone()[0]
-            if value is not None:
-                return value
-            else:
-                return -1
+        with self._connection() as connection, connection.cursor() as cursor:
+            cursor.execute("""SELECT image_id FROM images WHERE file_path = %s;""", (image.source_path,))
+            row = cursor.fetchone()
+            return row[0] if row is not None else -1
 
     def image_in_database(self, image):
         """Check if an image has an entry in the 'images' table"""
-        file_path = image.source_path
-        with self.connection.cursor() as cursor:
-            cursor.execute(f"""SELECT image_id FROM images WHERE file_path = '{file_path}';""")
+        return self.get_image_id(image) != -1
 
-            if cursor.fetchone() is not None:
-                return True
-
-        return False
-
-    def add_image(self, image):
-        """Add an image to the database, creating entries in the 'images' and 'image_status' tables."""
+    @staticmethod
+    def _image_row(image):
+        """Returns the (file_path, object_id, ra, dec, filter) values of an image for the 'images' table"""
         try:
-            try:
-                filter = image.hdr["FILTER"]
-            except Exception:
-                filter = "NONE"
+            filter = image.hdr["FILTER"]
+        except Exception:
+            filter = "NONE"
 
-            ra = image.ra if image.ra else None
-            dec = image.dec if image.dec else None
+        ra = image.ra if image.ra else None
+        dec = image.dec if image.dec else None
+        return (image.source_path, image.object_id, ra, dec, filter)
 
+    def add_image(self, image, priority=0):
+        """Add an image to the database, creating entries in the 'images' and 'image_status' tables.
+        Images with a higher priority are claimed first when the manager uses the "priority" claim order."""
+        try:
             # Insert image into images
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""INSERT INTO images(file_path, object_id, ra, dec, filter)
                                VALUES(%s, %s, %s, %s, %s) RETURNING image_id;""",
-                               (image.source_path, image.object_id, ra, dec, filter))
+                               self._image_row(image))
 
                 # Set the image's database id
                 image_id = cursor.fetchone()[0]
@@ -87,46 +233,162 @@ class DatabaseManager:
                 image.hdul.close()
 
                 # Insert an entry into the status table
-                cursor.execute("""INSERT INTO image_status(image_id, file_path, status, pipeline_step, processing_time)
-                               VALUES(%s, %s, 'received', 'received', 0);""",
-                               (image_id, image.source_path))
+                cursor.execute("""INSERT INTO image_status(image_id, file_path, status, pipeline_step, processing_time, priority)
+                               VALUES(%s, %s, 'received', 'received', 0, %s);""",
+                               (image_id, image.source_path, priority))
 
                 # Update pipeline status table
-                cursor.execute("""UPDATE status SET n_current = n_current + 1
-                                   WHERE pipeline_step = 'received';""")
+                self._update_step_counters(cursor, {"received": (1, 0, 0)})
+
+                # Wake any idle workers once the image is committed
+                self._notify_work(cursor, image_id)
 
-                self.connection.commit()
+                connection.commit()
         except Exception as e:
             self.logger.exception(f"Failed to add the image to the database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to add the image to the database.") from e
         
-    def add_new_image(self, image):
-        """Check if image is in the database, and add it if it isn't.
-        Updates the DB_ID header value if the image is already in the database"""
+    def add_images(self, images, priority=0):
+        """Add many images to the database in one transaction, creating their 'images' and
+        'image_status' entries with multi-row inserts. Sets db_id and DB_ID on every image.
+        Returns the list of image ids, in the order the images were given."""
+        images = list(images)
+        if not images:
+            return []
 
-        if not self.image_in_database(image):
-            self.add_image(image)
-        else:
-            image_id = self.get_image_id(image)
+        try:
+            rows = [self._image_row(image) for image in images]
+
+            with self._connection() as connection, connection.cursor() as cursor:
+                # Reserve the ids up front so they map onto the images without relying on RETURNING order
+                cursor.execute("""SELECT nextval(pg_get_serial_sequence('images', 'image_id'))
+                               FROM generate_series(1, %s);""",
+                               (len(rows),))
+                image_ids = [row[0] for row in cursor.fetchall()]
+
+                execute_values(cursor,
+                               """INSERT INTO images(image_id, file_path, object_id, ra, dec, filter) VALUES %s;""",
+                               [(image_id,) + row for image_id, row in zip(image_ids, rows)],
+                               page_size=1000)
+
+                execute_values(cursor,
+                               """INSERT INTO image_status(image_id, file_path, status, pipeline_step, processing_time, priority)
+                               VALUES %s;""",
+                               [(image_id, row[0], priority) for image_id, row in zip(image_ids, rows)],
+                               template="(%s, %s, 'received', 'received', 0, %s)",
+                               page_size=1000)
+
+                # One counter update for the whole batch
+                self._update_step_counters(cursor, {"received": (len(rows), 0, 0)})
+
+                self._notify_work(cursor, len(rows))
+
+                connection.commit()
+
+            for image, image_id in zip(images, image_ids):
+                image.db_id = image_id
+                image.hdr.update(DB_ID=image_id)
+                image.hdul.close()
+
+            return image_ids
+        except Exception as e:
+            self.logger.exception(f"Failed to add the images to the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to add the images to the database.") from e
+
+    def add_new_image(self, image, priority=0):
+        """Add an image to the database unless its file_path is already there, in one statement.
+        Sets db_id and the DB_ID header value either way. Returns True if the image was added."""
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                # A path inserted concurrently after this statement's snapshot is neither inserted nor
+                # visible to it, so such a conflict is resolved by running the statement again
+                for _ in range(2):
+                    cursor.execute(queries.ADD_NEW_IMAGE,
+                                   self._image_row(image) + (priority, self._counter_shard(), self.work_channel,
+                                                             image.source_path))
+                    row = cursor.fetchone()
+                    if row is not None:
+                        break
+                else:
+                    raise DatabaseError(f"{image.source_path} is neither inserted nor visible.")
+                connection.commit()
+
+            image_id, added = row
             image.db_id = image_id
             image.hdr.update(DB_ID=image_id)
             image.hdul.close()
+            return added
+        except Exception as e:
+            self.logger.exception(f"Failed to add the image to the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to add the image to the database.") from e
 
+    def _insert_missing_images(self, cursor, rows, status):
+        """Inserts the (file_path, object_id, ra, dec, filter, priority) rows whose file_path is not in
+        the images table yet, with an image_status row in status, in one statement.
+        Returns ({file_path: image_id} for every row, number of images inserted)."""
+        columns = [list(column) for column in zip(*rows)]
+        cursor.execute("""WITH input AS (
+                            SELECT * FROM unnest(%s::text[], %s::text[], %s::float8[], %s::float8[], %s::text[], %s::smallint[])
+                                AS t(file_path, object_id, ra, dec, filter, priority)
+                       ), new_images AS (
+                            INSERT INTO images(file_path, object_id, ra, dec, filter)
+                            SELECT file_path, object_id, ra, dec, filter FROM input
+                            ON CONFLICT (file_path) DO NOTHING
+                            RETURNING image_id, file_path
+                       ), queued AS (
+                            INSERT INTO image_status(image_id, file_path, status, pipeline_step, processing_time, priority)
+                            SELECT n.image_id, n.file_path, %s, %s, 0, i.priority
+                            FROM new_images n JOIN input i USING (file_path)
+                       )
+                       SELECT file_path, image_id, TRUE FROM new_images
+                       UNION ALL
+                       SELECT file_path, image_id, FALSE FROM images WHERE file_path = ANY(%s::text[]);""",
+                       columns + [status, status, columns[0]])
+        results = cursor.fetchall()
+        added = sum(1 for row in results if row[2])
+        image_ids = {file_path: image_id for file_path, image_id, _ in results}
+
+        # Paths inserted concurrently after the statement's snapshot are looked up again
+        missing = [file_path for file_path in columns[0] if file_path not in image_ids]
+        if missing:
+            cursor.execute("""SELECT file_path, image_id FROM images WHERE file_path = ANY(%s);""", (missing,))
+            image_ids.update(cursor.fetchall())
+        return image_ids, added
+
+    def reconcile_paths(self, records, priority=0):
+        """Returns {file_path: image_id} for every record, adding the paths that are not in the
+        database yet with one statement. Records are (file_path, object_id, ra, dec, filter) tuples or
+        bare paths, which are added with the file name (without extension) as object_id and filter NONE."""
+        rows = {}
+        for record in records:
+            if isinstance(record, (str, os.PathLike)):
+                record = (str(record), os.path.splitext(os.path.basename(record))[0], None, None, "NONE")
+            rows[str(record[0])] = (str(record[0]),) + tuple(record[1:5]) + (priority,)
+        if not rows:
+            return {}
+
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                image_ids, added = self._insert_missing_images(cursor, list(rows.values()), "received")
+                if added:
+                    self._update_step_counters(cursor, {"received": (added, 0, 0)})
+                    self._notify_work(cursor, added)
+                connection.commit()
+
+            self.logger.info(f"Reconciled {len(rows)} paths: {added} added, {len(rows) - added} already in the database.")
+            return image_ids
+        except Exception as e:
+            self.logger.exception(f"Failed to reconcile image paths with the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to reconcile image paths with the database.") from e
 
     def get_next_image(self):
         """Get the next un-processed image from the 'image_status' table, while setting its status to 'processing'.
         Returns the file path, image_id, and log_path for the image."""
         self.add_pipeline_step('assigned', 'assigned')
 
-        with self.connection.cursor() as cursor:
-            cursor.execute("""UPDATE image_status SET status = 'processing', pipeline_step = 'assigned' 
-                           WHERE file_path = (
-                                SELECT file_path FROM image_status
-                                WHERE status = 'received'
-                                LIMIT 1
-                                FOR UPDATE SKIP LOCKED
-                                )
-                           RETURNING file_path, image_id, log_path;""")
+        with self._connection() as connection, connection.cursor() as cursor:
+            cursor.execute(queries.CLAIM_NEXT_IMAGE.format(order=self.claim_orders[self.claim_order]),
+                           (self.lease_seconds,))
             
 
             next_image = cursor.fetchone()
@@ -140,12 +402,125 @@ class DatabaseManager:
                 next_image_id = -1
                 log_path = None
 
+            # Commit the claim, so the row lock is not held until this connection's next commit
+            connection.commit()
             return next_image_path, next_image_id, log_path
         
+    def get_next_images(self, n, machine_name, start_time=None):
+        """Claim up to n un-processed images in one statement, setting their status to 'processing'
+        and stamping the machine name and start time. Returns a list of (file_path, image_id, log_path)."""
+        if start_time is None:
+            start_time = datetime.now()
+
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(f"""UPDATE image_status
+                               SET status = 'processing', pipeline_step = 'assigned',
+                                   machine_name = %s, processing_start = %s,
+                                   lease_expires = NOW() + %s * INTERVAL '1 second'
+                               WHERE image_id IN (
+                                    SELECT image_id FROM image_status
+                                    WHERE status = 'received'
+                                    {self.claim_orders[self.claim_order]}
+                                    LIMIT %s
+                                    FOR UPDATE SKIP LOCKED
+                                    )
+                               RETURNING file_path, image_id, log_path;""",
+                               (machine_name, start_time, self.lease_seconds, n))
+                claimed = cursor.fetchall()
+                connection.commit()
+            return claimed
+        except Exception as e:
+            self.logger.exception(f"Failed to claim images from the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to claim images from the database.") from e
+
+    def release_images(self, image_ids):
+        """Return claimed images that were never started back to the queue.
+        Returns the number of released images."""
+        image_ids = list(image_ids)
+        if not image_ids:
+            return 0
+
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""UPDATE image_status
+                               SET status = 'received', pipeline_step = 'received',
+                                   machine_name = NULL, processing_start = NULL, lease_expires = NULL
+                               WHERE image_id = ANY(%s) AND status = 'processing' AND pipeline_step = 'assigned';""",
+                               (image_ids,))
+                released = cursor.rowcount
+
+                # Wake any idle workers once the images are back in the queue
+                if released:
+                    self._notify_work(cursor, "released")
+
+                connection.commit()
+            return released
+        except Exception as e:
+            self.logger.exception(f"Failed to release images in the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to release images in the database.") from e
+
+    def _notify_work(self, cursor, payload):
+        """Queues a notification on the work channel. Postgres delivers it when the transaction commits."""
+        cursor.execute("""SELECT pg_notify(%s, %s);""", (self.work_channel, str(payload)))
+
+    def _listener(self):
+        """Returns this thread's autocommit connection listening on the work channel"""
+        listener = getattr(self._listeners, "connection", None)
+        if listener is None or listener.closed:
+            listener = self._connect()
+            listener.autocommit = True
+            with listener.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.work_channel}";')
+            self._listeners.connection = listener
+            with self._background_lock:
+                self._listener_connections.append(listener)
+        return listener
+
+    def wait_for_work(self, timeout=None):
+        """Block until an image is waiting in the queue, or until timeout seconds have passed.
+        Returns True if work may be available, False on timeout. Workers are woken by the
+        notification sent when images are queued as 'received' (add_image, add_images, add_new_image,
+        reconcile_paths), claimed images are released (release_images) or expired claims are requeued."""
+        try:
+            listener = self._listener()
+
+            # Drop notifications for work that has already been claimed, then check for work
+            # added before we started listening
+            listener.poll()
+            listener.notifies.clear()
+            with listener.cursor() as cursor:
+                cursor.execute("""SELECT EXISTS(SELECT 1 FROM image_status WHERE status = 'received');""")
+                if cursor.fetchone()[0]:
+                    return True
+
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if select.select([listener], [], [], remaining) == ([], [], []):
+                    return False
+                listener.poll()
+                if listener.notifies:
+                    listener.notifies.clear()
+                    return True
+        except Exception as e:
+            self.logger.exception(f"Failed to wait for new images.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to wait for new images.") from e
+
+    def get_queue_depth(self):
+        """Returns the number of images waiting in the queue for each priority, as {priority: count}"""
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.QUEUE_DEPTH)
+                return dict(cursor.fetchall())
+        except Exception as e:
+            self.logger.exception(f"Failed to query the queue depth.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to query the queue depth.") from e
+
     def clear_queue(self):
         """Remove any un-processed images from the 'image_status' table.
         Returns the list of removed file paths."""
-        with self.connection.cursor() as cursor:
+        with self._connection() as connection, connection.cursor() as cursor:
             cursor.execute("""DELETE FROM image_status WHERE status = 'received' RETURNING file_path""")
             cleared_files = cursor.fetchall()
             return cleared_files
@@ -154,7 +529,7 @@ class DatabaseManager:
         """Record the image as being processed by the pipeline."""
         self.add_pipeline_step('START OF PIPELINE', 'START')
 
-        with self.connection.cursor() as cursor:
+        with self._connection() as connection, connection.cursor() as cursor:
             if log_path is not None:
                 cursor.execute("""UPDATE image_status
                                SET pipeline_step = %s, processing_start = %s, machine_name = %s, log_path = %s
@@ -165,8 +540,66 @@ class DatabaseManager:
                                SET pipeline_step = %s, processing_start = %s, machine_name = %s
                                WHERE image_id = %s;""",
                                ('START OF PIPELINE', start_time, machine_name, image.db_id))
-            self.connection.commit()
+            connection.commit()
             
+    # Statuses that mark an image as finished and ready to be archived
+    finished_statuses = ("complete", "failed")
+
+    # Columns moved from image_status to image_status_archive
+    archived_columns = ("image_id, file_path, status, processing_start, processing_last, processing_time, "
+                        "machine_name, pipeline_step, step_message, log_path, priority")
+
+    # Images processed again replace their earlier archived row
+    archive_conflict = ("ON CONFLICT (image_id) DO UPDATE SET "
+                        + ", ".join(f"{column} = EXCLUDED.{column}" for column in archived_columns.split(", ")[1:])
+                        + ", archived_at = NOW()")
+
+    def finish_image(self, image, status="complete", end_time=None, step_message=None):
+        """Record that the pipeline has finished with an image, moving its status row from the
+        live queue into the archive. Buffered status updates are written first, so they reach the live row."""
+        try:
+            self.flush_status_updates()
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(f"""WITH finished AS (
+                                    DELETE FROM image_status WHERE image_id = %s
+                                    RETURNING {self.archived_columns}
+                               )
+                               INSERT INTO image_status_archive({self.archived_columns})
+                               SELECT image_id, file_path, %s, processing_start, COALESCE(%s, processing_last),
+                                   processing_time, machine_name, pipeline_step, COALESCE(%s, step_message), log_path,
+                                   priority
+                               FROM finished
+                               {self.archive_conflict};""",
+                               (image.db_id, status, end_time, step_message and step_message[:127]))
+                connection.commit()
+        except Exception as e:
+            self.logger.exception(f"Failed to finish the image in the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to finish the image in the database.") from e
+
+    def archive_finished_images(self):
+        """Move every image whose status is one of finished_statuses from the live queue into the archive.
+        Returns the number of archived images."""
+        try:
+            self.flush_status_updates()
+            with self._background_connection() as connection, connection.cursor() as cursor:
+                cursor.execute(f"""WITH finished AS (
+                                    DELETE FROM image_status WHERE status = ANY(%s)
+                                    RETURNING {self.archived_columns}
+                               )
+                               INSERT INTO image_status_archive({self.archived_columns})
+                               SELECT {self.archived_columns} FROM finished
+                               {self.archive_conflict};""",
+                               (list(self.finished_statuses),))
+                return cursor.rowcount
+        except Exception as e:
+            self.logger.exception(f"Failed to archive finished images.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to archive finished images.") from e
+
+    def start_archiver(self, interval=60.0):
+        """Archive finished images from a background thread every interval seconds"""
+        if self._archive_worker is None:
+            self._archive_worker = PeriodicWorker(interval, weak_method(self.archive_finished_images), self.logger, name="status-archiver")
+
     def start_image_runtime(self, image, timestamp):
         """ ** For use with runtime.py, to be deprecated **
         
@@ -180,10 +613,10 @@ class DatabaseManager:
                 if self.get_step_from_status_table(image.db_id) != "captured":
                     return False
                 # Update image table
-                with self.connection.cursor() as cursor:
+                with self._connection() as connection, connection.cursor() as cursor:
                     cursor.execute("UPDATE images SET file_path = %s, WHERE image_id = %s;",
                                     (image.source_path, image.db_id))
-                    self.connection.commit()
+                    connection.commit()
 
                 # Update status table
                 self.update_image_status(image, "received", "received", timestamp, 0, "Yes")
@@ -197,10 +630,10 @@ class DatabaseManager:
             self.logger.exception(f"Failed to start the image in the pipeline database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to start the image in the pipeline database.") from e
 
-    def add_exposure(self, filename, object_id, ra, dec, filter):
+    def add_exposure(self, filename, object_id, ra, dec, filter, priority=0):
         """Record that an image has been captured by the camera"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 # Insert image into images
                 cursor.execute("""INSERT INTO images(file_path, object_id, ra, dec, filter)
                                 VALUES(%s, %s, %s, %s, %s) RETURNING image_id;""",
@@ -210,21 +643,98 @@ class DatabaseManager:
                 image_id = cursor.fetchone()[0]
 
                 # Insert an entry into the status table
-                cursor.execute("""INSERT INTO image_status(image_id, pipeline_step, processing_time)
-                               VALUES(%s, 'captured', 0);""",
-                               (image_id,))
+                cursor.execute("""INSERT INTO image_status(image_id, file_path, status, pipeline_step, processing_time, priority)
+                               VALUES(%s, %s, 'captured', 'captured', 0, %s);""",
+                               (image_id, filename, priority))
 
-                # Update pipeline status table
-                cursor.execute("""UPDATE status SET n_current = n_current + 1
-                                   WHERE pipeline_step = 'captured';""")
+                # Update pipeline status table. Captured images cannot be claimed yet, so idle workers are not woken.
+                self._update_step_counters(cursor, {"captured": (1, 0, 0)})
 
-                self.connection.commit()
+                connection.commit()
 
             return image_id
         except Exception as e:
             self.logger.exception("Failed to add the image to the database.")
             raise DatabaseError("Failed to start the image in the pipeline database.") from e
 
+    def forward_exposures(self, records):
+        """Record a batch of captured exposures, as (file_path, object_id, ra, dec, filter, priority) tuples,
+        in one transaction. Exposures already recorded (matched on file_path) are left as they are, so a
+        batch can be replayed safely. Returns {file_path: image_id} for every record."""
+        rows = {str(record[0]): (str(record[0]),) + tuple(record[1:6]) for record in records}
+        if not rows:
+            return {}
+
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                image_ids, added = self._insert_missing_images(cursor, list(rows.values()), "captured")
+                # Captured images cannot be claimed yet, so idle workers are not woken
+                if added:
+                    self._update_step_counters(cursor, {"captured": (added, 0, 0)})
+                connection.commit()
+            return image_ids
+        except Exception as e:
+            self.logger.exception(f"Failed to forward exposures to the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to forward exposures to the database.") from e
+
+    def heartbeat(self, image_ids, lease_seconds=None):
+        """Renew the leases on claimed images so the reaper does not requeue them.
+        Takes one image id or a list. Returns the number of leases renewed."""
+        if isinstance(image_ids, int):
+            image_ids = [image_ids]
+        lease_seconds = self.lease_seconds if lease_seconds is None else lease_seconds
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""UPDATE image_status SET lease_expires = NOW() + %s * INTERVAL '1 second'
+                               WHERE image_id = ANY(%s) AND status = 'processing';""",
+                               (lease_seconds, list(image_ids)))
+                renewed = cursor.rowcount
+                connection.commit()
+            return renewed
+        except Exception as e:
+            self.logger.exception(f"Failed to renew the image leases.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to renew the image leases.") from e
+
+    def reap_expired_claims(self):
+        """Return every claimed image whose lease has expired to the queue, and remove the images
+        from the n_current count of any step they were in the middle of, in one transaction.
+        Returns the number of requeued images."""
+        try:
+            with self._background_connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""WITH expired AS (
+                                    SELECT image_id, pipeline_step, step_active FROM image_status
+                                    WHERE status = 'processing' AND lease_expires < NOW()
+                                    FOR UPDATE SKIP LOCKED
+                               ), requeued AS (
+                                    UPDATE image_status AS s
+                                    SET status = 'received', pipeline_step = 'received', machine_name = NULL,
+                                        processing_start = NULL, lease_expires = NULL, step_active = FALSE
+                                    FROM expired AS e
+                                    WHERE s.image_id = e.image_id
+                                    RETURNING e.pipeline_step, e.step_active
+                               )
+                               SELECT pipeline_step, COUNT(*) FILTER (WHERE step_active), COUNT(*)
+                               FROM requeued GROUP BY pipeline_step;""")
+                expired_steps = cursor.fetchall()
+                self._update_step_counters(cursor, {pipeline_step: (-n_active, 0, 0)
+                                                    for pipeline_step, n_active, _ in expired_steps if n_active})
+                if expired_steps:
+                    self._notify_work(cursor, "requeued")
+
+            requeued = sum(n_images for _, _, n_images in expired_steps)
+            if requeued:
+                self.logger.warning(f"Requeued {requeued} images with expired leases.")
+            return requeued
+        except Exception as e:
+            self.logger.exception(f"Failed to requeue expired image claims.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to requeue expired image claims.") from e
+
+    def start_lease_reaper(self, interval=None):
+        """Requeue expired claims from a background thread, by default every half lease period"""
+        if self._reaper_worker is None:
+            interval = self.lease_seconds / 2 if interval is None else interval
+            self._reaper_worker = PeriodicWorker(interval, weak_method(self.reap_expired_claims), self.logger, name="lease-reaper")
+
     def update_image_path(self, image, new_data_path):
         """Not Implemented"""
         return
@@ -232,51 +742,213 @@ class DatabaseManager:
 
     def update_image_status(self, image, pipeline_step, step_shortname, update_time, runtime, step_message="NO MESSAGE"):
         """Updates an image's status in the database including which step it's on and
-        its total processing time. Updates the image status and the pipeline status tables."""
+        its total processing time. Updates the image status and the pipeline status tables.
+        With write-behind enabled the update is queued and written by the flush thread.
+        Updates for images no longer in the live queue (finished and archived) are dropped."""
         try:
             # Trim completion message
             step_message = step_message[:127]
 
-            old_step = self.get_step_from_status_table(image.db_id)
+            if self._status_buffer is not None:
+                self._status_buffer.put((image.db_id, pipeline_step, step_shortname, update_time, runtime, step_message))
+                return
 
             # Add the pipeline step to the status table (if it's new)
             self.add_pipeline_step(pipeline_step, step_shortname)
 
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.LIVE_IMAGE_STEP, (image.db_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    # Archived images have no row to update, and must not move the counters
+                    connection.commit()
+                    self.logger.warning(f"Dropped a status update for image {image.db_id}, which is no longer in the live queue.")
+                    return
+                old_step = row[0]
+
                 # Set the pipeline step & update processing time in the image status table
-                cursor.execute("""UPDATE image_status
-                            SET pipeline_step = %s, processing_last = %s, processing_time = processing_time + %s, step_message = %s
-                            WHERE image_id = %s;""",
-                            (pipeline_step, update_time, runtime, step_message, image.db_id))
+                cursor.execute(queries.UPDATE_IMAGE_STEP,
+                            (pipeline_step, update_time, runtime, step_message,
+                             pipeline_step != old_step, self.lease_seconds, image.db_id))
 
                 # Update number of images in each step and the total processing time
                 # in the pipeline status table
                 if pipeline_step != old_step:
                     # Starting step
-                    cursor.execute("""UPDATE status SET n_current = n_current + 1
-                                   WHERE pipeline_step = %s;""",
-                                   (pipeline_step,))
+                    self._update_step_counters(cursor, {pipeline_step: (1, 0, 0)})
                 else:
                     # Finishing step
-                    cursor.execute("""UPDATE status SET n_current = n_current - 1,
-                                   n_processed = n_processed + 1, total_runtime = total_runtime + %s
-                                   WHERE pipeline_step = %s;""",
-                                   (runtime, pipeline_step))
+                    self._update_step_counters(cursor, {pipeline_step: (-1, 1, runtime)})
 
                     # Record how long the step took
-                    cursor.execute("""INSERT INTO processing_time(image_id, pipeline_step, runtime)
-                                   VALUES(%s, %s, %s) ON CONFLICT DO NOTHING;""",
-                                   (image.db_id, pipeline_step, runtime))
+                    cursor.execute(queries.RECORD_STEP_RUNTIME, (image.db_id, pipeline_step, runtime))
 
-                self.connection.commit()
+                connection.commit()
         except Exception as e:
             self.logger.exception(f"Failed to update the database image status.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to update the database image status.") from e
 
+    def enable_write_behind(self, max_batch=500, max_delay=1.0):
+        """Queue update_image_status calls in memory and write them in batches from a background thread,
+        when max_batch updates are waiting or every max_delay seconds. Queued updates are flushed on close."""
+        if self._status_buffer is not None:
+            return
+        self._status_buffer = StatusUpdateBuffer(self._write_status_updates, self.logger, max_batch, max_delay)
+        # A weak hook, so the manager can still be collected (and flushed by __del__) before exit
+        self._exit_hook = weak_method(self.disable_write_behind)
+        atexit.register(self._exit_hook)
+
+    def disable_write_behind(self):
+        """Flush any queued status updates and return to writing them synchronously"""
+        buffer, self._status_buffer = self._status_buffer, None
+        if buffer is None:
+            return
+        atexit.unregister(self._exit_hook)
+        try:
+            buffer.close()
+        except Exception as e:
+            self.logger.exception(f"Failed to flush the buffered image statuses.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to flush the buffered image statuses.") from e
+
+    def flush_status_updates(self):
+        """Write any queued status updates now. Returns the number of updates written."""
+        if self._status_buffer is None:
+            return 0
+        try:
+            return self._status_buffer.flush()
+        except Exception as e:
+            self.logger.exception(f"Failed to flush the buffered image statuses.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to flush the buffered image statuses.") from e
+
+    def _write_status_updates(self, updates):
+        """Applies a batch of queued (image_id, pipeline_step, shortname, update_time, runtime, message)
+        transitions in one transaction, replaying them in order to derive the step counter deltas."""
+        image_ids = list({update[0] for update in updates})
+
+        with self._background_connection() as connection, connection.cursor() as cursor:
+            known_steps = self._step_registry(cursor)
+            new_steps = {update[1]: (update[1], update[2]) for update in updates if update[1] not in known_steps}
+
+            # Add any new pipeline steps
+            if new_steps:
+                execute_values(cursor,
+                               """INSERT INTO status(pipeline_step, shortname, total_runtime, n_processed, n_current)
+                               VALUES %s ON CONFLICT DO NOTHING;""",
+                               list(new_steps.values()),
+                               template="(%s, %s, 0, 0, 0)")
+
+            cursor.execute("""SELECT image_id, pipeline_step FROM image_status WHERE image_id = ANY(%s);""",
+                           (image_ids,))
+            current_steps = dict(cursor.fetchall())
+
+            # Updates for images already archived have no row to update, and must not move the counters
+            archived = {update[0] for update in updates if update[0] not in current_steps}
+            if archived:
+                self.logger.warning(f"Dropped status updates for {len(archived)} images no longer in the live queue.")
+                updates = [update for update in updates if update[0] not in archived]
+
+            image_rows = {}
+            step_deltas = {}
+            step_times = []
+            for image_id, pipeline_step, _, update_time, runtime, step_message in updates:
+                n_current, n_processed, total_runtime = step_deltas.get(pipeline_step, (0, 0, 0))
+                starting = pipeline_step != current_steps.get(image_id)
+                if starting:
+                    # Starting step
+                    n_current += 1
+                else:
+                    # Finishing step
+                    n_current -= 1
+                    n_processed += 1
+                    total_runtime += runtime
+                    step_times.append((image_id, pipeline_step, runtime))
+                step_deltas[pipeline_step] = (n_current, n_processed, total_runtime)
+                current_steps[image_id] = pipeline_step
+
+                previous_runtime = image_rows[image_id][3] if image_id in image_rows else 0
+                image_rows[image_id] = (image_id, pipeline_step, update_time, previous_runtime + runtime, step_message, starting)
+
+            execute_values(cursor,
+                           f"""UPDATE image_status AS s
+                           SET pipeline_step = v.pipeline_step, processing_last = v.update_time,
+                               processing_time = s.processing_time + v.runtime, step_message = v.step_message,
+                               step_active = v.step_active, lease_expires = NOW() + {float(self.lease_seconds)} * INTERVAL '1 second'
+                           FROM (VALUES %s) AS v(image_id, pipeline_step, update_time, runtime, step_message, step_active)
+                           WHERE s.image_id = v.image_id;""",
+                           list(image_rows.values()),
+                           template="(%s::int, %s, %s::timestamp, %s::real, %s, %s::boolean)",
+                           page_size=1000)
+
+            self._update_step_counters(cursor, step_deltas)
+
+            if step_times:
+                execute_values(cursor,
+                               """INSERT INTO processing_time(image_id, pipeline_step, runtime)
+                               VALUES %s ON CONFLICT DO NOTHING;""",
+                               step_times,
+                               page_size=1000)
+
+        self._register_steps(new_steps)
+
+    def _counter_shard(self):
+        """Returns the name of the calling worker thread's counter shard"""
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"[:128]
+
+    def _update_step_counters(self, cursor, step_deltas):
+        """Applies {pipeline_step: (n_current, n_processed, total_runtime)} deltas to the calling
+        thread's rows in status_shards. Each worker thread writes its own rows, so workers never
+        wait on each other's counter updates. Read the totals from the status_totals view."""
+        if not step_deltas:
+            return
+        shard = self._counter_shard()
+        execute_values(cursor,
+                       queries.UPDATE_STEP_COUNTERS.format(rows="VALUES %s"),
+                       sorted((step, shard) + tuple(deltas) for step, deltas in step_deltas.items()),
+                       template=queries.STEP_COUNTER_ROW)
+
+    def rollup_step_counters(self):
+        """Folds the counter shards into the status table and removes them.
+        Returns the number of shard rows folded."""
+        try:
+            with self._background_connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""WITH drained AS (
+                                    DELETE FROM status_shards RETURNING *
+                               ), totals AS (
+                                    SELECT pipeline_step, SUM(n_current) AS n_current, SUM(n_processed) AS n_processed,
+                                        SUM(total_runtime) AS total_runtime, COUNT(*) AS n_shards
+                                    FROM drained GROUP BY pipeline_step
+                               ), folded AS (
+                                    UPDATE status AS s
+                                    SET n_current = s.n_current + t.n_current, n_processed = s.n_processed + t.n_processed,
+                                        total_runtime = s.total_runtime + t.total_runtime
+                                    FROM totals AS t WHERE s.pipeline_step = t.pipeline_step
+                               )
+                               SELECT COALESCE(SUM(n_shards), 0) FROM totals;""")
+                return cursor.fetchone()[0]
+        except Exception as e:
+            self.logger.exception(f"Failed to roll up the pipeline counters.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to roll up the pipeline counters.") from e
+
+    def start_counter_rollup(self, interval=60.0):
+        """Roll up the counter shards from a background thread every interval seconds"""
+        if self._rollup_worker is None:
+            self._rollup_worker = PeriodicWorker(interval, weak_method(self.rollup_step_counters), self.logger, name="counter-rollup")
+
+    def get_pipeline_status(self):
+        """Returns (pipeline_step, shortname, total_runtime, n_processed, n_current) for every step,
+        including counts not yet rolled up into the status table"""
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.PIPELINE_STATUS)
+                return cursor.fetchall()
+        except Exception as e:
+            self.logger.exception(f"Failed to query the pipeline status.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to query the pipeline status.") from e
+
     def get_objectId_from_image_table(self, image_id):
         """Query object_id from the image table for an image"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""SELECT object_id FROM images WHERE image_id = %s;""",
                                (image_id,))
                 value = cursor.fetchone()[0]
@@ -286,22 +958,71 @@ class DatabaseManager:
             self.logger.warning(f"Failed to query the database image table.", exc_info=True)
             return None
 
+    def get_image_ids(self, object_ids):
+        """Query the image_id of each object_id in the image table, as {object_id: image_id}.
+        The most recently added image is used when an object_id appears more than once."""
+        object_ids = list(object_ids)
+        if not object_ids:
+            return {}
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""SELECT DISTINCT ON (object_id) object_id, image_id FROM images
+                               WHERE object_id = ANY(%s) ORDER BY object_id, image_id DESC;""",
+                               (object_ids,))
+                return dict(cursor.fetchall())
+        except Exception as e:
+            self.logger.warning(f"Failed to query the database image table.", exc_info=True)
+            return {}
+
     def get_step_from_status_table(self, image_id):
         """Query the pipeline_step from the image status table for an image"""
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute("SELECT pipeline_step FROM image_status WHERE image_id = %s",
-                               (image_id,))
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.IMAGE_STEP, (image_id,))
                 value = cursor.fetchone()[0]
             return value
         except Exception as e:
             self.logger.warning(f"Failed to query the database image status table.", exc_info=True)
             return None
 
+    def get_image_status(self, image_id):
+        """Returns an image's status row as a dict, whether it is in the live queue or the archive,
+        or None if the image has no status"""
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.IMAGE_STATUS, (image_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                return dict(zip([column[0] for column in cursor.description], row))
+        except Exception as e:
+            self.logger.warning(f"Failed to query the database image status table.", exc_info=True)
+            return None
+
+    def get_status_history(self, since=None, until=None, status=None, machine_name=None, limit=1000):
+        """Returns status rows (as dicts) from the live queue and the archive, newest first,
+        optionally limited to a processing_start range, a status, or a machine"""
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""SELECT * FROM image_status_all
+                               WHERE (%(since)s::TIMESTAMP IS NULL OR processing_start >= %(since)s)
+                               AND (%(until)s::TIMESTAMP IS NULL OR processing_start < %(until)s)
+                               AND (%(status)s::VARCHAR IS NULL OR status = %(status)s)
+                               AND (%(machine)s::VARCHAR IS NULL OR machine_name = %(machine)s)
+                               ORDER BY processing_start DESC NULLS LAST, image_id DESC
+                               LIMIT %(limit)s;""",
+                               {"since": since, "until": until, "status": status,
+                                "machine": machine_name, "limit": limit})
+                columns = [column[0] for column in cursor.description]
+                return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            self.logger.exception(f"Failed to query the image status history.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to query the image status history.") from e
+
     def get_step_from_pipeline_status_table(self, pipeline_step):
         """Query a pipeline_step from the pipeline status table"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""SELECT pipeline_step FROM status WHERE pipeline_step = %s;""",
                             (pipeline_step,))
                 value = cursor.fetchone()
@@ -312,20 +1033,49 @@ class DatabaseManager:
             self.logger.warning(f"Failed to query the database pipeline status table.", exc_info=True)
             return None
 
+    def _step_registry(self, cursor=None):
+        """Returns the set of pipeline steps known to be in the database, loading it on first use.
+        Background threads pass their own cursor so the caller's connection is never used."""
+        with self._steps_lock:
+            if self._known_steps is None:
+                if cursor is not None:
+                    cursor.execute(queries.PIPELINE_STEPS)
+                    self._known_steps = {row[0] for row in cursor.fetchall()}
+                else:
+                    with self._connection() as connection, connection.cursor() as cursor:
+                        cursor.execute(queries.PIPELINE_STEPS)
+                        self._known_steps = {row[0] for row in cursor.fetchall()}
+            return self._known_steps
+
+    def _register_steps(self, pipeline_steps):
+        """Records pipeline steps that have been added to the database"""
+        with self._steps_lock:
+            if self._known_steps is not None:
+                self._known_steps.update(pipeline_steps)
+
+    def invalidate_step_registry(self):
+        """Forget the cached pipeline steps, e.g. after steps were removed from the database.
+        The registry is reloaded on the next step check."""
+        with self._steps_lock:
+            self._known_steps = None
+
     def pipeline_step_in_database(self, pipeline_step):
-        """Checks if a step is in the database."""
-        return self.get_step_from_pipeline_status_table(pipeline_step) is not None
+        """Checks if a step is in the database. Uses the cached step registry."""
+        try:
+            return pipeline_step in self._step_registry()
+        except Exception as e:
+            self.logger.warning(f"Failed to query the database pipeline status table.", exc_info=True)
+            return False
 
     def add_pipeline_step(self, pipeline_step, shortname):
         """Adds a new pipeline step to the database"""
         if (self.pipeline_step_in_database(pipeline_step)):
             return
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute("""INSERT INTO status(pipeline_step, shortname, total_runtime, n_processed, n_current)
-                               VALUES (%s, %s, 0, 0, 0) ON CONFLICT DO NOTHING;""",
-                               (pipeline_step,shortname))
-                self.connection.commit()
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.ADD_PIPELINE_STEP, (pipeline_step, shortname))
+                connection.commit()
+            self._register_steps([pipeline_step])
         except Exception as e:
             self.logger.error(f"Failed to add a pipeline step to the database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to add a pipeline step to the database.") from e
@@ -333,35 +1083,86 @@ class DatabaseManager:
     def assign_reference(self, db_id, reference_path, reference_distance):
         """Updates an image with a reference path and a reference distance."""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""UPDATE images
                                SET reference_path = %s, reference_distance = %s
                                WHERE image_id = %s;""",
-                               reference_path, reference_distance, db_id)
-                self.connection.commit()
+                               (reference_path, reference_distance, db_id))
+                connection.commit()
         except Exception as e:
             self.logger.exception(f"Failed to assign a reference in the database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to assign a reference in the database.") from e
 
+    def assign_references(self, assignments):
+        """Assigns references to many images with one bulk update.
+        Takes (image_id, reference_image_id, reference_distance) tuples; the reference path is
+        copied from the reference image's row. An image is never made its own reference.
+        Returns the number of images updated."""
+        assignments = list(assignments)
+        if not assignments:
+            return 0
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                execute_values(cursor,
+                               """UPDATE images AS i
+                               SET reference_path = r.file_path, reference_distance = v.reference_distance
+                               FROM (VALUES %s) AS v(image_id, reference_id, reference_distance)
+                               JOIN images AS r ON r.image_id = v.reference_id
+                               WHERE i.image_id = v.image_id AND v.reference_id <> v.image_id;""",
+                               assignments,
+                               template="(%s::int, %s::int, %s::real)",
+                               page_size=len(assignments))
+                updated = cursor.rowcount
+                connection.commit()
+            return updated
+        except Exception as e:
+            self.logger.exception(f"Failed to assign references in the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to assign references in the database.") from e
+
+    def get_image_positions(self, filter, after_image_id=0, unassigned_only=False):
+        """Returns (image_id, cx, cy, cz) unit vectors for the images with both coordinates in a filter,
+        optionally only those newer than after_image_id or without a reference"""
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""SELECT image_id, cx, cy, cz FROM images
+                               WHERE filter = %s AND image_id > %s
+                               AND cx IS NOT NULL AND cy IS NOT NULL AND cz IS NOT NULL
+                               AND (NOT %s OR reference_path IS NULL)
+                               ORDER BY image_id;""",
+                               (filter, after_image_id, unassigned_only))
+                return cursor.fetchall()
+        except Exception as e:
+            self.logger.exception(f"Failed to query image positions.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to query image positions.") from e
+
+    def get_unassigned_filters(self):
+        """Returns the filters that have images with both coordinates but no reference"""
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""SELECT DISTINCT filter FROM images
+                               WHERE reference_path IS NULL
+                               AND cx IS NOT NULL AND cy IS NOT NULL AND cz IS NOT NULL;""")
+                return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            self.logger.exception(f"Failed to query image filters.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to query image filters.") from e
+
+    # Cone radii (degrees) searched in turn by retrieve_closest_image
+    closest_image_radii = (0.5, 2.0, 8.0, 32.0, 180.0)
+
     def retrieve_closest_image(self, image_id, ra, dec, filter="NONE"):
-        """Retrieves the closest image in the database by its RA and DEC coordinate"""
-        select_sql = """
-        SELECT ra, dec, file_path,
-            DEGREES( ACOS(  GREATEST(-1, LEAST(1, SIN( RADIANS(%s)) * SIN( RADIANS(dec)) +
-                            COS( RADIANS(%s)) * COS( RADIANS(dec)) * COS(RADIANS(%s - ra)))))
-                            )
-            AS angular_distance,
-            object_id
-        FROM images
-        WHERE ra IS NOT NULL AND dec IS NOT NULL AND filter = %s
-        ORDER BY angular_distance;
-        """
+        """Retrieves the closest image in the database by its RA and DEC coordinate.
 
+        Searches cones of increasing radius around the position using the indexed unit vector
+        columns. The closest image inside a cone is the closest overall, so the result is exact."""
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute(select_sql, (dec, dec, ra, filter))
-                result = cursor.fetchone()
-                return result
+            with self._connection() as connection, connection.cursor() as cursor:
+                for params in queries.closest_image_cones(ra, dec, filter, self.closest_image_radii):
+                    cursor.execute(queries.CLOSEST_IMAGE, params)
+                    result = cursor.fetchone()
+                    if result is not None:
+                        return result
+                return None
         except Exception as e:
             self.logger.exception(f"Failed to find a close image pair in the database. {image_id}, {ra}, {dec}\n{type(e).__name__}: {e.args}")
             return None
@@ -374,7 +1175,7 @@ class DatabaseManager:
         """Updates the nsources value for an image"""
 
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""UPDATE images SET nsources = %s WHERE image_id = %s;""",
                                (nsources, db_id))
                 return True
@@ -383,40 +1184,125 @@ class DatabaseManager:
             raise DatabaseError("Failed to update nsources in the database.") from e
         
     def log_scamp(self, image, scamp_xml, dist_path=None, fgroup_path=None, referr1d_path=None, referr2d_path=None):
-        """Adds contents of a SCAMP output VOTable file to the database"""
-        table = votable.parse(scamp_xml)
-        date_proc = table.get_field_by_id_or_name('Date').value + ' ' + table.get_field_by_id_or_name('Time').value
-
-        dist_path = ("'"+str(dist_path)+"'") if dist_path else "NULL"
-        fgroup_path = ("'"+str(fgroup_path)+"'") if fgroup_path else "NULL"
-        referr1d_path = ("'"+str(referr1d_path)+"'") if referr1d_path else "NULL"
-        referr2d_path = ("'"+str(referr2d_path)+"'") if referr2d_path else "NULL"
-
-
-        stats = table.get_table_by_id('Fields')
-        obj_id = stats.array["Image_Ident"][0]
-        ra = stats.array["Field_Coordinates"][0][0] / 15
-        dec = stats.array["Field_Coordinates"][0][1]
-        ref_off = stats.array["AstromOffset_Reference"][0]
-        astrom_offset_ref = f'{{{ref_off[0]},{ref_off[1]}}}'
-        ref_sigma = stats.array["AstromSigma_Reference"][0]
-        astrom_sigma_ref = f'{{{ref_sigma[0]},{ref_sigma[1]}}}'
-        ref_corr = stats.array["AstromCorr_Reference"][0]
-        ref_chi2 = stats.array["Chi2_Reference"][0]
-
-        try:
-            with self.connection.cursor() as cursor:
-                cursor.execute(f"""INSERT INTO scamp_results(image_id, object_id, ra, dec, date_proc, astrom_offset_ref, astrom_sigma_ref, astrom_corr_ref, astrom_chi_ref, dist_map_path, fgroup_map_path, referr_1d_path, referr_2d_path)
-                               VALUES({image.db_id}, '{obj_id}', {ra}, {dec}, '{date_proc}', '{astrom_offset_ref}', '{astrom_sigma_ref}', {ref_corr}, {ref_chi2}, {dist_path}, {fgroup_path}, {referr1d_path}, {referr2d_path});""")
-                return True
+        """Adds contents of a SCAMP output VOTable file to the database.
+        Returns False, leaving the stored row unchanged, if the image already has a result with the same date_proc."""
+        row = parse_scamp_xml(scamp_xml)[0]
+        paths = tuple(str(path) if path else None for path in (dist_path, fgroup_path, referr1d_path, referr2d_path))
+        if self.add_scamp_results([(image.db_id,) + row + paths]) > 0:
+            return True
+        self.logger.warning(f"SCAMP result for image {image.db_id} processed at {row[3]} is already in the database; not replaced.")
+        return False
+
+    # Columns of scamp_results in the order add_scamp_results takes them
+    scamp_columns = ("image_id", "object_id", "ra", "dec", "date_proc", "astrom_offset_ref", "astrom_sigma_ref",
+                     "astrom_corr_ref", "astrom_chi_ref", "dist_map_path", "fgroup_map_path", "referr_1d_path",
+                     "referr_2d_path")
+
+    def add_scamp_results(self, rows, page_size=1000):
+        """Insert SCAMP result rows (tuples in scamp_columns order) in one transaction.
+        Rows whose (image_id, date_proc) is already recorded are skipped. Returns the number inserted."""
+        if not rows:
+            return 0
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                inserted = execute_values(cursor,
+                                          f"""INSERT INTO scamp_results({", ".join(self.scamp_columns)}) VALUES %s
+                                          ON CONFLICT (image_id, date_proc) DO NOTHING RETURNING 1;""",
+                                          rows,
+                                          template="(%s, %s, %s, %s, %s, %s::real[], %s::real[], %s, %s, %s, %s, %s, %s)",
+                                          page_size=page_size,
+                                          fetch=True)
+                connection.commit()
+            return len(inserted)
         except Exception as e:
             self.logger.exception(f"Failed to add scamp results to the database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to add scamp results to the database.") from e
 
+    # Columns written by add_candidates, in the order tuples records are given
+    candidate_columns = ("ra", "dec", "ra_cand", "dec_cand", "mag_cand", "dmag_cand", "real_bogus",
+                         "sci_cutout_path", "ref_cutout_path", "sub_cutout_path", "date_obs", "object_id")
+
+    def _candidate_rows(self, records):
+        """Converts a numpy structured array, a list of dicts, or a list of tuples in candidate_columns
+        order to tuples of python values. Missing columns are NULL."""
+        if hasattr(records, "dtype") and records.dtype.names:
+            columns = []
+            for name in self.candidate_columns:
+                if name not in records.dtype.names:
+                    columns.append([None] * len(records))
+                    continue
+                column = records[name]
+                if column.dtype.kind == "M":
+                    # tolist() only returns datetimes down to microsecond precision
+                    column = column.astype("datetime64[us]")
+                elif column.dtype.kind == "S":
+                    column = column.astype(str)
+                columns.append(column.tolist())
+            return list(zip(*columns))
+
+        rows = []
+        for record in records:
+            if isinstance(record, dict):
+                record = tuple(record.get(name) for name in self.candidate_columns)
+            elif len(record) != len(self.candidate_columns):
+                raise ValueError(f"Candidate records need the columns {self.candidate_columns}")
+            rows.append(tuple(value.item() if hasattr(value, "item") else value for value in record))
+        return rows
+
+    def add_candidates(self, image_id, records):
+        """Add the candidates found in a difference image with one multi-row statement.
+        Takes a numpy structured array or a list of dicts/tuples with the candidate_columns.
+        Candidates already recorded for the image (same object_id) are updated.
+        Returns the number of candidates written."""
+        try:
+            # Keep the last record for each object_id, as one statement cannot update a row twice
+            rows = {row[-1]: (image_id,) + row for row in self._candidate_rows(records)}
+            if not rows:
+                return 0
+
+            columns = ", ".join(self.candidate_columns)
+            updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in self.candidate_columns[:-1])
+            with self._connection() as connection, connection.cursor() as cursor:
+                execute_values(cursor,
+                               f"""INSERT INTO candidates(image_id, {columns}) VALUES %s
+                               ON CONFLICT (image_id, object_id) DO UPDATE SET {updates};""",
+                               list(rows.values()),
+                               page_size=len(rows))
+                connection.commit()
+            return len(rows)
+        except Exception as e:
+            self.logger.exception(f"Failed to add candidates to the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to add candidates to the database.") from e
+
+    def update_real_bogus(self, image_id, scores):
+        """Write classifier scores for an image's candidates with one statement.
+        Takes a {object_id: score} mapping or (object_id, score) pairs. Returns the number of candidates updated."""
+        if hasattr(scores, "items"):
+            scores = scores.items()
+        rows = [(str(object_id), float(score)) for object_id, score in scores]
+        if not rows:
+            return 0
+
+        try:
+            with self._connection() as connection, connection.cursor() as cursor:
+                execute_values(cursor,
+                               f"""UPDATE candidates AS c SET real_bogus = v.real_bogus
+                               FROM (VALUES %s) AS v(object_id, real_bogus)
+                               WHERE c.image_id = {int(image_id)} AND c.object_id = v.object_id;""",
+                               rows,
+                               template="(%s, %s::real)",
+                               page_size=len(rows))
+                updated = cursor.rowcount
+                connection.commit()
+            return updated
+        except Exception as e:
+            self.logger.exception(f"Failed to update real/bogus scores in the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError("Failed to update real/bogus scores in the database.") from e
+
     def image_found(self, object_id):
         """Checks if an image has been seen before based on its object_id"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""SELECT file_path, object_id FROM images WHERE object_id = %s;""",
                                 (object_id,))
                 result = cursor.fetchone()
@@ -428,7 +1314,7 @@ class DatabaseManager:
     def flat_found(self, object_id):
         """Checks if a flat has been seen before based on its object_id"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""SELECT file_path, object_id FROM flats WHERE object_id = %s;""",
                                 (object_id,))
                 result = cursor.fetchone()
@@ -440,7 +1326,7 @@ class DatabaseManager:
     def bias_found(self, object_id):
         """Checks if a bias has been seen before based on its object_id"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""SELECT file_path, object_id FROM biases WHERE object_id = %s;""",
                                 (object_id,))
                 result = cursor.fetchone()
@@ -452,7 +1338,7 @@ class DatabaseManager:
     def dark_found(self, object_id):
         """Checks if a dark has been seen before based on its object_id"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""SELECT file_path, object_id FROM darks WHERE object_id = %s;""",
                                 (object_id,))
                 result = cursor.fetchone()
@@ -464,13 +1350,14 @@ class DatabaseManager:
     def add_flat(self, path, telescope, filter, date, type):
         """Adds the flat to the flats table"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 object_id = f"flat_{telescope}_{filter}_{date}_{type}"
                 cursor.execute("""INSERT INTO flats(file_path, object_id, telescope, filter, type, date_obs, downloaded)
                                VALUES(%s, %s, %s, %s, %s, %s, %s);""",
                                (path, object_id, telescope, filter, type, date, "false"))
 
-                self.connection.commit()
+                connection.commit()
+            self.calibration_cache.invalidate("flat", telescope, filter)
         except Exception as e:
             self.logger.exception(f"Failed to add the flat to the database.", exc_info=True)
             raise DatabaseError("Failed to add the flat to the database.") from e
@@ -479,7 +1366,7 @@ class DatabaseManager:
         """Mark the flat as downloaded. Updates the path if the flat exists in the
         database already. Otherwise, inserts a new entry."""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 object_id = f"flat_{telescope}_{filter}_{date}_{type}"
                 cursor.execute("""SELECT COUNT(1)
                                 FROM flats
@@ -495,7 +1382,8 @@ class DatabaseManager:
                                 VALUES(%s, %s, %s, %s, %s, %s, %s);""",
                                 (path, object_id, telescope, filter, type, date, "true"))
 
-                self.connection.commit()
+                connection.commit()
+            self.calibration_cache.invalidate("flat", telescope, filter)
         except Exception as e:
             self.logger.exception(f"Failed to mark the flat as downloaded in the database.", exc_info=True)
             raise DatabaseError("Failed to mark the flat as downloaded in the database.") from e
@@ -503,19 +1391,27 @@ class DatabaseManager:
     def get_flat(self, telescopeName, filter, date: datetime):
         """Returns the filepath and timestamp of closest flat by time.
             Only looks at flats from the same telescope and filter
+
+        The flats taken that observing night (noon to noon), and the nearest flats before and after it,
+        are cached per (telescope, filter, night), so later frames from the same night need no query.
+        Lookups that find no flats are not cached.
         """
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute("""SELECT file_path, date_obs
-                                FROM flats
-                                WHERE downloaded=TRUE AND telescope=%s AND filter=%s
-                                ORDER BY ABS(EXTRACT(EPOCH FROM AGE(date_obs, %s::TIMESTAMPTZ))) asc
-                                LIMIT 1;""",
-                                (telescopeName, filter, date.strftime("%Y-%m-%d %H:%M:%S %Z")))
-                if cursor.rowcount == 0:
-                    return None, None
-                filepath, timestamp = cursor.fetchone()
-                return filepath, timestamp
+            key = ("flat", telescopeName, filter, queries.observing_night(date))
+            candidates = self.calibration_cache.get(key)
+
+            if candidates is None:
+                night_start, night_end = queries.night_bounds(date)
+                with self._connection() as connection, connection.cursor() as cursor:
+                    cursor.execute(queries.FLATS_FOR_NIGHT,
+                                   {"telescope": telescopeName, "filter": filter,
+                                    "start": night_start, "end": night_end})
+                    candidates = cursor.fetchall()
+                # No flats yet: ask again next time rather than missing one added by another process
+                if candidates:
+                    self.calibration_cache.put(key, candidates)
+
+            return queries.closest_in_time(candidates, date)
         except Exception as e:
             self.logger.exception(f"Failed to find flat in database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to find flat in database.") from e
@@ -526,7 +1422,7 @@ class DatabaseManager:
             return False
         try:
             bias_datetime =  datetime.strptime(bias.date_obs, '%Y-%m-%d %H:%M:%S.%f')
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""INSERT INTO biases(file_path, object_id, camera, date_obs)
                                VALUES(%s, %s, %s, %s) RETURNING image_id;""",
                                (bias.source_path, bias.object_id, bias.hdr["CAMERA"], bias_datetime))
@@ -534,7 +1430,8 @@ class DatabaseManager:
                 bias_id = cursor.fetchone()[0]
                 bias.db_id = bias_id
 
-                self.connection.commit()
+                connection.commit()
+            self.calibration_cache.invalidate("bias", bias.hdr["CAMERA"])
             return True
         except Exception as e:
             self.logger.exception(f"Failed to add the bias to the database.\n{type(e).__name__}: {e.args}")
@@ -542,14 +1439,17 @@ class DatabaseManager:
 
     def get_bias(self, camera_id):
         """Returns the filepath of the most time recent bias .fits file
-        based on the unique camera id"""
+        based on the unique camera id. Cached until a new bias is added or the cache expires."""
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute("""SELECT file_path FROM biases
-                               WHERE camera=%s ORDER BY date_obs desc;""",
-                               (camera_id,))
+            bias_filepath = self.calibration_cache.get(("bias", camera_id))
+            if bias_filepath is not None:
+                return bias_filepath
+
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.LATEST_BIAS, (camera_id,))
                 bias_filepath = cursor.fetchone()[0]
-                self.connection.commit()
+                connection.commit()
+            self.calibration_cache.put(("bias", camera_id), bias_filepath)
             return bias_filepath
         except Exception as e:
             self.logger.exception(f"Failed to find bias in database.\n{type(e).__name__}: {e.args}")
@@ -561,7 +1461,7 @@ class DatabaseManager:
             return False
         try:
             dark_datetime =  datetime.strptime(dark.date_obs, '%Y-%m-%d %H:%M:%S.%f')
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute("""INSERT INTO darks(file_path, object_id, camera, date_obs)
                                VALUES(%s, %s, %s, %s) RETURNING image_id;""",
                                (dark.source_path, dark.object_id, dark.hdr["CAMERA"], dark_datetime))
@@ -570,35 +1470,58 @@ class DatabaseManager:
                 dark_id = cursor.fetchone()[0]
                 dark.db_id = dark_id
 
-                self.connection.commit()
+                connection.commit()
+            self.calibration_cache.invalidate("dark", dark.hdr["CAMERA"])
             return True
         except Exception as e:
             self.logger.exception(f"Failed to add the dark to the database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to add the dark to the database.") from e
 
     def get_dark(self, camera_id):
-        """Returns the filepath of the most time recent dark .fits file based on the unique camera id"""
+        """Returns the filepath of the most time recent dark .fits file based on the unique camera id.
+        Cached until a new dark is added or the cache expires."""
         try:
-            with self.connection.cursor() as cursor:
-                cursor.execute("""SELECT file_path FROM darks WHERE camera=%s
-                               ORDER BY date_obs desc;""",
-                               (camera_id,))
+            dark_filepath = self.calibration_cache.get(("dark", camera_id))
+            if dark_filepath is not None:
+                return dark_filepath
+
+            with self._connection() as connection, connection.cursor() as cursor:
+                cursor.execute(queries.LATEST_DARK, (camera_id,))
                 dark_filepath = cursor.fetchone()[0]
 
-                self.connection.commit()
+                connection.commit()
+            self.calibration_cache.put(("dark", camera_id), dark_filepath)
             return dark_filepath
         except Exception as e:
             self.logger.exception(f"Failed to find dark in database.\n{type(e).__name__}: {e.args}")
             raise DatabaseError("Failed to find dark in database.") from e
 
+    def export_table(self, table, output, format="parquet", chunk_rows=50000,
+                     columns=None, start=None, end=None, where=None):
+        """Stream a pipeline table to Parquet or NPY files with bounded memory, optionally limited to a
+        time range and {column: value} predicates. Uses its own read-only connection so a long export
+        does not hold a pooled connection or the worker's transaction. See database.export."""
+        try:
+            connection = self._connect()
+            try:
+                connection.set_session(readonly=True)
+                return export_table(connection, table, output, format, chunk_rows, columns, start, end, where)
+            finally:
+                connection.close()
+        except ValueError:
+            raise
+        except Exception as e:
+            self.logger.exception(f"Failed to export {table} from the database.\n{type(e).__name__}: {e.args}")
+            raise DatabaseError(f"Failed to export {table} from the database.") from e
+
     def _delete_databse(self):
         """Removes the current Pipeline schema - PERMANENTLY
 
         THIS IS NOT REVERSIBLE!"""
         try:
-            with self.connection.cursor() as cursor:
+            with self._connection() as connection, connection.cursor() as cursor:
                 cursor.execute(f"DROP SCHEMA {self.schema} CASCADE;")
-                self.connection.commit()
+                connection.commit()
         except Exception as e:
             self.logger.error(f"Failed to delete the database schema.\n{type(e).__name__}: {e.args}")
             return False
@@ -0,0 +1,208 @@
+'''
+Streaming export of pipeline tables to columnar files.
+
+Rows are read through a server-side (named) cursor chunk_rows at a time, so client memory is
+bounded by the chunk size rather than the table size.
+
+- parquet   - a single file with one row group per chunk (requires pyarrow)
+- npy       - a directory of numbered structured-array files, one per chunk, each with a
+              structured boolean file (<name>_null.npy) marking the NULL fields
+'''
+from datetime import timezone
+from pathlib import Path
+import numpy as np
+from psycopg2 import sql
+
+# Exportable tables and the column used for time-range predicates (None if there is none)
+EXPORT_TABLES = {
+    "images": None,
+    "image_status_all": "processing_start",
+    "processing_time": None,
+    "candidates": "date_obs",
+    "scamp_results": "date_proc",
+    "flats": "date_obs",
+    "biases": "date_obs",
+    "darks": "date_obs",
+}
+
+# Postgres type oids and the numpy dtype used for their columns
+_NUMPY_TYPES = {
+    16: "?",                    # boolean
+    20: "i8", 21: "i2", 23: "i4",
+    700: "f4", 701: "f8",
+    1114: "datetime64[us]",     # timestamp
+    1184: "datetime64[us]",     # timestamptz, exported as UTC
+}
+_FLOAT_ARRAY_TYPES = {1021: "f4", 1022: "f8"}
+
+
+def _select_query(table, columns=None, start=None, end=None, where=None):
+    """Builds the SELECT statement and parameters for an export"""
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Table {table} cannot be exported. Choose from {sorted(EXPORT_TABLES)}.")
+
+    fields = sql.SQL("*") if columns is None else sql.SQL(", ").join(map(sql.Identifier, columns))
+    conditions = []
+    params = []
+
+    if start is not None or end is not None:
+        time_column = EXPORT_TABLES[table]
+        if time_column is None:
+            raise ValueError(f"Table {table} has no time column to filter on.")
+        if start is not None:
+            conditions.append(sql.SQL("{} >= %s").format(sql.Identifier(time_column)))
+            params.append(start)
+        if end is not None:
+            conditions.append(sql.SQL("{} < %s").format(sql.Identifier(time_column)))
+            params.append(end)
+
+    for column, value in (where or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            conditions.append(sql.SQL("{} = ANY(%s)").format(sql.Identifier(column)))
+            params.append(list(value))
+        else:
+            conditions.append(sql.SQL("{} = %s").format(sql.Identifier(column)))
+            params.append(value)
+
+    query = sql.SQL("SELECT {} FROM {}").format(fields, sql.Identifier(table))
+    if conditions:
+        query = sql.SQL("{} WHERE {}").format(query, sql.SQL(" AND ").join(conditions))
+    return query, params
+
+
+def _utc_naive(value):
+    """Converts an aware datetime to naive UTC, which numpy and arrow store without ambiguity"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _numpy_dtypes(description):
+    """Fixes the numpy dtype of every column from the result's column types, once per export.
+
+    Columns of types without a numpy equivalent are exported as strings, and float arrays as 2d
+    columns; their width depends on the chunk, but their dtype kind does not."""
+    return [_NUMPY_TYPES.get(column.type_code, _FLOAT_ARRAY_TYPES.get(column.type_code, "U"))
+            for column in description]
+
+
+def _numpy_column(values, type_code, dtype):
+    """Converts one column of a chunk to a numpy array, writing a neutral value for NULLs"""
+    if type_code in _FLOAT_ARRAY_TYPES:
+        width = max((len(value) for value in values if value is not None), default=0)
+        array = np.full((len(values), width), np.nan, dtype=dtype)
+        for row, value in enumerate(values):
+            if value is not None:
+                array[row, :len(value)] = value
+        return array
+
+    if dtype.startswith("datetime"):
+        return np.array([np.datetime64("NaT") if value is None else _utc_naive(value) for value in values],
+                        dtype=dtype)
+    if dtype == "U":
+        return np.array(["" if value is None else str(value) for value in values], dtype=str)
+    fill = np.nan if dtype[0] == "f" else 0
+    return np.array([fill if value is None else value for value in values], dtype=dtype)
+
+
+def _structured_chunk(rows, description, dtypes):
+    """Converts a chunk of rows to a numpy structured array and the matching structured NULL mask"""
+    columns = list(zip(*rows))
+    arrays = [_numpy_column(values, column.type_code, dtype)
+              for values, column, dtype in zip(columns, description, dtypes)]
+    chunk = np.empty(len(rows), dtype=[(column.name, array.dtype, array.shape[1:])
+                                       for column, array in zip(description, arrays)])
+    mask = np.empty(len(rows), dtype=[(column.name, "?") for column in description])
+    for values, column, array in zip(columns, description, arrays):
+        chunk[column.name] = array
+        mask[column.name] = [value is None for value in values]
+    return chunk, mask
+
+
+def _arrow_schema(description, pyarrow):
+    """Builds the arrow schema of an export from the column types"""
+    types = {16: pyarrow.bool_(), 20: pyarrow.int64(), 21: pyarrow.int16(), 23: pyarrow.int32(),
+             700: pyarrow.float32(), 701: pyarrow.float64(),
+             1114: pyarrow.timestamp("us"), 1184: pyarrow.timestamp("us", tz="UTC"),
+             1021: pyarrow.list_(pyarrow.float32()), 1022: pyarrow.list_(pyarrow.float64())}
+    return pyarrow.schema([(column.name, types.get(column.type_code, pyarrow.string())) for column in description])
+
+
+def _arrow_chunk(rows, description, pyarrow, schema):
+    """Converts a chunk of rows to an arrow table"""
+    data = {}
+    for values, column in zip(zip(*rows), description):
+        if column.type_code == 1184:
+            values = [_utc_naive(value) for value in values]
+        elif column.type_code not in _NUMPY_TYPES and column.type_code not in _FLOAT_ARRAY_TYPES:
+            values = [None if value is None else str(value) for value in values]
+        data[column.name] = list(values)
+    return pyarrow.Table.from_pydict(data, schema=schema)
+
+
+def export_table(connection, table, output, format="parquet", chunk_rows=50000,
+                 columns=None, start=None, end=None, where=None):
+    """Streams a table to columnar files.
+
+    @param connection   An open psycopg2 connection. Its transaction is rolled back when done.
+    @param table        One of EXPORT_TABLES
+    @param output       The parquet file, or the directory for npy chunks
+    @param format       "parquet" or "npy"
+    @param chunk_rows   Rows fetched and written at a time
+    @param columns      Columns to export (all by default)
+    @param start        Only rows at or after this time (tables with a time column)
+    @param end          Only rows before this time
+    @param where        {column: value} equality predicates; list values match any element
+    @return             Dict with the number of rows, the files written and, for npy, the NULL masks
+    """
+    if format not in ("parquet", "npy"):
+        raise ValueError(f"Unknown export format: {format}")
+    if format == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+
+    query, params = _select_query(table, columns, start, end, where)
+    output = Path(output)
+    files = []
+    masks = []
+    n_rows = 0
+    writer = None
+    schema = None
+    dtypes = None
+
+    try:
+        with connection.cursor(name=f"export_{table}") as cursor:
+            cursor.itersize = chunk_rows
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+
+                if format == "parquet":
+                    if writer is None:
+                        schema = _arrow_schema(cursor.description, pyarrow)
+                        output.parent.mkdir(parents=True, exist_ok=True)
+                        writer = pyarrow.parquet.ParquetWriter(output, schema)
+                        files.append(output)
+                    writer.write_table(_arrow_chunk(rows, cursor.description, pyarrow, schema))
+                else:
+                    if dtypes is None:
+                        dtypes = _numpy_dtypes(cursor.description)
+                        output.mkdir(parents=True, exist_ok=True)
+                    chunk, mask = _structured_chunk(rows, cursor.description, dtypes)
+                    path = output / f"{table}_{len(files):05d}.npy"
+                    np.save(path, chunk, allow_pickle=False)
+                    np.save(path.with_name(f"{path.stem}_null.npy"), mask, allow_pickle=False)
+                    files.append(path)
+                    masks.append(path.with_name(f"{path.stem}_null.npy"))
+                n_rows += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+        connection.rollback()
+
+    result = {"rows": n_rows, "files": files}
+    if format == "npy":
+        result["masks"] = masks
+    return result
@@ -0,0 +1,157 @@
+'''
+Store-and-forward exposure log for the telescope control computer.
+
+- LocalExposureLog  - a local SQLite (WAL) file that records captured exposures without touching the network
+- ExposureForwarder - a background thread that replays the log to the pipeline database in batches
+
+Exposures are keyed on file_path, so a batch that was committed in Postgres but not marked as
+forwarded locally (e.g. the connection dropped before the reply) is simply replayed.
+'''
+from logging import Logger
+import sqlite3
+import threading
+import time
+
+from database.background import PeriodicWorker
+
+
+class LocalExposureLog:
+    """Records exposures in a local SQLite database and remembers the image_id each one was given"""
+
+    def __init__(self, path):
+        """@param path  The SQLite file, created if it does not exist"""
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL;")
+        # WAL with synchronous=NORMAL survives a crash of the process without an fsync on every commit
+        self._connection.execute("PRAGMA synchronous=NORMAL;")
+        self._connection.execute("""
+        CREATE TABLE IF NOT EXISTS exposures (
+        local_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_path TEXT NOT NULL UNIQUE,
+        object_id TEXT NOT NULL,
+        ra REAL,
+        dec REAL,
+        filter TEXT NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 0,
+        captured_at REAL NOT NULL,
+        image_id INTEGER,
+        forwarded_at REAL
+        );
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS exposures_pending_idx ON exposures (local_id) WHERE image_id IS NULL;")
+
+    def add_exposure(self, filename, object_id, ra, dec, filter, priority=0):
+        """Record that an image has been captured by the camera. Returns its local id.
+        Recording the same file again returns the id it was first given."""
+        with self._lock:
+            self._connection.execute("""INSERT OR IGNORE INTO exposures(file_path, object_id, ra, dec, filter, priority, captured_at)
+                                     VALUES(?, ?, ?, ?, ?, ?, ?);""",
+                                     (str(filename), object_id, ra, dec, filter, priority, time.time()))
+            return self._connection.execute("SELECT local_id FROM exposures WHERE file_path = ?;",
+                                            (str(filename),)).fetchone()[0]
+
+    def pending(self, limit=500):
+        """Returns up to limit exposures not yet forwarded, oldest first, as
+        (file_path, object_id, ra, dec, filter, priority) tuples"""
+        with self._lock:
+            return self._connection.execute("""SELECT file_path, object_id, ra, dec, filter, priority FROM exposures
+                                            WHERE image_id IS NULL ORDER BY local_id LIMIT ?;""",
+                                            (limit,)).fetchall()
+
+    def mark_forwarded(self, image_ids):
+        """Stores the {file_path: image_id} mapping returned by the pipeline database"""
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN;")
+            try:
+                self._connection.executemany("UPDATE exposures SET image_id = ?, forwarded_at = ? WHERE file_path = ?;",
+                                             [(image_id, now, file_path) for file_path, image_id in image_ids.items()])
+                self._connection.execute("COMMIT;")
+            except Exception:
+                self._connection.execute("ROLLBACK;")
+                raise
+
+    def image_id(self, local_id):
+        """Returns the pipeline image_id of an exposure, or None if it has not been forwarded yet"""
+        with self._lock:
+            row = self._connection.execute("SELECT image_id FROM exposures WHERE local_id = ?;", (local_id,)).fetchone()
+        return row[0] if row else None
+
+    def backlog(self):
+        """Returns the number of exposures waiting to be forwarded"""
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM exposures WHERE image_id IS NULL;").fetchone()[0]
+
+    def prune(self, older_than):
+        """Deletes forwarded exposures captured more than older_than seconds ago. Returns the number deleted."""
+        with self._lock:
+            return self._connection.execute("DELETE FROM exposures WHERE image_id IS NOT NULL AND captured_at < ?;",
+                                            (time.time() - older_than,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ExposureForwarder:
+    """Forwards a LocalExposureLog to the pipeline database from a background thread.
+    The database is only ever contacted from that thread, so a slow or unreachable database
+    delays forwarding but never the caller of add_exposure."""
+
+    def __init__(self, exposure_log, manager_factory, logger: Logger, interval=1.0, batch_size=500):
+        """@param exposure_log      The LocalExposureLog to forward
+        @param manager_factory      Callable returning a DatabaseManager. Called again after a failure.
+        @param logger               Logger for forwarding failures
+        @param interval             Seconds between forwarding attempts
+        @param batch_size           Exposures sent per transaction"""
+        self.exposure_log = exposure_log
+        self.manager_factory = manager_factory
+        self.logger = logger
+        self.batch_size = batch_size
+        self._manager = None
+        self._worker = PeriodicWorker(interval, self.forward, logger, name="exposure-forwarder")
+
+    def add_exposure(self, filename, object_id, ra, dec, filter, priority=0):
+        """Records an exposure locally and wakes the forwarder. Returns its local id."""
+        local_id = self.exposure_log.add_exposure(filename, object_id, ra, dec, filter, priority)
+        self._worker.wake()
+        return local_id
+
+    def image_id(self, local_id):
+        """Returns the pipeline image_id of an exposure, or None if it has not been forwarded yet"""
+        return self.exposure_log.image_id(local_id)
+
+    def forward(self):
+        """Sends every pending exposure to the pipeline database. Returns the number forwarded.
+        On failure the manager is dropped and the remaining exposures are retried on the next call."""
+        forwarded = 0
+        try:
+            if self._manager is None:
+                self._manager = self.manager_factory()
+            while True:
+                batch = self.exposure_log.pending(self.batch_size)
+                if not batch:
+                    break
+                image_ids = self._manager.forward_exposures(batch)
+                self.exposure_log.mark_forwarded(image_ids)
+                forwarded += len(image_ids)
+                if len(batch) < self.batch_size or len(image_ids) < len(batch):
+                    break
+        except Exception as e:
+            self.logger.warning(f"Failed to forward exposures; {self.exposure_log.backlog()} waiting.\n"
+                                f"{type(e).__name__}: {e.args}")
+            manager, self._manager = self._manager, None
+            if manager is not None:
+                manager.close()
+        return forwarded
+
+    def stop(self, flush=True):
+        """Stops the forwarding thread, making a last attempt to forward pending exposures if flush is set"""
+        self._worker.stop()
+        if flush:
+            self.forward()
+        if self._manager is not None:
+            self._manager.close()
+            self._manager = None
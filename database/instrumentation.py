@@ -0,0 +1,265 @@
+'''
+Opt-in latency tracing for the DatabaseManager.
+
+- QueryTracer   - per-method histograms of wall time, round trips and rows, and a log of
+                  statements slower than a threshold with their EXPLAIN plans
+- trace_methods - wraps the public methods of an object so their calls are recorded
+
+Statements are timed by a cursor class installed as the cursor_factory of traced connections.
+'''
+from collections import deque
+import bisect
+import functools
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+# Upper edges (ms) of the latency histogram buckets. The last bucket holds everything slower.
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_EXPLAINABLE = ("select", "insert", "update", "delete", "with")
+
+# Clauses and functions that make a SELECT change something when it is run again by EXPLAIN ANALYZE.
+# Rollback does not undo sequence advances, notifications or locks on other rows.
+_SIDE_EFFECTS = re.compile(r"\bfor\s+(no\s+key\s+update|update|key\s+share|share)\b|\binto\b"
+                           r"|\b(nextval|setval|pg_notify|pg_advisory_\w*|pg_try_advisory_\w*|lo_\w+)\s*\(",
+                           re.IGNORECASE)
+
+
+def _safe_to_analyze(statement):
+    """Whether running a statement again changes nothing: a SELECT without locking clauses or side-effecting calls"""
+    return statement.lstrip().lower().startswith("select") and _SIDE_EFFECTS.search(statement) is None
+
+
+class _MethodStats:
+    """Histogram and totals for one traced method"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.round_trips = 0
+        self.rows = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, elapsed, round_trips, rows, failed):
+        self.calls += 1
+        self.errors += failed
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.round_trips += round_trips
+        self.rows += rows
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed * 1000)] += 1
+
+    def percentile(self, fraction):
+        """Estimates a latency percentile (ms) as the upper edge of the bucket that contains it"""
+        rank = fraction * self.calls
+        seen = 0
+        for edge, count in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return edge
+        return 1000 * self.max_time
+
+    def as_dict(self):
+        calls = max(self.calls, 1)
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "mean_ms": 1000 * self.total_time / calls,
+                "p50_ms": self.percentile(0.5),
+                "p90_ms": self.percentile(0.9),
+                "p99_ms": self.percentile(0.99),
+                "max_ms": 1000 * self.max_time,
+                "round_trips_per_call": self.round_trips / calls,
+                "rows_per_call": self.rows / calls,
+                "histogram": dict(zip([f"<={edge}ms" for edge in LATENCY_BUCKETS_MS] + ["slower"], self.buckets))}
+
+
+class _Frame:
+    """Counters for a traced method call in progress"""
+
+    __slots__ = ("round_trips", "rows")
+
+    def __init__(self):
+        self.round_trips = 0
+        self.rows = 0
+
+
+class QueryTracer:
+    """Collects per-method latency histograms and a slow-query log"""
+
+    def __init__(self, slow_threshold=0.5, explain=False, analyze=False, max_slow_queries=200):
+        """@param slow_threshold    Statements taking longer than this many seconds are logged (None disables the log)
+        @param explain              Capture the EXPLAIN plan of slow statements
+        @param analyze              Use EXPLAIN ANALYZE for SELECT statements without side effects, which runs
+                                    them again. Other statements get a plain EXPLAIN plan.
+        @param max_slow_queries     Number of slow statements kept (oldest are dropped)"""
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        self.analyze = analyze
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self._methods = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.cursor_factory = self._make_cursor_factory()
+
+    def _frames(self):
+        frames = getattr(self._local, "frames", None)
+        if frames is None:
+            frames = self._local.frames = []
+        return frames
+
+    def _current_method(self):
+        methods = getattr(self._local, "methods", None)
+        return methods[-1] if methods else None
+
+    def wrap(self, function, name):
+        """Returns a wrapper of function that records its calls under name"""
+        tracer = self
+
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            frames = tracer._frames()
+            frame = _Frame()
+            frames.append(frame)
+            methods = getattr(tracer._local, "methods", None)
+            if methods is None:
+                methods = tracer._local.methods = []
+            methods.append(name)
+            failed = False
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                frames.pop()
+                methods.pop()
+                with tracer._lock:
+                    stats = tracer._methods.setdefault(name, _MethodStats())
+                    stats.record(elapsed, frame.round_trips, frame.rows, failed)
+
+        traced.__wrapped_by_tracer__ = True
+        return traced
+
+    def record_statement(self, cursor, query, vars, elapsed):
+        """Counts a statement against every traced call in progress and logs it if it was slow"""
+        rows = max(cursor.rowcount, 0)
+        for frame in self._frames():
+            frame.round_trips += 1
+            frame.rows += rows
+
+        if self.slow_threshold is None or elapsed < self.slow_threshold:
+            return
+        try:
+            statement = cursor.mogrify(query, vars).decode(errors="replace")
+        except Exception:
+            statement = str(query)
+        entry = {"method": self._current_method(),
+                 "duration_ms": 1000 * elapsed,
+                 "rows": rows,
+                 "sql": statement,
+                 "plan": None,
+                 "time": time.time()}
+        if self.explain and cursor.name is None:
+            entry["plan"] = self._explain(cursor.connection, statement)
+        with self._lock:
+            self.slow_queries.append(entry)
+
+    def _explain(self, connection, statement):
+        """Returns the plan of a statement, run inside a savepoint that is always rolled back.
+        Only SELECTs without side effects are analyzed, since ANALYZE executes the statement."""
+        if not statement.lstrip().lower().startswith(_EXPLAINABLE):
+            return None
+        if connection.autocommit or connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+            return None
+
+        options = "ANALYZE, BUFFERS" if self.analyze and _safe_to_analyze(statement) else "COSTS"
+        with connection.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+            cursor.execute("SAVEPOINT query_tracer_explain;")
+            try:
+                cursor.execute(f"EXPLAIN ({options}) {statement.rstrip().rstrip(';')}")
+                return "\n".join(row[0] for row in cursor.fetchall())
+            except Exception as e:
+                return f"EXPLAIN failed: {type(e).__name__}: {e}"
+            finally:
+                cursor.execute("ROLLBACK TO SAVEPOINT query_tracer_explain;")
+                cursor.execute("RELEASE SAVEPOINT query_tracer_explain;")
+
+    def _make_cursor_factory(self):
+        """Builds a cursor class that reports every statement to this tracer"""
+        tracer = self
+
+        class TracingCursor(psycopg2.extensions.cursor):
+            def execute(self, query, vars=None):
+                start = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    tracer.record_statement(self, query, vars, time.perf_counter() - start)
+
+            def executemany(self, query, vars_list):
+                start = time.perf_counter()
+                try:
+                    return super().executemany(query, vars_list)
+                finally:
+                    tracer.record_statement(self, query, None, time.perf_counter() - start)
+
+        return TracingCursor
+
+    def report(self):
+        """Returns {method: stats} for every traced method, most total time first"""
+        with self._lock:
+            stats = {name: method.as_dict() for name, method in self._methods.items()}
+        return dict(sorted(stats.items(), key=lambda item: item[1]["mean_ms"] * item[1]["calls"], reverse=True))
+
+    def dump(self, logger, slow_queries=10):
+        """Logs the method report and the most recent slow statements"""
+        lines = [f"{'method':<34}{'calls':>8}{'mean ms':>10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>10}{'trips':>7}{'rows':>9}"]
+        for name, stats in self.report().items():
+            lines.append(f"{name:<34}{stats['calls']:>8}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>9.2f}"
+                         f"{stats['p99_ms']:>9.2f}{stats['max_ms']:>10.2f}{stats['round_trips_per_call']:>7.1f}"
+                         f"{stats['rows_per_call']:>9.1f}")
+        logger.info("Database method latencies:\n" + "\n".join(lines))
+
+        with self._lock:
+            recent = list(self.slow_queries)[-slow_queries:] if slow_queries else []
+        for entry in recent:
+            message = f"Slow query in {entry['method']} ({entry['duration_ms']:.1f} ms, {entry['rows']} rows):\n{entry['sql']}"
+            if entry["plan"]:
+                message += f"\n{entry['plan']}"
+            logger.info(message)
+
+    def reset(self):
+        """Clears the histograms and the slow-query log"""
+        with self._lock:
+            self._methods.clear()
+            self.slow_queries.clear()
+
+
+def trace_methods(obj, tracer, names=None, exclude=()):
+    """Wraps the public methods of obj (or the given names) on the instance so their calls are
+    recorded by tracer. Returns the names of the wrapped methods."""
+    if names is None:
+        names = [name for name in dir(type(obj))
+                 if not name.startswith("_") and name not in exclude and callable(getattr(type(obj), name))]
+    wrapped = []
+    for name in names:
+        method = getattr(obj, name)
+        if getattr(method, "__wrapped_by_tracer__", False):
+            continue
+        setattr(obj, name, tracer.wrap(method, name))
+        wrapped.append(name)
+    return wrapped
+
+
+def untrace_methods(obj, names):
+    """Removes wrappers installed by trace_methods"""
+    for name in names:
+        obj.__dict__.pop(name, None)
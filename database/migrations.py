@@ -0,0 +1,96 @@
+'''
+Versioned schema migrations for the Pipeline database.
+
+Applied migrations are recorded in {schema}.schema_version, so starting up against an
+up-to-date database is a single version check.
+'''
+from collections import namedtuple
+import logging
+
+import psycopg2
+
+Migration = namedtuple("Migration", ["version", "description", "statements"])
+Migration.__doc__ = """A numbered set of statements applied together.
+A failing statement aborts the whole upgrade unless it is an OptionalStatement."""
+
+
+class OptionalStatement(str):
+    """A migration statement whose failure is logged and skipped rather than aborting the upgrade,
+    e.g. handing a table to a role that may not exist"""
+
+
+def schema_version(database_connection, schema='pipeline'):
+    """Returns the latest applied migration version, or 0 for a database without a version table"""
+    cursor = database_connection.cursor()
+    try:
+        cursor.execute(f"SELECT COALESCE(MAX(version), 0) FROM {schema}.schema_version;")
+        return cursor.fetchone()[0]
+    except (psycopg2.errors.UndefinedTable, psycopg2.errors.InvalidSchemaName):
+        database_connection.rollback()
+        return 0
+    finally:
+        cursor.close()
+
+
+def apply_migrations(database_connection, migrations, schema='pipeline', setup=(), logger=None):
+    """Applies every migration newer than the database's schema version, in one transaction.
+
+    @param database_connection  An open psycopg2 connection
+    @param migrations           List of Migrations, ordered by version
+    @param schema               The schema holding the schema_version table
+    @param setup                Statements run before the version table is created (e.g. CREATE SCHEMA)
+    @param logger               Logger for progress and skipped statements
+    @return                     The schema version after upgrading
+    """
+    logger = logger or logging.getLogger(__name__)
+    latest = migrations[-1].version if migrations else 0
+
+    version = schema_version(database_connection, schema)
+    if version >= latest:
+        database_connection.commit()
+        return version
+
+    cursor = database_connection.cursor()
+    try:
+        # Serialize upgrades between processes starting at the same time
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (f"{schema}.schema_version",))
+        for command in setup:
+            cursor.execute(command)
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.schema_version (
+        version INT PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """)
+        # Another process may have upgraded while we waited for the lock
+        cursor.execute(f"SELECT COALESCE(MAX(version), 0) FROM {schema}.schema_version;")
+        version = cursor.fetchone()[0]
+
+        for migration in migrations:
+            if migration.version <= version:
+                continue
+            logger.info(f"Applying pipeline schema migration {migration.version}: {migration.description}")
+            for command in migration.statements:
+                if not isinstance(command, OptionalStatement):
+                    cursor.execute(command)
+                    continue
+                cursor.execute("SAVEPOINT migration_statement;")
+                try:
+                    cursor.execute(command)
+                    cursor.execute("RELEASE SAVEPOINT migration_statement;")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT migration_statement;")
+                    logger.warning(f"Skipped a statement in migration {migration.version}.\n{type(e).__name__}: {e.args}\n{command}")
+            cursor.execute(f"INSERT INTO {schema}.schema_version(version, description) VALUES (%s, %s);",
+                           (migration.version, migration.description))
+            version = migration.version
+
+        database_connection.commit()
+    except Exception:
+        database_connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    return version
@@ -0,0 +1,148 @@
+'''
+SQL and query parameters shared by DatabaseManager (psycopg2) and AsyncDatabaseManager (psycopg 3).
+
+Both drivers use %s and %(name)s placeholders, so the statements are written once here.
+Statements with a {placeholder} are completed with str.format before use.
+'''
+from datetime import datetime, timedelta
+import math
+
+# Claims the next received image. {order} is one of DatabaseManager.claim_orders.
+CLAIM_NEXT_IMAGE = """UPDATE image_status SET status = 'processing', pipeline_step = 'assigned',
+                        lease_expires = NOW() + %s * INTERVAL '1 second'
+                   WHERE image_id = (
+                        SELECT image_id FROM image_status
+                        WHERE status = 'received'
+                        {order}
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                        )
+                   RETURNING file_path, image_id, log_path;"""
+
+QUEUE_DEPTH = """SELECT priority, COUNT(*) FROM image_status
+               WHERE status = 'received' GROUP BY priority;"""
+
+PIPELINE_STEPS = """SELECT pipeline_step FROM status;"""
+
+ADD_PIPELINE_STEP = """INSERT INTO status(pipeline_step, shortname, total_runtime, n_processed, n_current)
+                   VALUES (%s, %s, 0, 0, 0) ON CONFLICT DO NOTHING;"""
+
+IMAGE_STEP = """SELECT pipeline_step FROM image_status_all WHERE image_id = %s"""
+
+# The step of an image in the live queue, locked until the status update commits
+LIVE_IMAGE_STEP = """SELECT pipeline_step FROM image_status WHERE image_id = %s FOR UPDATE;"""
+
+IMAGE_STATUS = """SELECT * FROM image_status_all WHERE image_id = %s;"""
+
+PIPELINE_STATUS = """SELECT pipeline_step, shortname, total_runtime, n_processed, n_current
+                   FROM status_totals ORDER BY pipeline_step;"""
+
+# Starting a step marks it active, finishing it marks it inactive. Any lease is renewed.
+UPDATE_IMAGE_STEP = """UPDATE image_status
+                    SET pipeline_step = %s, processing_last = %s, processing_time = processing_time + %s, step_message = %s,
+                        step_active = %s, lease_expires = NOW() + %s * INTERVAL '1 second'
+                    WHERE image_id = %s;"""
+
+RECORD_STEP_RUNTIME = """INSERT INTO processing_time(image_id, pipeline_step, runtime)
+                      VALUES(%s, %s, %s) ON CONFLICT DO NOTHING;"""
+
+# {rows} is "VALUES %s" for psycopg2's execute_values, "VALUES " + STEP_COUNTER_ROW for one row at a time,
+# or a SELECT of (pipeline_step, shard, n_current, n_processed, total_runtime). No semicolon, so it can be a CTE.
+UPDATE_STEP_COUNTERS = """INSERT INTO status_shards AS s(pipeline_step, shard, n_current, n_processed, total_runtime)
+                       {rows}
+                       ON CONFLICT (pipeline_step, shard) DO UPDATE
+                       SET n_current = s.n_current + EXCLUDED.n_current, n_processed = s.n_processed + EXCLUDED.n_processed,
+                           total_runtime = s.total_runtime + EXCLUDED.total_runtime"""
+STEP_COUNTER_ROW = "(%s, %s, %s::int, %s::int, %s::real)"
+
+# Inserts an image unless its file_path exists, queues it, counts it in the caller's shard and wakes
+# idle workers, in one statement. Returns (image_id, TRUE) if inserted, else (existing image_id, FALSE).
+ADD_NEW_IMAGE = f"""WITH new_image AS (
+                    INSERT INTO images(file_path, object_id, ra, dec, filter)
+                    VALUES(%s, %s, %s, %s, %s)
+                    ON CONFLICT (file_path) DO NOTHING
+                    RETURNING image_id, file_path
+               ), queued AS (
+                    INSERT INTO image_status(image_id, file_path, status, pipeline_step, processing_time, priority)
+                    SELECT image_id, file_path, 'received', 'received', 0, %s FROM new_image
+               ), counted AS (
+                    {UPDATE_STEP_COUNTERS.format(rows="SELECT 'received', %s, 1, 0, 0 FROM new_image")}
+               )
+               SELECT image_id, TRUE FROM new_image, LATERAL pg_notify(%s, image_id::text)
+               UNION ALL
+               SELECT image_id, FALSE FROM images WHERE file_path = %s;"""
+
+# The closest image inside a cone, using the indexed unit vector columns of images
+CLOSEST_IMAGE = """
+SELECT ra, dec, file_path,
+    DEGREES( ACOS( GREATEST(-1, LEAST(1, cx * %(x)s + cy * %(y)s + cz * %(z)s))) )
+    AS angular_distance,
+    object_id
+FROM images
+WHERE filter = %(filter)s AND cz BETWEEN %(z_min)s AND %(z_max)s
+    AND cx * %(x)s + cy * %(y)s + cz * %(z)s >= %(cos_radius)s
+ORDER BY cx * %(x)s + cy * %(y)s + cz * %(z)s DESC
+LIMIT 1;
+"""
+
+# Downloaded flats of one night, plus the nearest flat before and after it
+FLATS_FOR_NIGHT = """(SELECT file_path, date_obs FROM flats
+                  WHERE downloaded=TRUE AND telescope=%(telescope)s AND filter=%(filter)s
+                  AND date_obs < %(start)s
+                  ORDER BY date_obs DESC LIMIT 1)
+                  UNION ALL
+                  (SELECT file_path, date_obs FROM flats
+                  WHERE downloaded=TRUE AND telescope=%(telescope)s AND filter=%(filter)s
+                  AND date_obs >= %(start)s AND date_obs < %(end)s)
+                  UNION ALL
+                  (SELECT file_path, date_obs FROM flats
+                  WHERE downloaded=TRUE AND telescope=%(telescope)s AND filter=%(filter)s
+                  AND date_obs >= %(end)s
+                  ORDER BY date_obs ASC LIMIT 1);"""
+
+LATEST_BIAS = """SELECT file_path FROM biases
+              WHERE camera=%s ORDER BY date_obs desc LIMIT 1;"""
+
+LATEST_DARK = """SELECT file_path FROM darks WHERE camera=%s
+              ORDER BY date_obs desc LIMIT 1;"""
+
+
+def closest_image_cones(ra, dec, filter, radii):
+    """Yields the CLOSEST_IMAGE parameters for cones of each radius (degrees) around a position"""
+    ra_rad, dec_rad = math.radians(ra), math.radians(dec)
+    params = {"x": math.cos(dec_rad) * math.cos(ra_rad),
+              "y": math.cos(dec_rad) * math.sin(ra_rad),
+              "z": math.sin(dec_rad),
+              "filter": filter}
+    for radius in radii:
+        params["z_min"] = math.sin(math.radians(max(-90.0, dec - radius)))
+        params["z_max"] = math.sin(math.radians(min(90.0, dec + radius)))
+        params["cos_radius"] = math.cos(math.radians(radius))
+        yield params
+
+
+def observing_night(date):
+    """Returns the date on which the observing night containing date began.
+    Nights run from noon to noon in date's time zone, so frames on either side of midnight share a night."""
+    return (date - timedelta(hours=12)).date()
+
+
+def night_bounds(date):
+    """Returns the start and end (noon to noon, in date's time zone) of the observing night containing date"""
+    night = observing_night(date)
+    night_start = datetime(night.year, night.month, night.day, 12, tzinfo=date.tzinfo)
+    return night_start, night_start + timedelta(days=1)
+
+
+def closest_in_time(candidates, date):
+    """Returns the (file_path, date_obs) candidate nearest to date, or (None, None) if there are none"""
+    if not candidates:
+        return None, None
+
+    def time_from_date(candidate):
+        # Naive dates are interpreted in the session time zone, as the database would
+        if date.tzinfo is None and candidate[1].tzinfo is not None:
+            return abs(candidate[1] - date.replace(tzinfo=candidate[1].tzinfo))
+        return abs(candidate[1] - date)
+
+    return min(candidates, key=time_from_date)
@@ -0,0 +1,304 @@
+'''
+Batch reference assignment for the images table.
+
+The positions of every image in a filter are held in a KD-tree of unit vectors, so the nearest
+reference for all unassigned images is found in one vectorized query and written back with a
+single bulk update. New images are added to a small brute-force buffer that is folded into the
+tree once it grows, instead of rebuilding the tree on every refresh. Each filter's index is also
+reloaded from scratch every rebuild_interval seconds, picking up images that committed after a
+newer image was loaded and images whose coordinates were set after they were added.
+'''
+from logging import Logger
+import time
+import numpy as np
+
+
+def chord_to_degrees(chord):
+    """Converts the chord length between two unit vectors to an angular distance in degrees"""
+    return np.degrees(2 * np.arcsin(np.clip(chord / 2, 0.0, 1.0)))
+
+
+class KDTree:
+    """A static KD-tree over points held in NumPy arrays. Queries for many points run together:
+    each descends to its own leaf for a first bound, then the tree is searched level by level,
+    pruning every node that cannot hold a point closer than the current k-th neighbour."""
+
+    # Largest number of queries searched at once
+    max_block = 8192
+
+    def __init__(self, points, leaf_size=32):
+        """@param points    (n, dims) array of points
+        @param leaf_size    Largest number of points in a leaf"""
+        self.points = np.asarray(points, dtype=float)
+        self.leaf_size = leaf_size
+        dims, splits, lefts, rights, leaves = [], [], [], [], []
+
+        # Nodes are numbered in the order they are built; each links itself into its parent
+        order = np.arange(len(self.points))
+        stack = [(0, len(order), None, None)]
+        while stack:
+            start, end, parent, children = stack.pop()
+            node = len(dims)
+            if parent is not None:
+                children[parent] = node
+            splits.append(0.0)
+            lefts.append(-1)
+            rights.append(-1)
+            if end - start <= leaf_size:
+                dims.append(-1)
+                leaves.append((node, order[start:end].copy()))
+                continue
+
+            # Split the widest dimension at its median
+            segment = self.points[order[start:end]]
+            dim = int(np.argmax(segment.max(axis=0) - segment.min(axis=0)))
+            middle = (end - start) // 2
+            order[start:end] = order[start:end][np.argpartition(segment[:, dim], middle)]
+            dims.append(dim)
+            splits[node] = self.points[order[start + middle], dim]
+            stack.append((start + middle, end, node, rights))
+            stack.append((start, start + middle, node, lefts))
+
+        self._dim = np.array(dims, dtype=np.int64)
+        self._split = np.array(splits)
+        self._left = np.array(lefts, dtype=np.int64)
+        self._right = np.array(rights, dtype=np.int64)
+        self._leaf_row = np.full(len(dims), -1, dtype=np.int64)
+        self._leaf_points = np.full((max(len(leaves), 1), leaf_size), -1, dtype=np.int64)
+        for row, (node, members) in enumerate(leaves):
+            self._leaf_row[node] = row
+            self._leaf_points[row, :len(members)] = members
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, vectors, k=1):
+        """Finds the k nearest points to each of the given points. k is at most half the leaf size,
+        so the leaf each query descends to holds k points and bounds the search.
+        @return     (distances, indices), both (n, k) and sorted by distance. Missing neighbours
+                    (fewer than k points in the tree) have distance inf and index -1."""
+        if k > (self.leaf_size + 1) // 2:
+            raise ValueError(f"k must be at most {(self.leaf_size + 1) // 2} for a leaf size of {self.leaf_size}")
+        vectors = np.asarray(vectors, dtype=float).reshape(-1, self.points.shape[1])
+        distances = np.full((len(vectors), k), np.inf)
+        indices = np.full((len(vectors), k), -1, dtype=np.int64)
+        if len(self.points) == 0:
+            return distances, indices
+
+        for start in range(0, len(vectors), self.max_block):
+            block = slice(start, start + self.max_block)
+            self._query_block(vectors[block], distances[block], indices[block])
+        return distances, indices
+
+    def _query_block(self, vectors, distances, indices):
+        """Fills distances and indices (views of the caller's arrays) for a block of queries"""
+        # Descend to each query's own leaf first, giving a bound that prunes most of the tree
+        queries = np.arange(len(vectors))
+        nodes = np.zeros(len(vectors), dtype=np.int64)
+        inner = self._dim[nodes] >= 0
+        while inner.any():
+            inner_nodes = nodes[inner]
+            below = vectors[inner, self._dim[inner_nodes]] < self._split[inner_nodes]
+            nodes[inner] = np.where(below, self._left[inner_nodes], self._right[inner_nodes])
+            inner = self._dim[nodes] >= 0
+        first_leaves = nodes
+        self._scan_leaves(vectors, queries, first_leaves, distances, indices)
+
+        # Visit every (query, node) pair whose node may still hold a closer point, one level at a time
+        nodes = np.zeros(len(vectors), dtype=np.int64)
+        bounds = np.zeros(len(vectors))
+        while queries.size:
+            keep = bounds < distances[queries, -1]
+            queries, nodes, bounds = queries[keep], nodes[keep], bounds[keep]
+
+            leaf = self._dim[nodes] < 0
+            unseen = leaf & (nodes != first_leaves[queries])
+            self._scan_leaves(vectors, queries[unseen], nodes[unseen], distances, indices)
+
+            queries, nodes, bounds = queries[~leaf], nodes[~leaf], bounds[~leaf]
+            offsets = vectors[queries, self._dim[nodes]] - self._split[nodes]
+            below = offsets < 0
+            near = np.where(below, self._left[nodes], self._right[nodes])
+            far = np.where(below, self._right[nodes], self._left[nodes])
+            queries = np.concatenate([queries, queries])
+            nodes = np.concatenate([near, far])
+            bounds = np.concatenate([bounds, np.maximum(bounds, np.abs(offsets))])
+
+    def _scan_leaves(self, vectors, queries, nodes, distances, indices):
+        """Merges the points of leaf nodes into the k nearest found so far for their queries.
+        A query may appear more than once."""
+        if queries.size == 0:
+            return
+        k = distances.shape[1]
+        members = self._leaf_points[self._leaf_row[nodes]]
+        valid = members >= 0
+        leaf_distances = np.linalg.norm(vectors[queries, None, :] - self.points[np.where(valid, members, 0)], axis=2)
+        leaf_distances[~valid] = np.inf
+        if members.shape[1] > k:
+            closest = np.argpartition(leaf_distances, k - 1, axis=1)[:, :k]
+            leaf_distances = np.take_along_axis(leaf_distances, closest, axis=1)
+            members = np.take_along_axis(members, closest, axis=1)
+
+        # Rank the leaf points together with each query's current neighbours, keeping the k nearest
+        unique = np.unique(queries)
+        owners = np.concatenate([np.repeat(queries, members.shape[1]), np.repeat(unique, k)])
+        candidates = np.concatenate([leaf_distances.ravel(), distances[unique].ravel()])
+        candidate_ids = np.concatenate([members.ravel(), indices[unique].ravel()])
+        order = np.lexsort((candidates, owners))
+        owners, candidates, candidate_ids = owners[order], candidates[order], candidate_ids[order]
+        rank = np.arange(len(owners)) - np.searchsorted(owners, owners)
+        nearest = rank < k
+        distances[unique] = candidates[nearest].reshape(-1, k)
+        indices[unique] = candidate_ids[nearest].reshape(-1, k)
+
+
+class ReferenceIndex:
+    """Nearest-neighbour index of image positions in one filter"""
+
+    # Largest number of query/buffer pairs compared at once
+    max_block = 1_000_000
+
+    def __init__(self, rebuild_fraction=0.1, min_rebuild=1000):
+        """@param rebuild_fraction  Fold the buffer into the tree when it exceeds this fraction of the tree
+        @param min_rebuild          ...or this number of positions, whichever is larger"""
+        self.rebuild_fraction = rebuild_fraction
+        self.min_rebuild = min_rebuild
+        self.last_image_id = 0
+        self.created = time.monotonic()
+        self._tree = None
+        self._tree_ids = np.empty(0, dtype=np.int64)
+        self._tree_vectors = np.empty((0, 3))
+        self._buffer_ids = np.empty(0, dtype=np.int64)
+        self._buffer_vectors = np.empty((0, 3))
+
+    def __len__(self):
+        return len(self._tree_ids) + len(self._buffer_ids)
+
+    def add(self, image_ids, vectors):
+        """Adds image positions (unit vectors) to the index.
+        Positions that are not finite, and images already in the index, are skipped."""
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        if image_ids.size == 0:
+            return
+        vectors = np.asarray(vectors, dtype=float).reshape(-1, 3)
+
+        # Each image is held once, so it is only ever skipped as its own neighbour
+        _, first = np.unique(image_ids, return_index=True)
+        usable = np.zeros(len(image_ids), dtype=bool)
+        usable[first] = True
+        usable &= np.isfinite(vectors).all(axis=1)
+        usable &= ~np.isin(image_ids, self._tree_ids) & ~np.isin(image_ids, self._buffer_ids)
+        if not usable.any():
+            return
+        self._buffer_ids = np.concatenate([self._buffer_ids, image_ids[usable]])
+        self._buffer_vectors = np.concatenate([self._buffer_vectors, vectors[usable]])
+
+        if len(self._buffer_ids) > max(self.min_rebuild, self.rebuild_fraction * len(self._tree_ids)):
+            self._rebuild()
+
+    def _rebuild(self):
+        """Folds the buffered positions into a new tree"""
+        self._tree_ids = np.concatenate([self._tree_ids, self._buffer_ids])
+        self._tree_vectors = np.concatenate([self._tree_vectors, self._buffer_vectors])
+        self._buffer_ids = self._buffer_ids[:0]
+        self._buffer_vectors = self._buffer_vectors[:0]
+        self._tree = KDTree(self._tree_vectors)
+
+    def nearest(self, image_ids, vectors):
+        """Finds the nearest other image for each position.
+        @return     (reference_ids, distances in degrees). Ids are -1 where no other image exists
+                    or the position is not finite."""
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=float).reshape(-1, 3)
+        finite = np.isfinite(vectors).all(axis=1)
+        vectors = np.where(finite[:, None], vectors, 0.0)
+        best_ids = np.full(len(image_ids), -1, dtype=np.int64)
+        best_chords = np.full(len(image_ids), np.inf)
+
+        if self._tree is not None and len(self._tree_ids) > 0:
+            # Ask for two neighbours so a query image can skip itself
+            k = min(2, len(self._tree_ids))
+            chords, indices = self._tree.query(vectors, k=k)
+            chords, indices = chords.reshape(len(vectors), k), indices.reshape(len(vectors), k)
+            neighbour_ids = self._tree_ids[indices]
+            usable = neighbour_ids != image_ids[:, None]
+            chords = np.where(usable, chords, np.inf)
+            column = np.argmin(chords, axis=1)
+            rows = np.arange(len(vectors))
+            best_chords = chords[rows, column]
+            best_ids = np.where(np.isfinite(best_chords), neighbour_ids[rows, column], -1)
+
+        if len(self._buffer_ids) > 0:
+            # Compare against the buffer in blocks to bound the size of the distance matrix
+            step = max(1, self.max_block // len(self._buffer_ids))
+            for start in range(0, len(vectors), step):
+                block = slice(start, start + step)
+                chords = np.linalg.norm(vectors[block, None, :] - self._buffer_vectors[None, :, :], axis=2)
+                chords[self._buffer_ids[None, :] == image_ids[block, None]] = np.inf
+                column = np.argmin(chords, axis=1)
+                buffer_chords = chords[np.arange(len(chords)), column]
+                closer = buffer_chords < best_chords[block]
+                best_chords[block] = np.where(closer, buffer_chords, best_chords[block])
+                best_ids[block] = np.where(closer, self._buffer_ids[column], best_ids[block])
+
+        best_ids[~finite] = -1
+        best_chords[~finite] = np.inf
+        return best_ids, chord_to_degrees(best_chords)
+
+
+class ReferenceAssigner:
+    """Assigns the nearest image in the same filter as the reference of every unassigned image"""
+
+    def __init__(self, database_manager, logger: Logger, max_distance=None, rebuild_interval=600.0):
+        """@param database_manager  The DatabaseManager to read positions from and write references to
+        @param logger               Logger for progress messages
+        @param max_distance         Largest reference distance (degrees) to assign, or None for no limit
+        @param rebuild_interval     Reload each filter's index from scratch after this many seconds"""
+        self.database_manager = database_manager
+        self.logger = logger
+        self.max_distance = max_distance
+        self.rebuild_interval = rebuild_interval
+        self.indexes = {}
+
+    def refresh(self, filter):
+        """Loads images added since the last refresh into the filter's index.
+        Images are loaded in id order, so an image that commits after a newer one was loaded, or whose
+        coordinates are set later, is missed here. It is added by assign while it has no reference,
+        and otherwise when the index is next reloaded."""
+        index = self.indexes.get(filter)
+        if index is None or time.monotonic() - index.created > self.rebuild_interval:
+            index = self.indexes[filter] = ReferenceIndex()
+        rows = self.database_manager.get_image_positions(filter, after_image_id=index.last_image_id)
+        if rows:
+            positions = np.array(rows, dtype=float)
+            index.add(positions[:, 0].astype(np.int64), positions[:, 1:])
+            index.last_image_id = int(positions[-1, 0])
+        return index
+
+    def assign(self, filter):
+        """Assigns references to every unassigned image in a filter. Returns the number assigned."""
+        index = self.refresh(filter)
+        rows = self.database_manager.get_image_positions(filter, unassigned_only=True)
+        if not rows:
+            return 0
+
+        positions = np.array(rows, dtype=float)
+        image_ids = positions[:, 0].astype(np.int64)
+        # Unassigned images are references for each other, even those refresh missed
+        index.add(image_ids, positions[:, 1:])
+        reference_ids, distances = index.nearest(image_ids, positions[:, 1:])
+
+        found = reference_ids >= 0
+        if self.max_distance is not None:
+            found &= distances <= self.max_distance
+
+        assignments = [(int(image_id), int(reference_id), float(distance))
+                       for image_id, reference_id, distance
+                       in zip(image_ids[found], reference_ids[found], distances[found])]
+        assigned = self.database_manager.assign_references(assignments)
+        self.logger.info(f"Assigned references to {assigned} of {len(image_ids)} unassigned {filter} images.")
+        return assigned
+
+    def assign_all(self):
+        """Assigns references in every filter with unassigned images. Returns the number assigned."""
+        return sum(self.assign(filter) for filter in self.database_manager.get_unassigned_filters())
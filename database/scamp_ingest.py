@@ -0,0 +1,108 @@
+'''
+Batch ingestion of SCAMP XML (VOTable) results into scamp_results.
+
+- parse_scamp_xml - reads the Fields statistics of one SCAMP XML file, one row per field
+- ScampIngester   - parses a directory of SCAMP XMLs in a process pool and inserts every row
+                    in one transaction, skipping (image_id, date_proc) keys already ingested
+'''
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging import Logger
+from pathlib import Path
+import numpy as np
+from astropy.io import votable
+
+# Order of the values in the rows returned by parse_scamp_xml
+SCAMP_COLUMNS = ("object_id", "ra", "dec", "date_proc", "astrom_offset_ref", "astrom_sigma_ref",
+                 "astrom_corr_ref", "astrom_chi_ref")
+
+
+def _column(fields, name):
+    """Returns a column of the Fields table as a plain float array"""
+    return np.ma.getdata(fields[name]).astype(float)
+
+
+def parse_scamp_xml(path):
+    """Extracts the per-field astrometry statistics from a SCAMP XML file.
+    Defined at module level so it can run in a process pool.
+    @return     List of tuples in SCAMP_COLUMNS order, with plain python values"""
+    table = votable.parse(str(path))
+    date_proc = table.get_field_by_id_or_name('Date').value + ' ' + table.get_field_by_id_or_name('Time').value
+    fields = table.get_table_by_id('Fields').array
+
+    object_ids = [value.decode() if isinstance(value, bytes) else str(value)
+                  for value in np.ma.getdata(fields["Image_Ident"])]
+    coordinates = _column(fields, "Field_Coordinates")
+    ra = (coordinates[:, 0] / 15).tolist()
+    dec = coordinates[:, 1].tolist()
+    offsets = _column(fields, "AstromOffset_Reference")[:, :2].tolist()
+    sigmas = _column(fields, "AstromSigma_Reference")[:, :2].tolist()
+    correlations = _column(fields, "AstromCorr_Reference").tolist()
+    chi2 = _column(fields, "Chi2_Reference").tolist()
+
+    return [(object_id, ra[i], dec[i], date_proc, offsets[i], sigmas[i], correlations[i], chi2[i])
+            for i, object_id in enumerate(object_ids)]
+
+
+class ScampIngester:
+    """Backfills scamp_results from directories of SCAMP XML files"""
+
+    def __init__(self, database_manager, logger: Logger, workers=None):
+        """@param database_manager  The DatabaseManager to insert results with
+        @param logger               Logger for progress and unreadable files
+        @param workers              Number of parsing processes (defaults to the number of CPUs)"""
+        self.database_manager = database_manager
+        self.logger = logger
+        self.workers = workers
+
+    def parse(self, paths):
+        """Parses SCAMP XML files in parallel. Files that cannot be parsed are logged and skipped.
+        @return     List of (path, rows) in the order of paths"""
+        paths = [Path(path) for path in paths]
+        if not paths:
+            return []
+
+        results = {}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(parse_scamp_xml, path): path for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    results[path] = future.result()
+                except Exception as e:
+                    self.logger.warning(f"Failed to parse SCAMP results {path}.\n{type(e).__name__}: {e.args}")
+        return [(path, results[path]) for path in paths if path in results]
+
+    def ingest(self, paths, image_ids=None, map_paths=None):
+        """Parses SCAMP XML files and inserts their rows in one transaction.
+
+        @param paths        SCAMP XML files
+        @param image_ids    {Image_Ident: image_id}. Looked up from images.object_id when not given.
+        @param map_paths    {Image_Ident: (dist_map_path, fgroup_map_path, referr_1d_path, referr_2d_path)}
+        @return             Dict with the number of files parsed, rows inserted, and rows skipped
+                            because no image matched their Image_Ident
+        """
+        parsed = self.parse(paths)
+        rows = [row for _, file_rows in parsed for row in file_rows]
+        if image_ids is None:
+            image_ids = self.database_manager.get_image_ids({row[0] for row in rows})
+        map_paths = map_paths or {}
+
+        records = []
+        unmatched = 0
+        for row in rows:
+            image_id = image_ids.get(row[0])
+            if image_id is None:
+                unmatched += 1
+                continue
+            records.append((image_id,) + row + tuple(map_paths.get(row[0], (None, None, None, None))))
+        if unmatched:
+            self.logger.warning(f"Skipped {unmatched} SCAMP fields with no matching image.")
+
+        inserted = self.database_manager.add_scamp_results(records)
+        self.logger.info(f"Ingested {inserted} SCAMP fields from {len(parsed)} files "
+                         f"({len(records) - inserted} already in the database).")
+        return {"files": len(parsed), "inserted": inserted, "unmatched": unmatched}
+
+    def ingest_directory(self, directory, pattern="*.xml", image_ids=None, map_paths=None):
+        """Ingests every SCAMP XML file in a directory matching pattern"""
+        return self.ingest(sorted(Path(directory).glob(pattern)), image_ids, map_paths)
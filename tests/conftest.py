@@ -0,0 +1,75 @@
+'''
+Shared fixtures for the tests.
+
+Database tests run against a throwaway cluster started with initdb/pg_ctl (see
+database.benchmark.TemporaryPostgres), each in a schema of its own. Set PIPELINE_TEST_DSN to use
+an existing server instead. The tests are skipped when neither is available.
+'''
+from contextlib import suppress
+import logging
+import os
+import subprocess
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def db_details():
+    """Connection keywords for a Postgres server with a turbogroup role"""
+    psycopg2 = pytest.importorskip("psycopg2")
+    dsn = os.environ.get("PIPELINE_TEST_DSN")
+    if dsn:
+        details = psycopg2.extensions.parse_dsn(dsn)
+        connection = psycopg2.connect(**details)
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_roles WHERE rolname = 'turbogroup';")
+            if cursor.fetchone() is None:
+                cursor.execute("CREATE ROLE turbogroup;")
+        connection.close()
+        yield details
+        return
+
+    from database.benchmark import TemporaryPostgres
+    postgres = None
+    try:
+        postgres = TemporaryPostgres(max_connections=100)
+        postgres.start()
+    except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+        if postgres is not None:
+            with suppress(Exception):
+                postgres.stop()
+        pytest.skip(f"No Postgres server to test against: {e}")
+    yield postgres.db_details
+    postgres.stop()
+
+
+@pytest.fixture
+def schema(db_details):
+    """Name of a schema that is dropped after the test"""
+    import psycopg2
+    name = f"test_{uuid.uuid4().hex[:12]}"
+    yield name
+    connection = psycopg2.connect(**db_details)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {name} CASCADE;")
+    connection.close()
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("pipeline-tests")
+
+
+@pytest.fixture
+def manager(db_details, schema, logger):
+    """A DatabaseManager on a new schema"""
+    from database.database_manager import DatabaseManager
+    manager = DatabaseManager(db_details, logger, schema=schema)
+    yield manager
+    manager.close()
@@ -0,0 +1,69 @@
+'''
+The asyncio DatabaseManager against tables created by the DatabaseManager.
+'''
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("psycopg_pool")
+
+from database.async_database_manager import AsyncDatabaseManager
+from database.benchmark import BenchmarkImage
+
+
+def run(manager, db_details, schema, logger, test):
+    """Runs test(async_manager) with an AsyncDatabaseManager on the manager's schema"""
+    async def main():
+        async with AsyncDatabaseManager(db_details, logger, schema=schema, max_size=2) as async_manager:
+            return await test(async_manager)
+    return asyncio.run(main())
+
+
+def step_counts(status, pipeline_step):
+    return {row[0]: tuple(row[2:]) for row in status}[pipeline_step]
+
+
+def test_claim_and_update_status(manager, db_details, schema, logger):
+    images = [BenchmarkImage(index=index) for index in range(1, 4)]
+    manager.add_images(images)
+    start_time = datetime(2026, 1, 1, 22, 0)
+
+    async def test(async_manager):
+        assert await async_manager.get_queue_depth() == {0: 3}
+        claims = await asyncio.gather(*(async_manager.get_next_image() for _ in range(4)))
+        assert sorted(claim[1] for claim in claims) == [-1] + [image.db_id for image in images]
+
+        for image in images:
+            await async_manager.update_image_status(image, "reduction", "reduce", start_time, 0)
+            await async_manager.update_image_status(image, "reduction", "reduce", start_time, 2.0, "done")
+        assert step_counts(await async_manager.get_pipeline_status(), "reduction") == pytest.approx((6.0, 3, 0))
+        status = await async_manager.get_image_status(images[0].db_id)
+        assert (status["status"], status["pipeline_step"], status["step_message"]) == ("processing", "reduction", "done")
+
+        # A late update for an archived image is dropped
+        manager.finish_image(images[0], end_time=start_time + timedelta(seconds=5))
+        await async_manager.update_image_status(images[0], "reduction", "reduce", start_time, 1.0)
+        assert step_counts(await async_manager.get_pipeline_status(), "reduction") == pytest.approx((6.0, 3, 0))
+        assert await async_manager.get_step_from_status_table(images[0].db_id) == "reduction"
+
+    run(manager, db_details, schema, logger, test)
+
+
+def test_queries_match_the_database_manager(manager, db_details, schema, logger):
+    images = [BenchmarkImage(index=index) for index in range(1, 30)]
+    manager.add_images(images)
+    night = datetime(2026, 1, 1, 23, 0)
+    for hours in (-20, -1, 3):
+        manager.download_flat(f"/flats/{hours}.fits", "RASA11", "r", night + timedelta(hours=hours), "dome")
+
+    async def test(async_manager):
+        for image in images[::5]:
+            assert (await async_manager.retrieve_closest_image(None, image.ra + 0.1, image.dec, "r")
+                    == manager.retrieve_closest_image(None, image.ra + 0.1, image.dec, "r"))
+        assert (await async_manager.get_flat("RASA11", "r", night))[0] == "/flats/-1.fits"
+        for date in (night, night + timedelta(hours=4), night + timedelta(days=3)):
+            assert (await async_manager.get_flat("RASA11", "r", date)
+                    == manager.get_flat("RASA11", "r", date))
+
+    run(manager, db_details, schema, logger, test)
@@ -0,0 +1,80 @@
+'''
+Claiming images in batches and releasing unstarted claims.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+from database.database_manager import DatabaseManager
+
+
+def test_claim_in_batches(manager):
+    images = [BenchmarkImage(index=index) for index in range(5)]
+    manager.add_images(images)
+    start_time = datetime(2026, 1, 1, 22, 0)
+
+    # The oldest images are claimed first, although they are not returned in any order
+    claimed = sorted(manager.get_next_images(3, "machine-a", start_time), key=lambda row: row[1])
+    assert [row[1] for row in claimed] == [image.db_id for image in images[:3]]
+    assert [row[0] for row in claimed] == [image.source_path for image in images[:3]]
+    status = manager.get_image_status(images[0].db_id)
+    assert (status["status"], status["pipeline_step"]) == ("processing", "assigned")
+    assert (status["machine_name"], status["processing_start"]) == ("machine-a", start_time)
+
+    assert sorted(row[1] for row in manager.get_next_images(3, "machine-b")) == [image.db_id for image in images[3:]]
+    assert manager.get_next_images(3, "machine-b") == []
+
+
+def test_concurrent_claims_do_not_overlap(manager, db_details, schema, logger):
+    manager.add_images([BenchmarkImage(index=index) for index in range(200)])
+
+    def claim_all(name):
+        worker = DatabaseManager(db_details, logger, schema=schema)
+        try:
+            claimed = []
+            while batch := worker.get_next_images(7, name):
+                claimed += [row[1] for row in batch]
+            return claimed
+        finally:
+            worker.close()
+
+    with ThreadPoolExecutor(4) as executor:
+        claims = list(executor.map(claim_all, [f"machine-{n}" for n in range(4)]))
+    claimed = [image_id for claim in claims for image_id in claim]
+    assert len(claimed) == len(set(claimed)) == 200
+
+
+def test_release_returns_unstarted_claims(manager):
+    images = [BenchmarkImage(index=index) for index in range(3)]
+    manager.add_images(images)
+    manager.get_next_images(3, "machine-a")
+    manager.start_image(images[0], "machine-a", datetime.now())
+
+    # The started image stays claimed
+    assert manager.release_images([image.db_id for image in images]) == 2
+    assert manager.get_queue_depth() == {0: 2}
+    status = manager.get_image_status(images[1].db_id)
+    assert (status["status"], status["pipeline_step"], status["machine_name"]) == ("received", "received", None)
+    assert sorted(row[1] for row in manager.get_next_images(3, "machine-b")) == [image.db_id for image in images[1:]]
+    assert manager.release_images([]) == 0
+
+
+def test_release_wakes_idle_workers(manager):
+    image = BenchmarkImage(index=1)
+    manager.add_image(image)
+    manager.get_next_images(1, "machine-a")
+
+    with ThreadPoolExecutor(1) as executor:
+        waiter = executor.submit(manager.wait_for_work, 30)
+        # Let the waiter find the queue empty and start listening
+        time.sleep(0.5)
+        assert not waiter.done()
+        start = time.monotonic()
+        assert manager.release_images([image.db_id]) == 1
+        assert waiter.result(timeout=10) is True
+    assert time.monotonic() - start < 10
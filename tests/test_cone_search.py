@@ -0,0 +1,65 @@
+'''
+retrieve_closest_image against the full-table ACOS query it replaced.
+'''
+import math
+import random
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+
+# The original query, which computes the distance to every image in the filter
+BASELINE_QUERY = """
+SELECT ra, dec, file_path,
+    DEGREES( ACOS(  GREATEST(-1, LEAST(1, SIN( RADIANS(%s)) * SIN( RADIANS(dec)) +
+                    COS( RADIANS(%s)) * COS( RADIANS(dec)) * COS(RADIANS(%s - ra)))))
+                    )
+    AS angular_distance,
+    object_id
+FROM images
+WHERE ra IS NOT NULL AND dec IS NOT NULL AND filter = %s
+ORDER BY angular_distance;
+"""
+
+
+def positions(rng, n):
+    """Random positions, uniform on the sphere, plus some near the poles and either side of RA 0"""
+    uniform = [(rng.uniform(0, 360), math.degrees(math.asin(rng.uniform(-1, 1)))) for _ in range(n)]
+    poles = [(rng.uniform(0, 360), sign * rng.uniform(88, 90)) for sign in (1, -1) for _ in range(n // 10)]
+    wrap = [(ra % 360, rng.uniform(-30, 30)) for ra in (rng.uniform(-2, 2) for _ in range(n // 10))]
+    return uniform + poles + wrap
+
+
+def add_images(manager, coordinates, filter, start):
+    images = []
+    for index, (ra, dec) in enumerate(coordinates, start):
+        image = BenchmarkImage(index=index)
+        image.ra, image.dec, image.hdr = ra, dec, {"FILTER": filter}
+        images.append(image)
+    manager.add_images(images)
+
+
+def test_closest_image_matches_the_acos_query(manager):
+    rng = random.Random(20261017)
+    add_images(manager, positions(rng, 300), "r", 0)
+    add_images(manager, positions(rng, 100), "g", 1000)
+    # Two images far apart, so most searches need the widest cone
+    add_images(manager, [(10.0, 80.0), (200.0, -70.0)], "i", 2000)
+
+    queries = [(ra, dec, filter) for ra, dec in positions(rng, 40) for filter in ("r", "g", "i")]
+    queries += [(0.0, 90.0, "r"), (0.0, -90.0, "g"), (359.999, 0.0, "r"), (0.0, 0.0, "i")]
+    with manager._connection() as connection, connection.cursor() as cursor:
+        for ra, dec, filter in queries:
+            cursor.execute(BASELINE_QUERY, (dec, dec, ra, filter))
+            expected = cursor.fetchone()
+            result = manager.retrieve_closest_image(None, ra, dec, filter)
+            # Distances rather than paths are compared, as images at the same distance may be ordered either way
+            assert result[3] == pytest.approx(expected[3], abs=1e-4), (ra, dec, filter)
+        connection.commit()
+
+
+def test_closest_image_without_images_in_the_filter(manager):
+    add_images(manager, [(10.0, 10.0)], "r", 0)
+    assert manager.retrieve_closest_image(None, 10.0, 10.0, "z") is None
@@ -0,0 +1,159 @@
+'''
+Duplicate detection and the manifest of cutout_extractor.
+'''
+import hashlib
+import shutil
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip("numpy")
+fits = pytest.importorskip("astropy.io.fits")
+pytest.importorskip("PIL")
+
+import cutout_extractor
+from cutout_extractor import CutoutManifest, DuplicateDetector, MANIFEST_NAME, process_all_fits
+
+
+def write_bytes(path, data):
+    path.write_bytes(bytes(data))
+    return path
+
+
+def write_fits(path, seed):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = np.random.default_rng(seed).normal(100, 10, (32, 32)).astype(np.float32)
+    fits.PrimaryHDU(data).writeto(path)
+    return path
+
+
+def test_files_of_unique_size_are_not_read(tmp_path):
+    detector = DuplicateDetector()
+    # The paths do not exist, so reading either would fail
+    assert detector.check(tmp_path / "a.fits", 100) == (None, None, None)
+    assert detector.check(tmp_path / "b.fits", 200) == (None, None, None)
+    assert not detector.stage_times
+
+
+def test_identical_files_are_duplicates(tmp_path):
+    data = np.random.default_rng(1).bytes(50000)
+    a = write_bytes(tmp_path / "a.fits", data)
+    b = write_bytes(tmp_path / "b.fits", data)
+    detector = DuplicateDetector()
+    assert detector.check(a, len(data))[0] is None
+    owner, sample, full = detector.check(b, len(data))
+    assert owner == str(a)
+    assert full == hashlib.sha256(data).hexdigest()
+
+
+def test_same_size_different_content_is_not_a_duplicate(tmp_path):
+    rng = np.random.default_rng(2)
+    a = write_bytes(tmp_path / "a.fits", rng.bytes(50000))
+    b = write_bytes(tmp_path / "b.fits", rng.bytes(50000))
+    detector = DuplicateDetector()
+    assert detector.check(a, 50000)[0] is None
+    owner, sample, full = detector.check(b, 50000)
+    assert owner is None and sample is not None
+    # Different sample hashes settle it without reading either file in full
+    assert "full" not in detector.stage_times
+
+
+def test_sample_hash_collision_is_settled_by_the_full_hash(tmp_path):
+    data = bytearray(np.random.default_rng(3).bytes(100000))
+    a = write_bytes(tmp_path / "a.fits", data)
+    # Change a byte between the two sampled blocks
+    data[50000] ^= 0xFF
+    b = write_bytes(tmp_path / "b.fits", data)
+    detector = DuplicateDetector(samples=2, sample_size=1000)
+    assert detector.check(a, len(data))[0] is None
+    owner, sample, full = detector.check(b, len(data))
+    assert owner is None
+    assert sample == detector.sample_hash(a)
+    assert detector.stage_times["full"][0] == 2
+
+
+@pytest.fixture
+def source(tmp_path):
+    """Source directory holding two pairs of identical FITS files"""
+    src = tmp_path / "src"
+    write_fits(src / "a.fits", 1)
+    shutil.copy(src / "a.fits", src / "b.fits")
+    write_fits(src / "c.fits", 2)
+    write_fits(src / "night" / "d.fits", 2)
+    return src
+
+
+def pngs(dest):
+    return sorted(str(path.relative_to(dest)) for path in dest.rglob("*.png"))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_duplicates_are_skipped(source, tmp_path, workers):
+    dest = tmp_path / "dest"
+    process_all_fits(source, dest, workers=workers, max_in_flight=1)
+    assert pngs(dest) == ["a.png", "c.png"]
+
+    with sqlite3.connect(dest / MANIFEST_NAME) as db:
+        rows = dict(db.execute("SELECT path, duplicate_of FROM files"))
+    assert rows == {str(source / "a.fits"): None, str(source / "b.fits"): str(source / "a.fits"),
+                    str(source / "c.fits"): None, str(source / "night" / "d.fits"): str(source / "c.fits")}
+
+
+def test_rerun_writes_nothing_to_the_manifest(source, tmp_path, monkeypatch):
+    dest = tmp_path / "dest"
+    process_all_fits(source, dest)
+
+    writes = []
+    monkeypatch.setattr(CutoutManifest, "_changed", lambda self: writes.append(1))
+    monkeypatch.setattr(cutout_extractor, "sample_hash", None)
+    monkeypatch.setattr(cutout_extractor, "hash_file", None)
+    process_all_fits(source, dest)
+    assert writes == []
+    assert pngs(dest) == ["a.png", "c.png"]
+
+
+def test_duplicate_of_an_earlier_run_is_skipped(source, tmp_path):
+    dest = tmp_path / "dest"
+    process_all_fits(source, dest)
+    shutil.copy(source / "c.fits", source / "e.fits")
+    process_all_fits(source, dest)
+    assert pngs(dest) == ["a.png", "c.png"]
+
+
+def test_hashes_of_another_algorithm_are_not_reused(tmp_path):
+    manifest = CutoutManifest(tmp_path / MANIFEST_NAME, "md5")
+    manifest.record("/src/a.fits", 100, 1, "sample", "full")
+    manifest.close()
+
+    manifest = CutoutManifest(tmp_path / MANIFEST_NAME, "sha256")
+    assert manifest.cached("/src/a.fits", 100, 1) is None
+    manifest.close()
+    manifest = CutoutManifest(tmp_path / MANIFEST_NAME, "md5")
+    assert manifest.cached("/src/a.fits", 100, 1) == ("sample", "full")
+    assert manifest.cached("/src/a.fits", 100, 2) is None
+    manifest.close()
+
+
+def test_old_manifest_is_upgraded(source, tmp_path):
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    a = source / "a.fits"
+    stat = a.stat()
+    full = hashlib.sha256(a.read_bytes()).hexdigest()
+    with sqlite3.connect(dest / MANIFEST_NAME) as db:
+        db.execute("""CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,
+                   hash TEXT NOT NULL, png_path TEXT, duplicate_of TEXT)""")
+        db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, NULL)",
+                   (str(a), stat.st_size, stat.st_mtime_ns, full, str(dest / "a.png")))
+    db.close()
+
+    manifest = CutoutManifest(dest / MANIFEST_NAME)
+    assert manifest.cached(str(a), stat.st_size, stat.st_mtime_ns) == (None, full)
+    manifest.close()
+
+    process_all_fits(source, dest)
+    assert pngs(dest) == ["a.png", "c.png"]
+    with sqlite3.connect(dest / MANIFEST_NAME) as db:
+        row = db.execute("SELECT algorithm, full_hash, duplicate_of FROM files WHERE path = ?", (str(a),)).fetchone()
+    db.close()
+    assert row == ("sha256", full, None)
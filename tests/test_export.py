@@ -0,0 +1,49 @@
+'''
+Streaming exports of pipeline tables.
+'''
+from collections import namedtuple
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+from database.export import _numpy_dtypes, _structured_chunk
+
+Column = namedtuple("Column", ["name", "type_code"])
+
+
+def test_npy_columns_keep_their_type_across_chunks(manager, tmp_path):
+    images = [BenchmarkImage(index=index) for index in range(1, 6)]
+    manager.add_images(images)
+    # Chunks of two rows mix NULL and non-NULL nsources differently
+    with manager._connection() as connection, connection.cursor() as cursor:
+        for image in images[:2] + images[3:4]:
+            cursor.execute("UPDATE images SET nsources = %s WHERE image_id = %s;", (100 + image.db_id, image.db_id))
+        connection.commit()
+
+    result = manager.export_table("images", tmp_path / "images", format="npy", chunk_rows=2,
+                                  columns=["image_id", "nsources", "ra"])
+    assert result["rows"] == 5 and len(result["files"]) == len(result["masks"]) == 3
+    chunks = [np.load(path) for path in result["files"]]
+    masks = [np.load(path) for path in result["masks"]]
+    assert {chunk.dtype["nsources"] for chunk in chunks} == {np.dtype("i4")}
+    assert {chunk.dtype["ra"] for chunk in chunks} == {np.dtype("f4")}
+
+    image_ids = np.concatenate([chunk["image_id"] for chunk in chunks])
+    values = np.ma.masked_array(np.concatenate([chunk["nsources"] for chunk in chunks]),
+                                np.concatenate([mask["nsources"] for mask in masks]))
+    expected = [100 + image.db_id if index in (0, 1, 3) else None for index, image in enumerate(images)]
+    assert values[np.argsort(image_ids)].tolist() == expected
+
+
+def test_null_booleans_are_masked_not_false():
+    description = [Column("flag", 16), Column("count", 23), Column("date", 1114), Column("name", 25)]
+    rows = [(True, 1, None, "a"), (None, None, None, None), (False, 3, None, "c")]
+    chunk, mask = _structured_chunk(rows, description, _numpy_dtypes(description))
+    assert chunk.dtype["flag"] == np.dtype("?") and chunk.dtype["count"] == np.dtype("i4")
+    assert mask["flag"].tolist() == mask["count"].tolist() == [False, True, False]
+    assert mask["date"].all() and np.isnat(chunk["date"]).all()
+    assert np.ma.masked_array(chunk["flag"], mask["flag"]).tolist() == [True, None, False]
+    assert np.ma.masked_array(chunk["name"], mask["name"]).tolist() == ["a", None, "c"]
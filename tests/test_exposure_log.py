@@ -0,0 +1,106 @@
+'''
+Recording exposures locally and forwarding them to the pipeline database.
+'''
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.database_manager import DatabaseManager
+from database.exposure_log import ExposureForwarder, LocalExposureLog
+
+
+def exposure(n):
+    return (f"/raw/exposure_{n:04d}.fits", f"field_{n}", 10.0 + n, 20.0, "r", 0)
+
+
+@pytest.fixture
+def exposure_log(tmp_path):
+    log = LocalExposureLog(tmp_path / "exposures.sqlite")
+    yield log
+    log.close()
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_local_log(exposure_log):
+    first = exposure_log.add_exposure(*exposure(1))
+    second = exposure_log.add_exposure(*exposure(2))
+    assert exposure_log.add_exposure(*exposure(1)) == first
+    assert exposure_log.pending() == [exposure(1), exposure(2)]
+    assert exposure_log.pending(limit=1) == [exposure(1)]
+
+    exposure_log.mark_forwarded({exposure(1)[0]: 41})
+    assert (exposure_log.image_id(first), exposure_log.image_id(second)) == (41, None)
+    assert exposure_log.backlog() == 1
+    assert exposure_log.prune(older_than=-1) == 1
+    assert exposure_log.pending() == [exposure(2)]
+
+
+def test_forwarding_is_replayable(manager):
+    records = [exposure(n) for n in range(3)]
+    image_ids = manager.forward_exposures(records)
+    assert sorted(image_ids) == [record[0] for record in records]
+    replayed = manager.forward_exposures(records[1:] + [exposure(3)])
+    assert [replayed[record[0]] for record in records[1:]] == [image_ids[record[0]] for record in records[1:]]
+    assert replayed[exposure(3)[0]] not in image_ids.values()
+    status = manager.get_image_status(image_ids[records[0][0]])
+    assert (status["status"], status["file_path"]) == ("captured", records[0][0])
+    # Captured exposures are not queued
+    assert manager.get_queue_depth() == {}
+
+
+def test_capture_does_not_wait_on_the_database(manager, db_details, schema, logger, exposure_log):
+    reachable = threading.Event()
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if not reachable.wait(5):
+            raise ConnectionError("database unreachable")
+        return DatabaseManager(db_details, logger, schema=schema)
+
+    forwarder = ExposureForwarder(exposure_log, connect, logger, interval=3600, batch_size=2)
+    try:
+        start = time.monotonic()
+        local_ids = [forwarder.add_exposure(*exposure(n)) for n in range(5)]
+        assert time.monotonic() - start < 1
+        wait_until(lambda: attempts)
+        assert [forwarder.image_id(local_id) for local_id in local_ids] == [None] * 5
+
+        reachable.set()
+        forwarder.add_exposure(*exposure(5))
+        wait_until(lambda: exposure_log.backlog() == 0)
+    finally:
+        forwarder.stop()
+
+    image_ids = manager.forward_exposures([exposure(n) for n in range(5)])
+    assert [exposure_log.image_id(local_id) for local_id in local_ids] == [image_ids[exposure(n)[0]] for n in range(5)]
+
+
+def test_failed_batches_are_retried(manager, db_details, schema, logger, exposure_log):
+    failures = [ConnectionError("database unreachable")]
+
+    def connect():
+        if failures:
+            raise failures.pop()
+        return DatabaseManager(db_details, logger, schema=schema)
+
+    forwarder = ExposureForwarder(exposure_log, connect, logger, interval=3600)
+    forwarder._worker.stop()
+    for n in range(3):
+        exposure_log.add_exposure(*exposure(n))
+    assert forwarder.forward() == 0
+    assert exposure_log.backlog() == 3
+
+    exposure_log.add_exposure(*exposure(3))
+    forwarder.stop(flush=True)
+    assert exposure_log.backlog() == 0
+    assert manager.forward_exposures([exposure(0)]) == {exposure(0)[0]: exposure_log.image_id(1)}
@@ -0,0 +1,32 @@
+'''
+Adding images only once, by file_path.
+'''
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+
+
+def received(manager):
+    return {row[0]: row[4] for row in manager.get_pipeline_status()}["received"]
+
+
+def test_add_new_image_counts_only_new_images(manager):
+    first, again = BenchmarkImage(index=1), BenchmarkImage(index=1)
+    assert manager.add_new_image(first, priority=2) is True
+    assert manager.add_new_image(again) is False
+    assert again.db_id == first.db_id and again.hdr["DB_ID"] == first.db_id
+    assert received(manager) == 1
+    assert manager.get_queue_depth() == {2: 1}
+
+
+def test_reconcile_paths(manager):
+    manager.add_new_image(BenchmarkImage(index=1))
+    existing = BenchmarkImage(index=1).source_path
+    image_ids = manager.reconcile_paths([existing, "/raw/new.fits", ("/raw/other.fits", "other", 10.0, 20.0, "r")])
+    assert set(image_ids) == {existing, "/raw/new.fits", "/raw/other.fits"}
+    assert len(set(image_ids.values())) == 3
+    assert received(manager) == 3
+    assert manager.reconcile_paths(["/raw/new.fits"]) == {"/raw/new.fits": image_ids["/raw/new.fits"]}
+    assert received(manager) == 3
@@ -0,0 +1,57 @@
+'''
+Leases on claimed images and requeueing expired claims.
+'''
+from datetime import datetime
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+from database.database_manager import DatabaseManager
+
+
+@pytest.fixture
+def short_leases(manager, db_details, schema, logger):
+    """A manager on the test schema whose claims expire after one second"""
+    leased = DatabaseManager(db_details, logger, schema=schema, lease_seconds=1)
+    yield leased
+    leased.close()
+
+
+def step_counts(manager, pipeline_step):
+    return {row[0]: tuple(row[2:]) for row in manager.get_pipeline_status()}[pipeline_step]
+
+
+def test_expired_claims_are_requeued(short_leases):
+    manager = short_leases
+    images = [BenchmarkImage(index=index) for index in range(1, 4)]
+    manager.add_images(images)
+    assert len(manager.get_next_images(3, "machine-a")) == 3
+    manager.update_image_status(images[0], "reduction", "reduce", datetime(2026, 1, 1, 22, 0), 0)
+    assert step_counts(manager, "reduction") == pytest.approx((0.0, 0, 1))
+
+    # Nothing has expired yet
+    assert manager.reap_expired_claims() == 0
+    assert manager.heartbeat(images[1].db_id, lease_seconds=60) == 1
+    time.sleep(1.5)
+
+    assert manager.reap_expired_claims() == 2
+    assert manager.reap_expired_claims() == 0
+    assert step_counts(manager, "reduction") == pytest.approx((0.0, 0, 0))
+    assert manager.get_queue_depth() == {0: 2}
+    for image, status in zip(images, ("received", "processing", "received")):
+        assert manager.get_image_status(image.db_id)["status"] == status
+    status = manager.get_image_status(images[0].db_id)
+    assert (status["pipeline_step"], status["machine_name"]) == ("received", None)
+    assert sorted(row[1] for row in manager.get_next_images(3, "machine-b")) == [images[0].db_id, images[2].db_id]
+
+
+def test_heartbeat_renews_only_claimed_images(short_leases):
+    manager = short_leases
+    images = [BenchmarkImage(index=index) for index in range(1, 3)]
+    manager.add_images(images)
+    manager.get_next_images(1, "machine-a")
+    assert manager.heartbeat([image.db_id for image in images]) == 1
+    assert manager.heartbeat([]) == 0
@@ -0,0 +1,216 @@
+'''
+Upgrading a database created by the original create_pipeline_tables (before versioned migrations).
+'''
+from datetime import datetime
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+from database.create_pipeline_tables import pipeline_migrations
+from database.database_manager import DatabaseError, DatabaseManager
+from database.migrations import Migration, OptionalStatement, apply_migrations, schema_version
+
+# The schema as the original create_pipeline_tables built it
+BASELINE_SCHEMA = """
+CREATE SCHEMA IF NOT EXISTS {schema} AUTHORIZATION turbogroup;
+
+CREATE TABLE IF NOT EXISTS {schema}.images (
+image_id SERIAL PRIMARY KEY,
+file_path VARCHAR(255) NOT NULL,
+object_id VARCHAR(64) NOT NULL,
+filter VARCHAR(64) NOT NULL,
+ra REAL,
+dec REAL,
+quality VARCHAR(64),
+ncoadds INT,
+nsources INT,
+reference_path VARCHAR(255),
+reference_distance REAL
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.status (
+pipeline_step VARCHAR(255) PRIMARY KEY,
+shortname VARCHAR(25) NOT NULL,
+total_runtime REAL NOT NULL,
+n_processed INT NOT NULL,
+n_current INT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.image_status (
+image_id int PRIMARY KEY NOT NULL,
+file_path VARCHAR(255) NOT NULL,
+status VARCHAR (128) NOT NULL,
+processing_start TIMESTAMP,
+processing_last TIMESTAMP,
+processing_time REAL,
+machine_name VARCHAR(128),
+pipeline_step VARCHAR(255),
+step_message VARCHAR(255),
+log_path TEXT,
+FOREIGN KEY (image_id) REFERENCES {schema}.images (image_id) ON DELETE CASCADE,
+FOREIGN KEY (pipeline_step) REFERENCES {schema}.status (pipeline_step) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.processing_time (
+image_id int,
+pipeline_step VARCHAR(255),
+runtime REAL NOT NULL,
+PRIMARY KEY(image_id, pipeline_step),
+FOREIGN KEY (image_id) REFERENCES {schema}.images (image_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.flats (
+image_id SERIAL PRIMARY KEY,
+file_path VARCHAR(255) NOT NULL,
+object_id VARCHAR(64) NOT NULL,
+telescope VARCHAR(16) NOT NULL,
+filter CHAR(1) NOT NULL,
+type CHAR(4) NOT NULL,
+date_obs TIMESTAMPTZ NOT NULL,
+downloaded BOOLEAN NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.darks (
+image_id SERIAL PRIMARY KEY,
+file_path VARCHAR(255) NOT NULL,
+object_id VARCHAR(64) NOT NULL,
+camera VARCHAR(255) NOT NULL,
+date_obs TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.biases (
+image_id SERIAL PRIMARY KEY,
+file_path VARCHAR(255) NOT NULL,
+object_id VARCHAR(64) NOT NULL,
+camera VARCHAR(255) NOT NULL,
+date_obs TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.candidates (
+image_id INT NOT NULL,
+ra REAL,
+dec REAL,
+ra_cand REAL,
+dec_cand REAL,
+mag_cand REAL,
+dmag_cand REAL,
+real_bogus REAL,
+sci_cutout_path VARCHAR NOT NULL,
+ref_cutout_path VARCHAR NOT NULL,
+sub_cutout_path VARCHAR NOT NULL,
+date_obs TIMESTAMP,
+object_id VARCHAR(64) NOT NULL,
+PRIMARY KEY(image_id, object_id)
+);
+
+CREATE TABLE IF NOT EXISTS {schema}.scamp_results (
+image_id INT NOT NULL,
+object_id VARCHAR(64),
+ra REAL,
+dec REAL,
+date_proc TIMESTAMP NOT NULL,
+astrom_offset_ref REAL[],
+astrom_sigma_ref REAL[],
+astrom_corr_ref REAL,
+astrom_chi_ref REAL,
+dist_map_path VARCHAR,
+fgroup_map_path VARCHAR,
+referr_1d_path VARCHAR,
+referr_2d_path VARCHAR,
+PRIMARY KEY(image_id, date_proc)
+);
+
+INSERT INTO {schema}.status(pipeline_step, shortname, total_runtime, n_processed, n_current)
+VALUES ('received', 'receiv', 0, 0, 0), ('captured', 'captur', 0, 0, 0)
+ON CONFLICT DO NOTHING;
+"""
+
+
+def create_baseline(db_details, schema, paths):
+    """Builds the baseline schema holding one queued image per path"""
+    connection = psycopg2.connect(**db_details)
+    with connection.cursor() as cursor:
+        cursor.execute(BASELINE_SCHEMA.replace("{schema}", schema))
+        for path in paths:
+            cursor.execute(f"""INSERT INTO {schema}.images(file_path, object_id, filter, ra, dec)
+                           VALUES (%s, 'baseline', 'r', 10.0, -20.0) RETURNING image_id;""", (path,))
+            image_id = cursor.fetchone()[0]
+            cursor.execute(f"""INSERT INTO {schema}.image_status(image_id, file_path, status, pipeline_step, processing_time)
+                           VALUES (%s, %s, 'received', 'received', 0);""", (image_id, path))
+        cursor.execute(f"UPDATE {schema}.status SET n_current = %s WHERE pipeline_step = 'received';", (len(paths),))
+    connection.commit()
+    return connection
+
+
+def test_upgrade_from_baseline_schema(db_details, schema, logger):
+    connection = create_baseline(db_details, schema, ["/raw/a.fits", "/raw/b.fits"])
+    assert schema_version(connection, schema) == 0
+
+    manager = DatabaseManager(db_details, logger, schema=schema, claim_order="priority")
+    try:
+        latest = pipeline_migrations(schema)[-1].version
+        assert schema_version(connection, schema) == latest
+
+        with connection.cursor() as cursor:
+            # Existing rows are kept and get the new columns
+            cursor.execute(f"SELECT file_path, priority, step_active FROM {schema}.image_status ORDER BY image_id;")
+            assert cursor.fetchall() == [("/raw/a.fits", 0, False), ("/raw/b.fits", 0, False)]
+            cursor.execute(f"SELECT cz FROM {schema}.images;")
+            assert all(cz == pytest.approx(-0.342, abs=1e-3) for (cz,) in cursor.fetchall())
+        connection.commit()
+
+        # The upgraded queue works with the new code
+        assert {row[0]: row[4] for row in manager.get_pipeline_status()}["received"] == 2
+        path, image_id, _ = manager.get_next_image()
+        assert path == "/raw/a.fits"
+        manager.finish_image(BenchmarkImage(db_id=image_id), end_time=datetime.now())
+        assert manager.get_image_status(image_id)["status"] == "complete"
+        assert manager.add_new_image(BenchmarkImage(index=1)) is True
+        assert manager.add_new_image(BenchmarkImage(index=1)) is False
+    finally:
+        manager.close()
+
+    # Starting again against an up-to-date database applies nothing
+    DatabaseManager(db_details, logger, schema=schema).close()
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {schema}.schema_version;")
+        assert cursor.fetchone()[0] == latest
+    connection.close()
+
+
+def test_failed_upgrade_is_rolled_back(db_details, schema, logger):
+    # Duplicate paths make the unique file_path migration fail
+    connection = create_baseline(db_details, schema, ["/raw/a.fits", "/raw/a.fits"])
+
+    with pytest.raises(DatabaseError):
+        DatabaseManager(db_details, logger, schema=schema)
+
+    assert schema_version(connection, schema) == 0
+    with connection.cursor() as cursor:
+        cursor.execute("""SELECT COUNT(*) FROM information_schema.columns
+                       WHERE table_schema = %s AND table_name = 'image_status' AND column_name = 'priority';""",
+                       (schema,))
+        assert cursor.fetchone()[0] == 0
+    connection.close()
+
+
+def test_only_optional_statements_are_skipped(db_details, schema, logger):
+    connection = psycopg2.connect(**db_details)
+    setup = [f"CREATE SCHEMA {schema};"]
+    create_table = Migration(1, "Table", [
+        f"CREATE TABLE {schema}.example (id INT PRIMARY KEY);",
+        OptionalStatement(f"ALTER TABLE {schema}.example OWNER TO no_such_role;"),
+    ])
+    broken_index = Migration(2, "Broken index", [f"CREATE INDEX example_idx ON {schema}.example (missing);"])
+
+    with pytest.raises(psycopg2.errors.UndefinedColumn):
+        apply_migrations(connection, [create_table, broken_index], schema, setup=setup, logger=logger)
+    assert schema_version(connection, schema) == 0
+
+    assert apply_migrations(connection, [create_table], schema, setup=setup, logger=logger) == 1
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (f"{schema}.example",))
+        assert cursor.fetchone()[0]
+    connection.close()
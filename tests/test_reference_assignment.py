@@ -0,0 +1,106 @@
+'''
+The NumPy KD-tree used for reference assignment, checked against a brute-force search,
+and assigning references to the images in the database.
+'''
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from database.benchmark import BenchmarkImage
+from database.reference_assignment import KDTree, ReferenceAssigner, ReferenceIndex
+
+
+def brute_force(points, vectors, k):
+    distances = np.linalg.norm(vectors[:, None, :] - points[None, :, :], axis=2)
+    return np.sort(distances, axis=1)[:, :k]
+
+
+def unit_vectors(rng, n):
+    vectors = rng.normal(size=(n, 3))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("n_points", [1, 5, 33, 2000])
+@pytest.mark.parametrize("k", [1, 3])
+def test_query_matches_brute_force(n_points, k):
+    rng = np.random.default_rng(n_points)
+    points = unit_vectors(rng, n_points)
+    vectors = unit_vectors(rng, 500)
+    distances, indices = KDTree(points, leaf_size=8).query(vectors, k)
+
+    expected = brute_force(points, vectors, k)
+    found = min(k, n_points)
+    np.testing.assert_allclose(distances[:, :found], expected, atol=1e-12)
+    np.testing.assert_allclose(np.linalg.norm(vectors[:, None, :] - points[indices[:, :found]], axis=2),
+                               expected, atol=1e-12)
+    # Missing neighbours are padded
+    assert np.all(distances[:, found:] == np.inf) and np.all(indices[:, found:] == -1)
+
+
+def test_repeated_points_and_blocks():
+    rng = np.random.default_rng(4)
+    points = np.repeat(unit_vectors(rng, 50), 4, axis=0)
+    tree = KDTree(points, leaf_size=8)
+    tree.max_block = 64
+    vectors = unit_vectors(rng, 300)
+    distances, _ = tree.query(vectors, 2)
+    np.testing.assert_allclose(distances, brute_force(points, vectors, 2), atol=1e-12)
+
+
+def test_empty_tree_and_k_limit():
+    distances, indices = KDTree(np.empty((0, 3))).query(np.zeros((2, 3)))
+    assert distances.shape == (2, 1) and np.all(indices == -1)
+    with pytest.raises(ValueError):
+        KDTree(np.zeros((4, 3)), leaf_size=4).query(np.zeros((1, 3)), k=3)
+
+
+def test_index_skips_non_finite_and_repeated_positions():
+    index = ReferenceIndex(min_rebuild=2)
+    index.add([1, 2, 3], [[1, 0, 0], [np.nan, np.nan, -1], [0, 1, 0]])
+    index.add([3, 4, 4], [[0, 1, 0], [0, 0, 1], [0, 0, 1]])
+    assert len(index) == 3
+
+    reference_ids, distances = index.nearest([1, 3, 5, 6], [[1, 0, 0], [0, 1, 0], [1, 0, 0], [np.nan, 0, 0]])
+    # No image is its own reference, and a position that is not finite gets none
+    assert reference_ids[0] in (3, 4) and distances[0] == pytest.approx(90)
+    assert reference_ids[1] in (1, 4) and distances[1] == pytest.approx(90)
+    assert reference_ids[2] == 1 and distances[2] == pytest.approx(0)
+    assert reference_ids[3] == -1
+
+
+def test_assign_references(manager, logger):
+    # Image 0 is at ra=0, which is stored as NULL, so it has no position
+    images = [BenchmarkImage(index=index) for index in range(20)]
+    late = BenchmarkImage(index=100)
+    late.ra = late.dec = None
+    manager.add_images(images + [late])
+
+    assigner = ReferenceAssigner(manager, logger)
+    assert assigner.assign_all() == 19
+    with manager._connection() as connection, connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM images WHERE reference_path = file_path;")
+        assert cursor.fetchone()[0] == 0
+
+        # An image given coordinates after it was added is still assigned, and becomes a reference
+        cursor.execute("UPDATE images SET ra = %s, dec = %s WHERE image_id = %s;",
+                       (images[5].ra, images[5].dec, late.db_id))
+        connection.commit()
+    assert assigner.assign_all() == 1
+    assert [row[0] for row in manager.get_image_positions("r", unassigned_only=True)] == []
+    position = next(row[1:] for row in manager.get_image_positions("r") if row[0] == images[5].db_id)
+    assert assigner.indexes["r"].nearest([images[5].db_id], [position])[0][0] == late.db_id
+    with manager._connection() as connection, connection.cursor() as cursor:
+        cursor.execute("SELECT reference_path, reference_distance FROM images WHERE image_id = %s;", (late.db_id,))
+        reference_path, distance = cursor.fetchone()
+        connection.commit()
+    assert reference_path == images[5].source_path and distance == pytest.approx(0, abs=1e-3)
+
+
+def test_index_is_reloaded(manager, logger):
+    images = [BenchmarkImage(index=index) for index in range(1, 6)]
+    manager.add_images(images)
+    assigner = ReferenceAssigner(manager, logger, rebuild_interval=0)
+    assigner.assign_all()
+    first = assigner.indexes["r"]
+    assigner.refresh("r")
+    assert assigner.indexes["r"] is not first and len(assigner.indexes["r"]) == 5
@@ -0,0 +1,72 @@
+'''
+Pipeline step counters sharded per worker thread.
+'''
+from datetime import datetime
+import threading
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+from database.database_manager import DatabaseManager
+
+
+def step_counts(manager, pipeline_step):
+    return {row[0]: tuple(row[2:]) for row in manager.get_pipeline_status()}[pipeline_step]
+
+
+def shard_rows(manager, pipeline_step):
+    with manager._connection() as connection, connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM status_shards WHERE pipeline_step = %s;", (pipeline_step,))
+        count = cursor.fetchone()[0]
+        connection.commit()
+        return count
+
+
+def test_threads_count_in_their_own_shards(manager, db_details, schema, logger):
+    images = [BenchmarkImage(index=index) for index in range(1, 41)]
+    manager.add_images(images)
+    start_time = datetime(2026, 1, 1, 22, 0)
+    workers = DatabaseManager(db_details, logger, schema=schema, pool_mode="thread")
+    barrier = threading.Barrier(4)
+
+    def process(batch):
+        barrier.wait()
+        for image in batch:
+            workers.update_image_status(image, "reduction", "reduce", start_time, 0)
+            workers.update_image_status(image, "reduction", "reduce", start_time, 0.5)
+
+    try:
+        threads = [threading.Thread(target=process, args=(images[n::4],)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        workers.close()
+
+    assert shard_rows(manager, "reduction") == 4
+    assert step_counts(manager, "reduction") == pytest.approx((20.0, 40, 0))
+
+    totals = manager.get_pipeline_status()
+    assert manager.rollup_step_counters() >= 4
+    assert shard_rows(manager, "reduction") == 0
+    assert sorted(manager.get_pipeline_status()) == sorted(totals)
+    assert manager.rollup_step_counters() == 0
+
+
+def test_exit_cleanup_zeros_current_counts(manager):
+    images = [BenchmarkImage(index=index) for index in range(1, 4)]
+    manager.add_images(images)
+    start_time = datetime(2026, 1, 1, 22, 0)
+    for image in images:
+        manager.update_image_status(image, "reduction", "reduce", start_time, 0)
+    manager.rollup_step_counters()
+    manager.update_image_status(images[0], "reduction", "reduce", start_time, 1.0)
+    manager.update_image_status(images[1], "photometry", "phot", start_time, 0)
+    assert step_counts(manager, "reduction") == pytest.approx((1.0, 1, 2))
+
+    manager.exit_cleanup()
+    assert step_counts(manager, "reduction") == pytest.approx((1.0, 1, 0))
+    assert step_counts(manager, "photometry") == pytest.approx((0.0, 0, 0))
@@ -0,0 +1,40 @@
+'''
+Method latency tracing and the slow-query log.
+'''
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+from database.instrumentation import _safe_to_analyze
+
+
+def test_only_side_effect_free_selects_are_analyzed():
+    assert _safe_to_analyze("SELECT file_path FROM images WHERE image_id = 1;")
+    assert not _safe_to_analyze("SELECT nextval(pg_get_serial_sequence('images', 'image_id'));")
+    assert not _safe_to_analyze("SELECT 1 FROM image_status FOR UPDATE SKIP LOCKED;")
+    assert not _safe_to_analyze("SELECT pg_notify('channel', '1');")
+    assert not _safe_to_analyze("UPDATE image_status SET status = 'processing';")
+    assert not _safe_to_analyze("WITH claimed AS (UPDATE image_status SET status = 'x' RETURNING 1) SELECT 1;")
+
+
+def test_tracing_with_analyze_does_not_repeat_side_effects(manager):
+    tracer = manager.enable_tracing(slow_threshold=0, explain=True, analyze=True)
+    images = [BenchmarkImage(index=index) for index in range(4)]
+    for image in images[:2]:
+        manager.add_image(image)
+    manager.add_images(images[2:])
+
+    # Explaining the inserts and nextval calls did not use up ids
+    assert [image.db_id for image in images] == list(range(images[0].db_id, images[0].db_id + 4))
+    assert manager.get_next_image()[1] == images[0].db_id
+    assert manager.get_queue_depth() == {0: 3}
+
+    report = manager.tracing_report()
+    assert report["add_image"]["calls"] == 2 and report["get_next_image"]["calls"] == 1
+    plans = [entry for entry in tracer.slow_queries if entry["plan"]]
+    assert plans
+    for entry in plans:
+        analyzed = "actual time" in entry["plan"]
+        assert analyzed == _safe_to_analyze(entry["sql"]), entry["sql"]
+    manager.disable_tracing()
@@ -0,0 +1,55 @@
+'''
+Waking idle workers with LISTEN/NOTIFY.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import pytest
+
+pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+
+
+def wait_while(manager, add, timeout):
+    """Runs add() while another thread waits for work, and returns what the wait returned"""
+    with ThreadPoolExecutor(1) as executor:
+        waiter = executor.submit(manager.wait_for_work, timeout)
+        # Let the waiter find the queue empty and start listening
+        time.sleep(0.5)
+        assert not waiter.done()
+        add()
+        return waiter.result(timeout=timeout + 10)
+
+
+def test_queued_work_returns_at_once(manager):
+    manager.add_image(BenchmarkImage(index=1))
+    start = time.monotonic()
+    assert manager.wait_for_work(30) is True
+    assert time.monotonic() - start < 10
+
+
+def test_empty_queue_times_out(manager):
+    start = time.monotonic()
+    assert manager.wait_for_work(0.5) is False
+    assert time.monotonic() - start >= 0.5
+
+
+@pytest.mark.parametrize("add", ["add_image", "add_images", "add_new_image", "reconcile_paths"])
+def test_adding_images_wakes_idle_workers(manager, add):
+    image = BenchmarkImage(index=1)
+    calls = {"add_image": lambda: manager.add_image(image),
+             "add_images": lambda: manager.add_images([image]),
+             "add_new_image": lambda: manager.add_new_image(image),
+             "reconcile_paths": lambda: manager.reconcile_paths([image.source_path])}
+    start = time.monotonic()
+    assert wait_while(manager, calls[add], 30) is True
+    assert time.monotonic() - start < 10
+
+
+def test_captured_exposures_do_not_wake_idle_workers(manager):
+    def capture():
+        manager.add_exposure("/raw/captured.fits", "field", 10.0, 20.0, "r")
+        manager.forward_exposures([("/raw/forwarded.fits", "field", 11.0, 21.0, "r", 0)])
+    assert wait_while(manager, capture, 2) is False
+    assert manager.get_queue_depth() == {}
@@ -0,0 +1,140 @@
+'''
+Write-behind status updates and moving finished images into the archive.
+'''
+from datetime import datetime, timedelta
+import gc
+import weakref
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+from database.benchmark import BenchmarkImage
+from database.database_manager import DatabaseManager
+
+
+def step_counts(manager, pipeline_step):
+    """Returns (total_runtime, n_processed, n_current) for a pipeline step"""
+    return {row[0]: row[2:] for row in manager.get_pipeline_status()}[pipeline_step]
+
+
+def process(manager, image, runtime, start_time):
+    """Claims an image and runs it through one buffered pipeline step"""
+    path, image_id, _ = manager.get_next_image()
+    assert path == image.source_path and image_id == image.db_id
+    manager.start_image(image, "test-machine", start_time)
+    manager.update_image_status(image, "reduction", "reduce", start_time, 0)
+    manager.update_image_status(image, "reduction", "reduce", start_time + timedelta(seconds=runtime), runtime, "done")
+
+
+def test_finish_image_writes_buffered_updates_first(manager):
+    image = BenchmarkImage(index=1)
+    manager.add_image(image)
+    manager.enable_write_behind(max_batch=1000, max_delay=60)
+
+    start_time = datetime(2026, 1, 1, 22, 0)
+    process(manager, image, 2.5, start_time)
+    manager.finish_image(image, end_time=start_time + timedelta(seconds=10))
+
+    status = manager.get_image_status(image.db_id)
+    assert status["status"] == "complete"
+    assert status["pipeline_step"] == "reduction"
+    assert status["step_message"] == "done"
+    assert status["processing_time"] == pytest.approx(2.5)
+    assert step_counts(manager, "reduction") == pytest.approx((2.5, 1, 0))
+
+    # A late update for the archived image is dropped rather than moving the counters
+    manager.update_image_status(image, "reduction", "reduce", start_time, 1.0)
+    manager.flush_status_updates()
+    assert step_counts(manager, "reduction") == pytest.approx((2.5, 1, 0))
+    assert manager.get_image_status(image.db_id)["processing_time"] == pytest.approx(2.5)
+    manager.disable_write_behind()
+
+
+def test_archive_finished_images_writes_buffered_updates_first(manager):
+    images = [BenchmarkImage(index=index) for index in range(3)]
+    for image in images:
+        manager.add_image(image)
+    manager.enable_write_behind(max_batch=1000, max_delay=60)
+
+    start_time = datetime(2026, 1, 1, 22, 0)
+    for image in images[:2]:
+        process(manager, image, 1.5, start_time)
+    with manager._connection() as connection, connection.cursor() as cursor:
+        cursor.execute("UPDATE image_status SET status = 'complete' WHERE image_id = ANY(%s);",
+                       ([image.db_id for image in images[:2]],))
+        connection.commit()
+
+    assert manager.archive_finished_images() == 2
+    for image in images[:2]:
+        status = manager.get_image_status(image.db_id)
+        assert (status["status"], status["pipeline_step"]) == ("complete", "reduction")
+        assert status["processing_time"] == pytest.approx(1.5)
+    assert manager.get_image_status(images[2].db_id)["status"] == "received"
+    assert step_counts(manager, "reduction") == pytest.approx((3.0, 2, 0))
+    manager.disable_write_behind()
+
+
+def test_flush_does_not_use_the_callers_connection(manager):
+    image = BenchmarkImage(index=1)
+    manager.add_image(image)
+    manager.enable_write_behind(max_batch=1000, max_delay=60)
+
+    # Loading the step registry during the flush must not open a transaction on the caller's connection
+    manager.invalidate_step_registry()
+    manager.update_image_status(image, "new step", "new", datetime.now(), 0)
+    assert manager.flush_status_updates() == 1
+    assert manager.connection.status == psycopg2.extensions.STATUS_READY
+    assert manager.pipeline_step_in_database("new step")
+    assert step_counts(manager, "new step") == pytest.approx((0, 0, 1))
+    manager.disable_write_behind()
+
+
+def test_late_synchronous_update_is_dropped(manager):
+    image = BenchmarkImage(index=1)
+    manager.add_image(image)
+    start_time = datetime(2026, 1, 1, 22, 0)
+    process(manager, image, 2.5, start_time)
+    manager.finish_image(image, end_time=start_time + timedelta(seconds=10))
+    assert step_counts(manager, "reduction") == pytest.approx((2.5, 1, 0))
+
+    manager.update_image_status(image, "reduction", "reduce", start_time, 1.0)
+    manager.update_image_status(image, "calibration", "calib", start_time, 0)
+    assert step_counts(manager, "reduction") == pytest.approx((2.5, 1, 0))
+    assert step_counts(manager, "calibration") == pytest.approx((0, 0, 0))
+    assert manager.get_image_status(image.db_id)["processing_time"] == pytest.approx(2.5)
+
+
+def test_unused_manager_is_collected_and_flushed(db_details, schema, logger):
+    manager = DatabaseManager(db_details, logger, schema=schema)
+    image = BenchmarkImage(index=1)
+    manager.add_image(image)
+    manager.enable_write_behind(max_batch=1000, max_delay=60)
+    manager.start_archiver(60)
+    manager.start_counter_rollup(60)
+    manager.start_lease_reaper(60)
+    manager.update_image_status(image, "reduction", "reduce", datetime.now(), 0)
+
+    # Neither the background threads nor the exit hook keep the manager alive
+    reference = weakref.ref(manager)
+    del manager
+    gc.collect()
+    assert reference() is None
+
+    manager = DatabaseManager(db_details, logger, schema=schema)
+    assert manager.get_image_status(image.db_id)["pipeline_step"] == "reduction"
+    manager.close()
+
+
+def test_claim_is_committed(manager, db_details, schema):
+    image = BenchmarkImage(index=1)
+    manager.add_image(image)
+    assert manager.get_next_image()[1] == image.db_id
+    assert manager.connection.status == psycopg2.extensions.STATUS_READY
+
+    # Other connections, such as the write-behind flush, can update the claimed row
+    connection = psycopg2.connect(options=f"-c search_path={schema}", **db_details)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT status FROM image_status WHERE image_id = %s FOR UPDATE NOWAIT;", (image.db_id,))
+        assert cursor.fetchone()[0] == "processing"
+    connection.close()